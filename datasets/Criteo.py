@@ -32,6 +32,7 @@ class Criteo(Dataset):
     raw_data_dir = os.path.join(data_dir, 'raw')
     feature_data_dir = os.path.join(data_dir, 'feature')
     hdf_data_dir = os.path.join(data_dir, 'hdf')
+    column_data_dir = os.path.join(data_dir, 'column')
 
     def __init__(self, initialized=True):
         """
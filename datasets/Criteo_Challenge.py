@@ -35,6 +35,7 @@ class Criteo_Challenge(Dataset):
     raw_data_dir = os.path.join(data_dir, 'raw')
     feature_data_dir = os.path.join(data_dir, 'feature')
     hdf_data_dir = os.path.join(data_dir, 'hdf')
+    column_data_dir = os.path.join(data_dir, 'column')
     train_size = 47681234
     test_size = 6042135
 
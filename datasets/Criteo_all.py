@@ -12,6 +12,7 @@ import numpy as np
 import pandas as pd
 
 from .Dataset import Dataset, DatasetHelper
+from .cache import ArtifactCache, dump_meta, load_meta
 
 
 class Criteo_all(Dataset):
@@ -27,8 +28,16 @@ class Criteo_all(Dataset):
     raw_data_dir = os.path.join(data_dir, 'raw')
     feature_data_dir = os.path.join(data_dir, 'feature')
     hdf_data_dir = os.path.join(data_dir, 'hdf')
+    column_data_dir = os.path.join(data_dir, 'column')
 
-    def __init__(self, initialized=True, num_of_days=9):
+    def __init__(self, initialized=True, num_of_days=9, cache_dir=None, min_count=40, sample_seed=None):
+        """
+        :param initialized: run the preprocessing pipeline into the default directories if False
+        :param num_of_days: 9 or 16
+        :param cache_dir: if set, run the pipeline as cached stages in cache_dir instead, see build()
+        :param min_count: cutoff of the vocabulary
+        :param sample_seed: seed of negative down sampling
+        """
         self.initialized = initialized
         if num_of_days == 9:
             self.num_of_days = num_of_days
@@ -63,21 +72,7 @@ class Criteo_all(Dataset):
         else:
             print('invalid setting! num_of_days should be 9 or 16')
             exit(0)
-        self.train_size = sum(self.file_sizes[:-2])
-        self.valid_size = self.file_sizes[-2]
-        self.test_size = self.file_sizes[-1]
-
-        self.train_hdf_files = []
-        for i in range(self.num_of_days - 2):
-            for j in range(self.num_of_parts[i]):
-                self.train_hdf_files.append(os.path.join(self.hdf_data_dir, '%s_%s_<>_part_%d.h5' %
-                                                         (self.prefix, self.log_files[i], j)))
-        self.valid_hdf_files = [
-            os.path.join(self.hdf_data_dir, '%s_%s_<>_part_%d.h5' % (self.prefix, self.log_files[-2], j))
-            for j in range(self.num_of_parts[-2])]
-        self.test_hdf_files = [
-            os.path.join(self.hdf_data_dir, '%s_%s_<>_part_%d.h5' % (self.prefix, self.log_files[-1], j))
-            for j in range(self.num_of_parts[-1])]
+        self._set_blocks_()
 
         self.X_train = None
         self.y_train = None
@@ -86,137 +81,239 @@ class Criteo_all(Dataset):
         self.X_test = None
         self.y_test = None
 
-        if not self.initialized:
+        if cache_dir is not None:
+            self.build(ArtifactCache(cache_dir), min_count=min_count, sample_seed=sample_seed)
+        elif not self.initialized:
             # down sample
             for _f in self.log_files:
-                self.down_sample(_f)
+                self.down_sample(_f, seed=sample_seed)
 
             # create feature map
-            if num_of_days == 9:
-                feat_map = pkl.load(open('../Criteo-all/raw/7day_feat_map.pkl', 'rb'))
-            elif num_of_days == 16:
-                feat_map = pkl.load(open('../Criteo-all/raw/14day_feat_map.pkl', 'rb'))
-            else:
-                print('invalid setting! num_of_days should be 9 or 16')
-                exit(0)
-
-            feat_sizes = []
-            num_feat = []
-            for i in range(13):
-                kv = []
-                for k, v in feat_map[i].iteritems():
-                    if k == '':
-                        kv.append([-1, v])
-                    else:
-                        kv.append([int(k), v])
-                kv = sorted(kv, key=lambda x: x[0])
-                kv = np.array(kv)
-                _s = 0
-                thresholds = []
-                for j in range(len(kv) - 1):
-                    _k, _v = kv[j]
-                    _s += _v
-                    if _s > 40:
-                        thresholds.append(_k)
-                        _s = 0
-                thresholds = np.array(thresholds)
-                num_feat.append(thresholds)
-                feat_sizes.append(len(num_feat[i]) + 1)
-
-            cat_feat = []
-            for i in range(13, 39):
-                cat_feat.append({})
-                for k, v in feat_map[i].iteritems():
-                    if v > 40:
-                        cat_feat[i - 13][k] = len(cat_feat[i - 13])
-                cat_feat[i - 13]['other'] = len(cat_feat[i - 13])
-                feat_sizes.append(len(cat_feat[i - 13]))
-
+            feat_map = pkl.load(open(os.path.join(self.raw_data_dir, self.prefix + '_feat_map.pkl'), 'rb'))
+            num_feat, cat_feat = self.build_vocab(feat_map, min_count)
             pkl.dump(num_feat, open(os.path.join(self.raw_data_dir, self.prefix + '_num_feat.pkl'), 'wb'))
             print('dump num_feat')
             pkl.dump(cat_feat, open(os.path.join(self.raw_data_dir, self.prefix + '_cat_feat.pkl'), 'wb'))
             print('dump cat_feat')
 
             # collect statistics
-            feat_sizes = []
-            num_feat = pkl.load(open(os.path.join(self.raw_data_dir, self.prefix + '_num_feat.pkl'), 'rb'))
-            cat_feat = pkl.load(open(os.path.join(self.raw_data_dir, self.prefix + '_cat_feat.pkl'), 'rb'))
-            for i in range(13):
-                feat_sizes.append(len(num_feat[i]) + 1)
-            for i in range(26):
-                feat_sizes.append(len(cat_feat[i]))
+            feat_sizes = self.vocab_sizes(num_feat, cat_feat)
             feat_min = [sum(feat_sizes[:i]) for i in range(39)]
             print(feat_sizes)
             print(feat_min)
             print(sum(feat_sizes))
 
+            # split into blocks and convert to index
+            num_of_parts = []
             file_sizes = []
-            for i, _f in enumerate(self.log_files):
-                cnt = 0
-                for j in range(self.num_of_parts[i]):
-                    f_in = os.path.join(self.feature_data_dir, '%s_%s_output.part_%d' % (self.prefix, _f, j))
-                    with open(f_in) as fin:
-                        cnt += len(fin.readlines())
-                file_sizes.append(cnt)
+            for _f in self.log_files:
+                parts, size = self.convert(_f, num_feat, cat_feat, feat_min, self.raw_data_dir, self.feature_data_dir)
+                num_of_parts.append(parts)
+                file_sizes.append(size)
+            print(num_of_parts)
             print(file_sizes)
 
-            # split into blocks and convert to index
-            for _f in self.log_files[15:18]:
-                cur_index = 0
-                f_in = os.path.join(self.raw_data_dir, _f + '.sample')
-
-                def output(cur_index, X, y):
-                    if len(y) == 0:
-                        return
-
-                    f_out_x = os.path.join(self.feature_data_dir, '%s_%s_input.part_%d' % (self.prefix, _f, cur_index))
-                    f_out_y = os.path.join(self.feature_data_dir, '%s_%s_output.part_%d' % (self.prefix, _f, cur_index))
-                    for i in range(len(X)):
-                        for j in range(13):
-                            _v = int(X[i][j]) if X[i][j] != '' else -1
-                            X[i][j] = len(np.where(num_feat[j] < _v)[0])
-                        for j in range(13, 39):
-                            _v = X[i][j]
-                            if _v in cat_feat[j - 13]:
-                                X[i][j] = cat_feat[j - 13][_v]
-                            else:
-                                X[i][j] = cat_feat[j - 13]['other']
-                    for i in range(len(X)):
-                        X[i] = ' '.join([str(X[i][j] + feat_min[j]) for j in range(39)])
-                        X[i] = X[i] + '\n'
-                    with open(f_out_y, 'a') as fout_y:
-                        for _y in y:
-                            fout_y.write(_y)
-                    with open(f_out_x, 'a') as fout_x:
-                        for _x in X:
-                            fout_x.write(_x)
-
-                with open(f_in) as fin:
-                    cnt = 0
-                    y = []
-                    X = []
-                    for line in fin:
-                        line = line.strip().split('\t')
-                        y.append(line[0] + '\n')
-                        X.append(line[1:])
-                        cnt += 1
-                        if cnt % 100000 == 0:
-                            print('processing', cnt, 'output', _f, 'part', cur_index)
-                            output(cur_index, X, y)
-                            y = []
-                            X = []
-                        if cnt % self.block_size == 0:
-                            cur_index += 1
-                    output(cur_index, X, y)
-
             # convert to hdf
             for i, _f in enumerate(self.log_files):
-                self.feature_to_hdf(self.num_of_parts[i], self.prefix + '_' + _f, self.feature_data_dir,
+                self.feature_to_hdf(num_of_parts[i], self.prefix + '_' + _f, self.feature_data_dir,
                                     self.hdf_data_dir)
 
-    def down_sample(self, f):
+    def _set_blocks_(self):
+        self.train_size = sum(self.file_sizes[:-2])
+        self.valid_size = self.file_sizes[-2]
+        self.test_size = self.file_sizes[-1]
+
+        self.train_hdf_files = []
+        for i in range(self.num_of_days - 2):
+            for j in range(self.num_of_parts[i]):
+                self.train_hdf_files.append(os.path.join(self.hdf_data_dir, '%s_%s_<>_part_%d.h5' %
+                                                         (self.prefix, self.log_files[i], j)))
+        self.valid_hdf_files = [
+            os.path.join(self.hdf_data_dir, '%s_%s_<>_part_%d.h5' % (self.prefix, self.log_files[-2], j))
+            for j in range(self.num_of_parts[-2])]
+        self.test_hdf_files = [
+            os.path.join(self.hdf_data_dir, '%s_%s_<>_part_%d.h5' % (self.prefix, self.log_files[-1], j))
+            for j in range(self.num_of_parts[-1])]
+
+    def build(self, cache, min_count=40, sample_seed=None):
+        """
+        run the preprocessing pipeline as cached stages: down sample -> vocab -> conversion -> hdf export.
+            each stage is skipped if it was already built from the same inputs and parameters, e.g. changing
+            min_count redoes vocab and conversion but reuses the down-sampled logs
+        :param cache: ArtifactCache
+        :param min_count: ids (or numeric buckets) seen no more than min_count times are merged
+        :param sample_seed: seed of negative down sampling
+        :return:
+        """
+        feat_map_file = os.path.join(self.raw_data_dir, self.prefix + '_feat_map.pkl')
+
+        def vocab(out_dir):
+            num_feat, cat_feat = self.build_vocab(pkl.load(open(feat_map_file, 'rb')), min_count)
+            pkl.dump(num_feat, open(os.path.join(out_dir, 'num_feat.pkl'), 'wb'))
+            pkl.dump(cat_feat, open(os.path.join(out_dir, 'cat_feat.pkl'), 'wb'))
+            dump_meta(out_dir, {'feat_sizes': self.vocab_sizes(num_feat, cat_feat)})
+
+        vocab_dir = cache.stage('vocab_' + self.prefix, vocab, params={'min_count': min_count},
+                                inputs=[feat_map_file])
+        feat_sizes = load_meta(vocab_dir)['feat_sizes']
+        feat_min = [sum(feat_sizes[:i]) for i in range(39)]
+
+        def convert(out_dir, _f, sample_dir):
+            num_feat = pkl.load(open(os.path.join(vocab_dir, 'num_feat.pkl'), 'rb'))
+            cat_feat = pkl.load(open(os.path.join(vocab_dir, 'cat_feat.pkl'), 'rb'))
+            num_of_parts, size = self.convert(_f, num_feat, cat_feat, feat_min, sample_dir, out_dir)
+            dump_meta(out_dir, {'num_of_parts': num_of_parts, 'size': size})
+
+        def to_hdf(out_dir, _f, feature_dir):
+            self.feature_to_hdf(load_meta(feature_dir)['num_of_parts'], self.prefix + '_' + _f, feature_dir,
+                                out_dir)
+
+        hdf_dirs = []
+        num_of_parts = []
+        file_sizes = []
+        for _f in self.log_files:
+            sample_dir = cache.stage('sample_' + _f, lambda out_dir, _f=_f: self.down_sample(_f, out_dir, sample_seed),
+                                     params={'seed': sample_seed}, inputs=[os.path.join(self.raw_data_dir, _f)])
+            feature_dir = cache.stage('feature_%s_%s' % (self.prefix, _f),
+                                      lambda out_dir, _f=_f, d=sample_dir: convert(out_dir, _f, d),
+                                      params={'block_size': self.block_size}, inputs=[vocab_dir, sample_dir])
+            hdf_dirs.append(cache.stage('hdf_%s_%s' % (self.prefix, _f),
+                                        lambda out_dir, _f=_f, d=feature_dir: to_hdf(out_dir, _f, d),
+                                        inputs=[feature_dir]))
+            meta = load_meta(feature_dir)
+            num_of_parts.append(meta['num_of_parts'])
+            file_sizes.append(meta['size'])
+
+        def link(out_dir):
+            for d in hdf_dirs:
+                for name in os.listdir(d):
+                    if name.endswith('.h5'):
+                        os.symlink(os.path.join(d, name), os.path.join(out_dir, name))
+
+        self.hdf_data_dir = cache.stage('hdf_' + self.prefix, link, inputs=hdf_dirs)
+        self.feat_sizes = feat_sizes
+        self.feat_min = feat_min
+        self.num_features = sum(feat_sizes)
+        self.num_of_parts = num_of_parts
+        self.file_sizes = file_sizes
+        self._set_blocks_()
+
+    @staticmethod
+    def build_vocab(feat_map, min_count=40):
+        """
+        :param feat_map: per-field value -> count
+        :param min_count: numeric values are bucketized so that every bucket has more than min_count samples,
+            categorical values seen no more than min_count times are merged into 'other'
+        :return: thresholds of the numeric buckets, index of the categorical values
+        """
+        num_feat = []
+        for i in range(13):
+            kv = []
+            for k, v in feat_map[i].items():
+                if k == '':
+                    kv.append([-1, v])
+                else:
+                    kv.append([int(k), v])
+            kv = sorted(kv, key=lambda x: x[0])
+            kv = np.array(kv)
+            _s = 0
+            thresholds = []
+            for j in range(len(kv) - 1):
+                _k, _v = kv[j]
+                _s += _v
+                if _s > min_count:
+                    thresholds.append(_k)
+                    _s = 0
+            thresholds = np.array(thresholds)
+            num_feat.append(thresholds)
+
+        cat_feat = []
+        for i in range(13, 39):
+            cat_feat.append({})
+            for k, v in feat_map[i].items():
+                if v > min_count:
+                    cat_feat[i - 13][k] = len(cat_feat[i - 13])
+            cat_feat[i - 13]['other'] = len(cat_feat[i - 13])
+        return num_feat, cat_feat
+
+    @staticmethod
+    def vocab_sizes(num_feat, cat_feat):
+        feat_sizes = []
+        for i in range(13):
+            feat_sizes.append(len(num_feat[i]) + 1)
+        for i in range(26):
+            feat_sizes.append(len(cat_feat[i]))
+        return feat_sizes
+
+    def convert(self, _f, num_feat, cat_feat, feat_min, sample_dir, feature_data_dir):
+        """
+        split a down-sampled log into blocks of feature files
+        :param _f: log file name
+        :param num_feat, cat_feat: see build_vocab()
+        :param feat_min:
+        :param sample_dir: directory of <_f>.sample
+        :param feature_data_dir:
+        :return: number of blocks, number of samples
+        """
+        cur_index = 0
+        f_in = os.path.join(sample_dir, _f + '.sample')
+
+        def output(cur_index, X, y):
+            if len(y) == 0:
+                return
+
+            f_out_x = os.path.join(feature_data_dir, '%s_%s_input.part_%d' % (self.prefix, _f, cur_index))
+            f_out_y = os.path.join(feature_data_dir, '%s_%s_output.part_%d' % (self.prefix, _f, cur_index))
+            for i in range(len(X)):
+                for j in range(13):
+                    _v = int(X[i][j]) if X[i][j] != '' else -1
+                    X[i][j] = len(np.where(num_feat[j] < _v)[0])
+                for j in range(13, 39):
+                    _v = X[i][j]
+                    if _v in cat_feat[j - 13]:
+                        X[i][j] = cat_feat[j - 13][_v]
+                    else:
+                        X[i][j] = cat_feat[j - 13]['other']
+            for i in range(len(X)):
+                X[i] = ' '.join([str(X[i][j] + feat_min[j]) for j in range(39)])
+                X[i] = X[i] + '\n'
+            with open(f_out_y, 'a') as fout_y:
+                for _y in y:
+                    fout_y.write(_y)
+            with open(f_out_x, 'a') as fout_x:
+                for _x in X:
+                    fout_x.write(_x)
+
+        with open(f_in) as fin:
+            cnt = 0
+            y = []
+            X = []
+            for line in fin:
+                line = line.strip().split('\t')
+                y.append(line[0] + '\n')
+                X.append(line[1:])
+                cnt += 1
+                if cnt % 100000 == 0:
+                    print('processing', cnt, 'output', _f, 'part', cur_index)
+                    output(cur_index, X, y)
+                    y = []
+                    X = []
+                if cnt % self.block_size == 0:
+                    cur_index += 1
+            output(cur_index, X, y)
+        return int(np.ceil(cnt * 1. / self.block_size)), cnt
+
+    def down_sample(self, f, out_dir=None, seed=None):
+        """
+        keep all positive samples and as many negative samples in expectation
+        :param f: log file name
+        :param out_dir: directory of <f>.sample, default is raw_data_dir
+        :param seed:
+        :return:
+        """
         f_in = os.path.join(self.raw_data_dir, f)
-        f_out = f_in + '.sample'
+        f_out = os.path.join(out_dir or self.raw_data_dir, f + '.sample')
+        rng = np.random.RandomState(seed) if seed is not None else np.random
         with open(f_in, 'r') as fin:
             neg_cnt = 0
             pos_cnt = 0
@@ -235,7 +332,7 @@ class Criteo_all(Dataset):
             for line in fin:
                 if line[0] == '1':
                     buf.append(line)
-                elif np.random.random() < neg_threshold:
+                elif rng.random_sample() < neg_threshold:
                     buf.append(line)
                 cnt += 1
                 if cnt % 1000000 == 0:
@@ -261,7 +358,14 @@ class Criteo_all(Dataset):
         for i in range(self.max_length):
             print('%s\t%d\t%d' % (self.feat_names[i], self.feat_min[i], self.feat_sizes[i]))
 
-    def _files_iter_(self, gen_type='train', shuffle_block=False):
+    def _files_iter_(self, gen_type='train', shuffle_block=False, block_fraction=None, block_seed=0):
+        """
+        :param gen_type: 'train', 'valid', or 'test', each is a separate range of days
+        :param shuffle_block:
+        :param block_fraction: only iterate a stratified subsample of the blocks, see Dataset._files_iter_()
+        :param block_seed:
+        :return: input_hdf_file_name, output_hdf_file_name
+        """
         gen_type = gen_type.lower()
         if gen_type == 'train':
             hdf_files = self.train_hdf_files
@@ -269,6 +373,10 @@ class Criteo_all(Dataset):
             hdf_files = self.valid_hdf_files
         elif gen_type == 'test':
             hdf_files = self.test_hdf_files
+        if block_fraction is not None and block_fraction < 1:
+            hdf_files = [hdf_files[i] for i in self.stratified_blocks(len(hdf_files), block_fraction, block_seed)]
+        else:
+            hdf_files = list(hdf_files)
         if shuffle_block:
             np.random.shuffle(hdf_files)
         for x in hdf_files:
@@ -294,12 +402,12 @@ class Criteo_all(Dataset):
         y_all = []
         for hdf_in, hdf_out in self._files_iter_(gen_type, False):
             print(hdf_in.split('/')[-1], '/', num_of_parts, 'loaded')
-            num_lines = pd.HDFStore(hdf_out, mode='r').get_storer('fixed').shape[0]
+            block_in, block_out = self._block_path_(hdf_in), self._block_path_(hdf_out)
+            num_lines = self._block_lines_(block_out)
             one_piece = int(np.ceil(num_lines / num_workers))
             start = one_piece * task_index
             stop = one_piece * (task_index + 1)
-            X_block = pd.read_hdf(hdf_in, mode='r', start=start, stop=stop).as_matrix()
-            y_block = pd.read_hdf(hdf_out, mode='r', start=start, stop=stop).as_matrix()
+            X_block, y_block = self._read_block_(block_in, block_out, start=start, stop=stop)
             X_all.append(X_block)
             y_all.append(y_block)
         X_all = np.vstack(X_all)
@@ -322,37 +430,62 @@ class Criteo_all(Dataset):
         return DatasetHelper(self, kwargs)
 
     def __iter__(self, gen_type='train', batch_size=None, shuffle_block=False, random_sample=False, split_fields=False,
-                 on_disk=True, squeeze_output=True, num_workers=1, task_index=0, **kwargs):
+                 on_disk=True, squeeze_output=True, num_workers=1, task_index=0, fields=None, neg_sample_rate=None,
+                 neg_sample_seed=None, block_fraction=None, block_seed=0):
+        """
+        same as Dataset.__iter__(), except that the valid set is a separate day rather than a ratio of the train set.
+            unknown options raise a TypeError instead of being ignored
+        """
         gen_type = gen_type.lower()
+        fields = self.field_index(fields)
+        rng = np.random.RandomState(neg_sample_seed) if neg_sample_seed is not None else np.random
 
         def _iter_():
             if on_disk:
                 print('on disk...')
-                for hdf_X, hdf_y in self._files_iter_(gen_type=gen_type, shuffle_block=shuffle_block):
-                    num_lines = pd.HDFStore(hdf_y, mode='r').get_storer('fixed').shape[0]
+                num_of_parts = len(self.valid_hdf_files if gen_type == 'valid' else
+                                   self.test_hdf_files if gen_type == 'test' else self.train_hdf_files)
+                row_fraction = None
+                if block_fraction is not None and block_fraction * num_of_parts < 1:
+                    row_fraction = block_fraction * num_of_parts
+                for hdf_X, hdf_y in self._files_iter_(gen_type=gen_type, shuffle_block=shuffle_block,
+                                                      block_fraction=block_fraction, block_seed=block_seed):
+                    block_X, block_y = self._block_path_(hdf_X), self._block_path_(hdf_y)
+                    num_lines = self._block_lines_(block_y)
                     one_piece = int(np.ceil(num_lines / num_workers))
                     start = one_piece * task_index
                     stop = one_piece * (task_index + 1)
-                    X_all = pd.read_hdf(hdf_X, mode='r', start=start, stop=stop).as_matrix()
-                    y_all = pd.read_hdf(hdf_y, mode='r', start=start, stop=stop).as_matrix()
-                    yield X_all, y_all, hdf_X
+                    X_all, y_all = self._read_block_(block_X, block_y, start=start, stop=stop, fields=fields)
+                    if row_fraction is not None:
+                        index = self.stratified_rows(y_all, row_fraction, np.random.RandomState(block_seed))
+                        X_all, y_all = X_all[index], y_all[index]
+                    yield X_all, y_all, block_X
             else:
                 print('in memory...')
                 self.load_data(gen_type=gen_type, num_workers=num_workers, task_index=task_index)
                 if gen_type == 'train':
-                    yield self.X_train, self.y_train, gen_type
+                    X_all, y_all = self.X_train, self.y_train
                 elif gen_type == 'valid':
-                    yield self.X_valid, self.y_valid, gen_type
+                    X_all, y_all = self.X_valid, self.y_valid
                 elif gen_type == 'test':
-                    yield self.X_test, self.y_test, gen_type
+                    X_all, y_all = self.X_test, self.y_test
+                if fields is not None:
+                    X_all = X_all[:, fields]
+                yield X_all, y_all, gen_type
 
         for X_all, y_all, block in _iter_():
-            gen = self.generator(X_all, y_all, batch_size, shuffle=random_sample)
+            index = self._neg_sample_(y_all, neg_sample_rate, rng) if neg_sample_rate else None
+            gen = self.generator(X_all, y_all, batch_size, shuffle=random_sample, index=index)
             for X, y in gen:
+                if self.id_remap is not None:
+                    X = np.take(self.id_remap, X)
                 if split_fields:
-                    X = np.split(X, self.max_length, axis=1)
-                    for i in range(self.max_length):
-                        X[i] -= self.feat_min[i]
+                    X = self._split_fields_(X, fields)
+                if neg_sample_rate:
+                    weights = np.where(y.reshape(-1) == 1, 1., 1. / neg_sample_rate)
                 if squeeze_output:
                     y = y.squeeze()
-                yield X, y
+                if neg_sample_rate:
+                    yield X, y, weights
+                else:
+                    yield X, y
@@ -1,18 +1,28 @@
 from __future__ import print_function
 
+import hashlib
 import os
 
 import numpy as np
 import pandas as pd
 
+from .cache import ArtifactCache
+from .screening import interaction_scores, top_mask
+
 
 class DatasetHelper:
     def __init__(self, dataset, kwargs):
         self.dataset = dataset
         self.kwargs = kwargs
+        self.rounds = 0
 
     def __iter__(self):
-        for x in self.dataset.__iter__(**self.kwargs):
+        kwargs = self.kwargs
+        if kwargs.get('neg_sample_seed') is not None:
+            # draw different negatives at every round
+            kwargs = dict(kwargs, neg_sample_seed=kwargs['neg_sample_seed'] + self.rounds)
+        self.rounds += 1
+        for x in self.dataset.__iter__(**kwargs):
             yield x
 
     @property
@@ -53,6 +63,10 @@ class Dataset:
         feature_data_dir: raw_to_feature() will process raw data and produce libsvm-format feature files,
             and feature engineering is done here
         hdf_data_dir: feature_to_hdf() will convert feature files into hdf5 tables, according to block_size
+        column_data_dir: to_column_format() will export hdf blocks into a column-oriented layout, one npy file
+            per field, so that a subset of fields can be read without touching the others
+    block_format: 'hdf' or 'column', decide which layout the iterator reads blocks from
+    id_remap: old id -> new id array applied to every batch, set by apply_remap(lazy=True)
     """
     block_size = None
     train_num_of_parts = 0
@@ -75,6 +89,9 @@ class Dataset:
     raw_data_dir = None
     feature_data_dir = None
     hdf_data_dir = None
+    column_data_dir = None
+    block_format = 'hdf'
+    id_remap = None
 
     X_train = None
     y_train = None
@@ -152,13 +169,338 @@ class Dataset:
         for i in range(len(self.feat_names)):
             print('%s\t%d\t%d' % (self.feat_names[i], self.feat_min[i], self.feat_sizes[i]))
 
-    def _files_iter_(self, gen_type='train', shuffle_block=False):
+    def field_index(self, fields=None):
+        """
+        resolve selected fields into column indices
+        :param fields: field names (see feat_names) or column indices, None means all fields
+        :return: sorted column indices, or None if fields is None
+        """
+        if fields is None:
+            return None
+        index = set()
+        for f in fields:
+            if isinstance(f, str):
+                index.add(self.feat_names.index(f))
+            else:
+                index.add(int(f))
+        return sorted(index)
+
+    def _block_path_(self, hdf_file, block_format=None):
+        """
+        map a block file yielded by _files_iter_ onto the directory of the given layout
+        :param hdf_file: path of an hdf block, e.g. .../train_input_part_0.h5
+        :param block_format: 'hdf' or 'column', default is self.block_format
+        :return: hdf file path, or column block path (a directory for inputs, a prefix of an npy file for outputs)
+        """
+        block_format = block_format or self.block_format
+        name = os.path.basename(hdf_file)
+        if block_format == 'column':
+            return os.path.join(self.column_data_dir, name[:-len('.h5')])
+        return os.path.join(self.hdf_data_dir, name)
+
+    def _block_lines_(self, block_out, block_format=None):
+        block_format = block_format or self.block_format
+        if block_format == 'column':
+            return np.load(block_out + '.npy', mmap_mode='r').shape[0]
+        with pd.HDFStore(block_out, mode='r') as hdf_out:
+            return hdf_out.get_storer('fixed').shape[0]
+
+    def _read_block_(self, block_in, block_out, start=None, stop=None, fields=None, block_format=None):
+        """
+        read rows [start, stop) of a block. in column layout only the selected fields are read from disk
+        :param fields: column indices, see field_index()
+        :return: X of shape (rows, len(fields)), y of shape (rows, 1)
+        """
+        block_format = block_format or self.block_format
+        if block_format == 'column':
+            if fields is None:
+                fields = range(self.max_length)
+            X = np.stack([np.load(os.path.join(block_in, 'field_%d.npy' % j), mmap_mode='r')[start:stop]
+                          for j in fields], axis=1)
+            y = np.array(np.load(block_out + '.npy', mmap_mode='r')[start:stop])
+        else:
+            X = pd.read_hdf(block_in, mode='r', start=start, stop=stop).values
+            y = pd.read_hdf(block_out, mode='r', start=start, stop=stop).values
+            if fields is not None:
+                X = X[:, fields]
+        return X, y
+
+    def _write_block_(self, X, y, block_in, block_out, block_format=None):
+        block_format = block_format or self.block_format
+        if block_format == 'column':
+            if not os.path.exists(block_in):
+                os.makedirs(block_in)
+            for j in range(X.shape[1]):
+                np.save(os.path.join(block_in, 'field_%d.npy' % j), np.ascontiguousarray(X[:, j]))
+            np.save(block_out + '.npy', y)
+        else:
+            pd.DataFrame(X).to_hdf(block_in, key='fixed')
+            pd.DataFrame(y).to_hdf(block_out, key='fixed')
+
+    def to_column_format(self, cache=None):
+        """
+        export all hdf blocks into column_data_dir. set block_format='column' afterwards to iterate on them
+        :param cache: ArtifactCache, if set the export is a cached stage and column_data_dir points to it
+        :return:
+        """
+        if cache is not None:
+            def export(out_dir):
+                self.column_data_dir = out_dir
+                self.to_column_format()
+
+            self.column_data_dir = cache.stage('column', export, inputs=[self.hdf_data_dir])
+            return
+        print('Transferring hdf data into column data...')
+        if not os.path.exists(self.column_data_dir):
+            os.makedirs(self.column_data_dir)
+        done = set()
+        for gen_type in ['train', 'valid', 'test']:
+            for hdf_in, hdf_out in self._files_iter_(gen_type=gen_type):
+                if hdf_in in done:
+                    continue
+                done.add(hdf_in)
+                X, y = self._read_block_(hdf_in, hdf_out, block_format='hdf')
+                self._write_block_(X, y, self._block_path_(hdf_in, 'column'), self._block_path_(hdf_out, 'column'),
+                                   block_format='column')
+                print('block:', os.path.basename(hdf_in), X.shape, y.shape)
+
+    def _split_fields_(self, X, fields=None):
+        """
+        split a batch into independently indexed fields
+        :param fields: column indices the batch was read with, see field_index()
+        :return:
+        """
+        if fields is None:
+            fields = range(self.max_length)
+        X = np.split(X, len(fields), axis=1)
+        for i, j in enumerate(fields):
+            X[i] -= self.feat_min[j]
+        return X
+
+    def _block_dir_(self):
+        return self.column_data_dir if self.block_format == 'column' else self.hdf_data_dir
+
+    def feature_count(self, gen_type='train', cache=None):
+        """
+        count the occurrences of every id over the blocks of gen_type. the counts are a cached stage keyed on the
+            blocks they were counted on, so rewritten blocks are counted again and the block directory is left as is
+        :param gen_type: 
+        :param cache: ArtifactCache of the counts, default is <block directory>-derived beside the blocks
+        :return: counts, shape (num_features,), under the current id_remap if any
+        """
+        num_features = self.num_features if self.id_remap is None else self.id_remap.shape[0]
+        block_dir = os.path.normpath(self._block_dir_())
+        if cache is None:
+            cache = ArtifactCache(block_dir + '-derived')
+
+        def count(out_dir):
+            print('Counting', gen_type, 'features...')
+            counts = np.zeros(num_features, dtype=np.int64)
+            for hdf_in, hdf_out in self._files_iter_(gen_type=gen_type):
+                X, _ = self._read_block_(self._block_path_(hdf_in), self._block_path_(hdf_out))
+                counts += np.bincount(X.reshape(-1), minlength=num_features)
+            np.save(os.path.join(out_dir, 'feat_count.npy'), counts)
+
+        count_dir = cache.stage('feat_count_' + gen_type, count, params={'block_format': self.block_format},
+                                inputs=[block_dir])
+        counts = np.load(os.path.join(count_dir, 'feat_count.npy'))
+        if self.id_remap is not None:
+            counts = np.bincount(self.id_remap, weights=counts, minlength=self.num_features).astype(np.int64)
+        return counts
+
+    def threshold_remap(self, counts, threshold=None, top_k=None, fields=None):
+        """
+        re-index features under a new min-count cutoff or per-field budget. kept ids of a field stay in order,
+            pruned ids of a field share one new id at the end of the field
+        :param counts: id frequencies, see feature_count()
+        :param threshold: keep ids appearing at least threshold times
+        :param top_k: keep the top_k most frequent ids of every field, an int or a list with one budget per field
+        :param fields: field names or column indices to re-threshold, None for all fields
+        :return: remap of shape (num_features,) giving the new id of every old id, new feat_sizes
+        """
+        fields = self.field_index(fields)
+        remap = np.zeros(self.num_features, dtype=np.int32)
+        feat_sizes = []
+        offset = 0
+        for i in range(len(self.feat_sizes)):
+            start, size = self.feat_min[i], self.feat_sizes[i]
+            c = counts[start: start + size]
+            keep = np.ones(size, dtype=bool)
+            if fields is None or i in fields:
+                keep = self._frequent_(c, i, threshold, top_k)
+            new_index = np.cumsum(keep) - 1
+            num_kept = int(keep.sum())
+            if num_kept < size:
+                new_index[~keep] = num_kept
+                num_kept += 1
+            remap[start: start + size] = offset + new_index
+            feat_sizes.append(num_kept)
+            offset += num_kept
+        return remap, feat_sizes
+
+    @staticmethod
+    def _frequent_(c, i, threshold=None, top_k=None):
+        """
+        :param c: id frequencies of field i
+        :return: mask of the ids passing the cutoff and the per-field budget, see threshold_remap()
+        """
+        keep = np.ones(c.shape[0], dtype=bool)
+        if threshold is not None:
+            keep &= c >= threshold
+        if top_k is not None:
+            k = top_k[i] if isinstance(top_k, (list, tuple)) else top_k
+            top = np.zeros(c.shape[0], dtype=bool)
+            top[np.argsort(-c, kind='mergesort')[:k]] = True
+            keep &= top
+        return keep
+
+    def hot_cold_remap(self, counts, hot_threshold=None, hot_k=None, cold_buckets=None, cold_ratio=0.01,
+                       fields=None):
+        """
+        re-index features into hot ids with dedicated rows and cold ids hashed into a few shared rows. every field
+            holds its hot ids first, most frequent first, so that the rows absorbing most lookups are packed
+            together, followed by the hash buckets of its cold ids
+        :param counts: id frequencies, see feature_count()
+        :param hot_threshold: ids appearing at least hot_threshold times are hot
+        :param hot_k: the hot_k most frequent ids of every field are hot, an int or a list with one budget per field
+        :param cold_buckets: number of hash buckets of the cold ids of every field, an int or a list
+        :param cold_ratio: if cold_buckets is None, a field gets ceil(cold_ratio * its cold ids) buckets
+        :param fields: field names or column indices to split, the other fields keep all ids
+        :return: remap of shape (num_features,) giving the new id of every old id, new feat_sizes
+        """
+        fields = self.field_index(fields)
+        remap = np.zeros(self.num_features, dtype=np.int32)
+        feat_sizes = []
+        offset = 0
+        for i in range(len(self.feat_sizes)):
+            start, size = self.feat_min[i], self.feat_sizes[i]
+            c = counts[start: start + size]
+            hot = np.ones(size, dtype=bool)
+            if fields is None or i in fields:
+                hot = self._frequent_(c, i, hot_threshold, hot_k)
+            # stable sort, ties keep the old order
+            order = np.argsort(-c, kind='mergesort')
+            order = order[hot[order]]
+            new_index = np.zeros(size, dtype=np.int64)
+            new_index[order] = np.arange(order.shape[0])
+            num_hot, num_cold = order.shape[0], size - order.shape[0]
+            num_buckets = 0
+            if num_cold:
+                if cold_buckets is not None:
+                    num_buckets = cold_buckets[i] if isinstance(cold_buckets, (list, tuple)) else cold_buckets
+                else:
+                    num_buckets = int(np.ceil(cold_ratio * num_cold))
+                num_buckets = max(min(num_buckets, num_cold), 1)
+                # multiplicative hash of the index within the field, fixed so that remaps are reproducible
+                cold = np.where(~hot)[0].astype(np.uint64)
+                new_index[~hot] = num_hot + (cold * np.uint64(2654435761) % np.uint64(2 ** 32)) % num_buckets
+            remap[start: start + size] = offset + new_index
+            feat_sizes.append(num_hot + num_buckets)
+            offset += num_hot + num_buckets
+        return remap, feat_sizes
+
+    def apply_remap(self, remap, feat_sizes, lazy=True, out_dir=None, cache=None):
+        """
+        switch the data set to a new index, and update feat_sizes, feat_min and num_features accordingly
+        :param remap: old id -> new id, see threshold_remap() and hot_cold_remap()
+        :param feat_sizes: new feat_sizes
+        :param lazy: if True, remap every batch in the iterator, else rewrite all blocks into out_dir and iterate
+            on the rewritten blocks
+        :param out_dir: directory of the rewritten blocks, in the current block_format
+        :param cache: ArtifactCache, if set the rewritten blocks are a cached stage and out_dir is ignored
+        :return:
+        """
+        if self.id_remap is not None:
+            remap = np.take(remap, self.id_remap)
+        if lazy:
+            self.id_remap = remap
+        else:
+            self.id_remap = None
+            if cache is not None:
+                out_dir = cache.stage('remap', lambda out_dir: self._rewrite_blocks_(remap, out_dir),
+                                      params={'remap': hashlib.sha1(remap.tobytes()).hexdigest(),
+                                              'block_format': self.block_format},
+                                      inputs=[self._block_dir_()])
+            else:
+                self._rewrite_blocks_(remap, out_dir)
+            if self.block_format == 'column':
+                self.column_data_dir = out_dir
+            else:
+                self.hdf_data_dir = out_dir
+        self.feat_sizes = list(feat_sizes)
+        self.feat_min = [sum(self.feat_sizes[:i]) for i in range(len(self.feat_sizes))]
+        self.num_features = sum(self.feat_sizes)
+        print('re-indexed: num_features = %d' % self.num_features)
+
+    def _rewrite_blocks_(self, remap, out_dir):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        print('Rewriting blocks into', out_dir)
+        done = set()
+        for gen_type in ['train', 'valid', 'test']:
+            for hdf_in, hdf_out in self._files_iter_(gen_type=gen_type):
+                if hdf_in in done:
+                    continue
+                done.add(hdf_in)
+                block_in, block_out = self._block_path_(hdf_in), self._block_path_(hdf_out)
+                X, y = self._read_block_(block_in, block_out)
+                X = np.take(remap, X)
+                self._write_block_(X, y, os.path.join(out_dir, os.path.basename(block_in)),
+                                   os.path.join(out_dir, os.path.basename(block_out)))
+                print('block:', os.path.basename(block_in), X.shape)
+
+    def rethreshold(self, threshold=None, top_k=None, fields=None, lazy=True, out_dir=None, cache=None):
+        """
+        shrink the feature space under a new min-count cutoff or per-field top-k budget without reprocessing
+            raw logs, see threshold_remap() and apply_remap()
+        """
+        remap, feat_sizes = self.threshold_remap(self.feature_count('train', cache=cache), threshold=threshold,
+                                                 top_k=top_k, fields=fields)
+        self.apply_remap(remap, feat_sizes, lazy=lazy, out_dir=out_dir, cache=cache)
+
+    def hot_cold_split(self, hot_threshold=None, hot_k=None, cold_buckets=None, cold_ratio=0.01, fields=None,
+                       lazy=True, out_dir=None, cache=None):
+        """
+        give frequent ids dedicated rows and hash the others into shared rows, see hot_cold_remap() and
+            apply_remap()
+        """
+        remap, feat_sizes = self.hot_cold_remap(self.feature_count('train', cache=cache),
+                                                hot_threshold=hot_threshold, hot_k=hot_k, cold_buckets=cold_buckets,
+                                                cold_ratio=cold_ratio, fields=fields)
+        self.apply_remap(remap, feat_sizes, lazy=lazy, out_dir=out_dir, cache=cache)
+
+    def screen_interactions(self, order=2, top_k=None, block_fraction=0.05, block_seed=0, candidates=None):
+        """
+        pre-screen the field combinations before the search: score every pair or triple on a stratified sample of
+            the training blocks, see screening.interaction_scores(), and keep the top_k as candidate comb mask
+        :param order: 2 for comb_mask, 3 for comb_mask_third
+        :param top_k: number of candidates to keep, None keeps all the scored ones
+        :param block_fraction: sample of the training set to count on, see __iter__()
+        :param block_seed:
+        :param candidates: comb mask restricting the scored combinations
+        :return: scores and comb mask over combinations(range(num_fields), order)
+        """
+        X, y = [], []
+        for batch_data in self.__iter__(gen_type='train', batch_size=100000, block_fraction=block_fraction,
+                                        block_seed=block_seed):
+            X.append(batch_data[0])
+            y.append(batch_data[1])
+        X, y = np.vstack(X), np.concatenate(y)
+        scores = interaction_scores(X, y, order=order, candidates=candidates)
+        if top_k is None:
+            top_k = int(np.isfinite(scores).sum())
+        return scores, top_mask(scores, top_k)
+
+    def _files_iter_(self, gen_type='train', shuffle_block=False, block_fraction=None, block_seed=0):
         """
         iterate among hdf files(blocks). when the whole data set is finished, the iterator restarts 
             from the beginning, thus the data stream will never stop
         :param gen_type: could be 'train', 'valid', or 'test'. when gen_type='train' or 'valid', 
             this file iterator will go through the train set
         :param shuffle_block: shuffle block files at every round
+        :param block_fraction: only iterate ceil(block_fraction * num_of_parts) blocks, one drawn from each of as
+            many equal strata of the block sequence, so that the subsample spans the whole collection period
+        :param block_seed: seed of the blocks drawn within the strata
         :return: input_hdf_file_name, output_hdf_file_name, finish_flag
         """
         gen_type = gen_type.lower()
@@ -168,11 +510,35 @@ class Dataset:
         elif gen_type == 'test':
             hdf_files = [os.path.join(self.hdf_data_dir, 'test_<>_part_%d.h5' % i)
                          for i in range(self.test_num_of_parts)]
+        if block_fraction is not None and block_fraction < 1:
+            hdf_files = [hdf_files[i] for i in self.stratified_blocks(len(hdf_files), block_fraction, block_seed)]
         if shuffle_block:
             np.random.shuffle(hdf_files)
         for f in hdf_files:
             yield f.replace('<>', 'input'), f.replace('<>', 'output')
 
+    @staticmethod
+    def stratified_blocks(num_of_parts, block_fraction, block_seed=0):
+        """
+        :return: sorted indices of ceil(block_fraction * num_of_parts) blocks, one drawn from each stratum
+        """
+        num = min(max(int(np.ceil(block_fraction * num_of_parts)), 1), num_of_parts)
+        bounds = np.linspace(0, num_of_parts, num + 1).astype(int)
+        rng = np.random.RandomState(block_seed)
+        return [int(rng.randint(bounds[i], bounds[i + 1])) for i in range(num)]
+
+    @staticmethod
+    def stratified_rows(y, row_fraction, rng):
+        """
+        :return: sorted indices of row_fraction of the positive and of the negative rows of y
+        """
+        y = y.reshape(-1)
+        index = []
+        for label in [0, 1]:
+            rows = np.where(y == label)[0]
+            index.append(rng.choice(rows, int(round(row_fraction * rows.shape[0])), replace=False))
+        return np.sort(np.concatenate(index))
+
     def load_data(self, gen_type='train', num_workers=1, task_index=0):
         gen_type = gen_type.lower()
 
@@ -189,15 +555,14 @@ class Dataset:
         y_all = []
         for hdf_in, hdf_out in self._files_iter_(gen_type, False):
             print(hdf_in.split('/')[-1], '/', num_of_parts, 'loaded')
-            with pd.HDFStore(hdf_in, mode='r') as hdf_in, pd.HDFStore(hdf_out, mode='r') as hdf_out:
-                num_lines = hdf_out.get_storer('fixed').shape[0]
-                one_piece = int(np.ceil(num_lines / num_workers))
-                start = one_piece * task_index
-                stop = one_piece * (task_index + 1)
-                X_block = pd.read_hdf(hdf_in, mode='r', start=start, stop=stop).values
-                y_block = pd.read_hdf(hdf_out, mode='r', start=start, stop=stop).values
-                X_all.append(X_block)
-                y_all.append(y_block)
+            block_in, block_out = self._block_path_(hdf_in), self._block_path_(hdf_out)
+            num_lines = self._block_lines_(block_out)
+            one_piece = int(np.ceil(num_lines / num_workers))
+            start = one_piece * task_index
+            stop = one_piece * (task_index + 1)
+            X_block, y_block = self._read_block_(block_in, block_out, start=start, stop=stop)
+            X_all.append(X_block)
+            y_all.append(y_block)
         X_all = np.vstack(X_all)
         y_all = np.vstack(y_all)
 
@@ -215,7 +580,8 @@ class Dataset:
 
     def __iter__(self, gen_type='train', batch_size=None, pos_ratio=None, val_ratio=0.0, shuffle_block=False,
                  random_sample=False, split_fields=False, on_disk=True, squeeze_output=True, num_workers=1,
-                 task_index=0):
+                 task_index=0, fields=None, neg_sample_rate=None, neg_sample_seed=None, block_fraction=None,
+                 block_seed=0):
         """
         :param gen_type: 'train', 'valid', or 'test'.  the valid set is partitioned from train set dynamically
         :param batch_size: 
@@ -225,31 +591,52 @@ class Dataset:
         :param shuffle_block: shuffle file blocks at every round
         :param split_fields: if True, returned values will be independently indexed, else using unified index
         :param on_disk: if true iterate on disk, random_sample in block, if false iterate in mem, random_sample on all data
+        :param fields: field names or column indices to read, None reads all fields. with block_format='column'
+            the other fields are not read from disk at all
+        :param neg_sample_rate: if set, keep each negative sample with this probability and yield (X, y, weights),
+            where weights = 1 / neg_sample_rate for negatives and 1 for positives keep the loss calibrated.
+            negatives are drawn again at every round
+        :param neg_sample_seed: seed of the first round of negative sampling, None uses the global random state
+        :param block_fraction: iterate on a stratified subsample of about block_fraction of the rows (on disk only):
+            blocks spread over the data set, see _files_iter_(), and when that is less than one block, a fraction
+            of the positive and negative rows of the block, see stratified_rows()
+        :param block_seed:
         :return: 
         """
         gen_type = gen_type.lower()
+        fields = self.field_index(fields)
+        if pos_ratio and neg_sample_rate:
+            raise Exception('pos_ratio and neg_sample_rate can not be used together.')
+        rng = np.random.RandomState(neg_sample_seed) if neg_sample_seed is not None else np.random
 
         def _iter_():
             if on_disk:
                 print('on disk...')
-                for hdf_in, hdf_out in self._files_iter_(gen_type=gen_type, shuffle_block=shuffle_block):
-                    with pd.HDFStore(hdf_in, mode='r') as hdf_in, pd.HDFStore(hdf_out, mode='r') as hdf_out:
-                        num_lines = hdf_in.get_storer('fixed').shape[0]
-                        if gen_type == 'train':
-                            start = int(num_lines * val_ratio)
-                            stop = num_lines
-                        elif gen_type == 'valid':
-                            start = 0
-                            stop = int(num_lines * val_ratio)
-                        else:
-                            start = 0
-                            stop = num_lines
-                        one_piece = int(np.ceil((stop - start)/ num_workers))
-                        start = start + one_piece * task_index
-                        stop = start + one_piece * (task_index + 1)
-                        X_all = pd.read_hdf(hdf_in, mode='r', start=start, stop=stop).values
-                        y_all = pd.read_hdf(hdf_out, mode='r', start=start, stop=stop).values
-                        yield X_all, y_all, hdf_in
+                num_of_parts = self.test_num_of_parts if gen_type == 'test' else self.train_num_of_parts
+                row_fraction = None
+                if block_fraction is not None and block_fraction * num_of_parts < 1:
+                    row_fraction = block_fraction * num_of_parts
+                for hdf_in, hdf_out in self._files_iter_(gen_type=gen_type, shuffle_block=shuffle_block,
+                                                         block_fraction=block_fraction, block_seed=block_seed):
+                    block_in, block_out = self._block_path_(hdf_in), self._block_path_(hdf_out)
+                    num_lines = self._block_lines_(block_out)
+                    if gen_type == 'train':
+                        start = int(num_lines * val_ratio)
+                        stop = num_lines
+                    elif gen_type == 'valid':
+                        start = 0
+                        stop = int(num_lines * val_ratio)
+                    else:
+                        start = 0
+                        stop = num_lines
+                    one_piece = int(np.ceil((stop - start)/ num_workers))
+                    start = start + one_piece * task_index
+                    stop = start + one_piece * (task_index + 1)
+                    X_all, y_all = self._read_block_(block_in, block_out, start=start, stop=stop, fields=fields)
+                    if row_fraction is not None:
+                        index = self.stratified_rows(y_all, row_fraction, np.random.RandomState(block_seed))
+                        X_all, y_all = X_all[index], y_all[index]
+                    yield X_all, y_all, block_in
             else:
                 print('in mem...')
                 self.load_data(gen_type=gen_type, num_workers=num_workers, task_index=task_index)
@@ -264,6 +651,8 @@ class Dataset:
                 elif gen_type == 'test':
                     X_all = self.X_test
                     y_all = self.y_test
+                if fields is not None:
+                    X_all = X_all[:, fields]
                 yield X_all, y_all, 'all'
 
         for X_all, y_all, block in _iter_():
@@ -287,10 +676,10 @@ class Dataset:
                         neg_X, neg_y = neg_gen.next()
                         X = np.append(pos_X, neg_X, axis=0)
                         y = np.append(pos_y, neg_y, axis=0)
+                        if self.id_remap is not None:
+                            X = np.take(self.id_remap, X)
                         if split_fields:
-                            X = np.split(X, self.max_length, axis=1)
-                            for i in range(self.max_length):
-                                X[i] -= self.feat_min[i]
+                            X = self._split_fields_(X, fields)
                         if squeeze_output:
                             y = y.squeeze()
                         yield X, y
@@ -298,28 +687,35 @@ class Dataset:
                         print('finish', block)
                         break
             else:
-                gen = self.generator(X_all, y_all, batch_size, shuffle=random_sample)
+                index = self._neg_sample_(y_all, neg_sample_rate, rng) if neg_sample_rate else None
+                gen = self.generator(X_all, y_all, batch_size, shuffle=random_sample, index=index)
                 for X, y in gen:
+                    if self.id_remap is not None:
+                        X = np.take(self.id_remap, X)
                     if split_fields:
-                        X = np.split(X, self.max_length, axis=1)
-                        for i in range(self.max_length):
-                            X[i] -= self.feat_min[i]
+                        X = self._split_fields_(X, fields)
+                    if neg_sample_rate:
+                        weights = np.where(y.reshape(-1) == 1, 1., 1. / neg_sample_rate)
                     if squeeze_output:
                         y = y.squeeze()
-                    yield X, y
+                    if neg_sample_rate:
+                        yield X, y, weights
+                    else:
+                        yield X, y
 
     @staticmethod
-    def generator(X, y, batch_size, shuffle=True):
+    def generator(X, y, batch_size, shuffle=True, index=None):
         """
         should be accessed only in private
         :param X: 
         :param y: 
         :param batch_size: 
         :param shuffle: 
+        :param index: rows to iterate on, None for all rows
         :return: 
         """
-        num_of_batches = int(np.ceil(X.shape[0] * 1.0 / batch_size))
-        sample_index = np.arange(X.shape[0])
+        sample_index = np.arange(X.shape[0]) if index is None else index
+        num_of_batches = int(np.ceil(sample_index.shape[0] * 1.0 / batch_size))
         if shuffle:
             np.random.shuffle(sample_index)
         assert X.shape[0] > 0
@@ -329,6 +725,18 @@ class Dataset:
             y_batch = y[batch_index]
             yield X_batch, y_batch
 
+    @staticmethod
+    def _neg_sample_(y, neg_sample_rate, rng=np.random):
+        """
+        should be accessed only in private
+        :param y: 
+        :param neg_sample_rate: probability to keep a negative sample
+        :param rng: 
+        :return: index of all positive samples and the kept negative samples
+        """
+        y = y.reshape(-1)
+        return np.where((y == 1) | (rng.random_sample(y.shape[0]) < neg_sample_rate))[0]
+
     @staticmethod
     def split_pos_neg(X, y):
         """
@@ -0,0 +1,180 @@
+from __future__ import division
+from __future__ import print_function
+
+from itertools import combinations
+import os
+
+import numpy as np
+
+from .Dataset import Dataset
+
+
+class Synthetic(Dataset):
+    """
+    generated CTR data with zipf distributed ids and labels drawn from a planted set of pairwise and
+        third-order interactions, used as a fixture for benchmarks and for checking that the search recovers
+        the planted structure, see planted_mask()
+    """
+    block_size = 200000
+    data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Synthetic')
+    hdf_data_dir = os.path.join(data_dir, 'hdf')
+    column_data_dir = os.path.join(data_dir, 'column')
+
+    def __init__(self, initialized=True, train_size=1000000, test_size=200000, num_fields=24, feat_sizes=None,
+                 max_cardinality=100000, zipf_a=1.2, pairs=None, triples=None, num_pairs=8, num_triples=4,
+                 embed_size=4, signal=2., pos_ratio=0.2, seed=0, block_format='hdf'):
+        """
+        :param initialized: write blocks if False, otherwise only rebuild the metadata
+        :param train_size, test_size: number of rows
+        :param num_fields:
+        :param feat_sizes: per-field cardinality, default is log-spaced from 4 to max_cardinality
+        :param zipf_a: exponent of the zipf distribution of ids within each field
+        :param pairs, triples: planted interactions as tuples of field indices, default is num_pairs/num_triples
+            combinations picked at random
+        :param embed_size: dimension of the hidden field embeddings producing the interaction terms
+        :param signal: standard deviation of the planted logits, larger is easier to learn
+        :param pos_ratio: target ratio of positive labels
+        :param seed: the same arguments and seed always produce the same data
+        :param block_format: 'hdf' or 'column', layout of the written blocks
+        """
+        self.initialized = initialized
+        self.block_format = block_format
+        self.seed = seed
+        self.zipf_a = zipf_a
+        self.embed_size = embed_size
+        self.signal = signal
+        self.pos_ratio = pos_ratio
+        self.num_fields = num_fields
+        self.max_length = num_fields
+        self.feat_names = ['f_%d' % i for i in range(num_fields)]
+        if feat_sizes is None:
+            feat_sizes = np.logspace(np.log10(4), np.log10(max_cardinality), num_fields).astype(int).tolist()
+        self.feat_sizes = feat_sizes
+        self.feat_min = [sum(self.feat_sizes[:i]) for i in range(num_fields)]
+        self.num_features = sum(self.feat_sizes)
+        self.train_num_of_parts = int(np.ceil(train_size / self.block_size))
+        self.test_num_of_parts = int(np.ceil(test_size / self.block_size))
+
+        rng = np.random.RandomState(seed)
+        if pairs is None:
+            all_pairs = list(combinations(range(num_fields), 2))
+            pairs = [all_pairs[i] for i in rng.choice(len(all_pairs), num_pairs, replace=False)]
+        if triples is None:
+            all_triples = list(combinations(range(num_fields), 3))
+            triples = [all_triples[i] for i in rng.choice(len(all_triples), num_triples, replace=False)]
+        self.pairs = sorted(tuple(sorted(p)) for p in pairs)
+        self.triples = sorted(tuple(sorted(t)) for t in triples)
+        # per field: a permutation so that hot ids are spread over the id range, the zipf cdf and
+        # the hidden embeddings of all ids
+        self.perms = [rng.permutation(s) for s in self.feat_sizes]
+        self.cdfs = []
+        for s in self.feat_sizes:
+            p = 1. / np.power(np.arange(1, s + 1), zipf_a)
+            self.cdfs.append(np.cumsum(p) / np.sum(p))
+        self.embeds = [rng.normal(size=(s, embed_size)) for s in self.feat_sizes]
+        self.bias = self._calibrate_(rng)
+
+        if not self.initialized:
+            print('Generating synthetic data set...')
+            print('max length = %d, # features = %d' % (self.max_length, self.num_features))
+            print('planted pairs:', self.pairs)
+            print('planted triples:', self.triples)
+            for file_prefix, size, num_of_parts in [('train', train_size, self.train_num_of_parts),
+                                                    ('test', test_size, self.test_num_of_parts)]:
+                self.generate(file_prefix, size, num_of_parts)
+
+        print('Got synthetic data set, getting metadata...')
+        self.train_size, self.train_pos_samples, self.train_neg_samples, self.train_pos_ratio = \
+            self._bin_count_('train')
+        self.test_size, self.test_pos_samples, self.test_neg_samples, self.test_pos_ratio = \
+            self._bin_count_('test')
+        print('Initialization finished!')
+
+    def sample(self, num, rng):
+        """
+        draw rows from the generating distribution
+        :param num: number of rows
+        :param rng: numpy RandomState
+        :return: X of unified indices, shape (num, num_fields), y of shape (num, 1)
+        """
+        X = self._sample_ids_(num, rng)
+        logits = self._logits_(X) + self.bias
+        y = (rng.random_sample(num) < 1. / (1. + np.exp(-logits))).astype(np.int32).reshape([-1, 1])
+        return X + np.array(self.feat_min, dtype=np.int32), y
+
+    def _sample_ids_(self, num, rng):
+        X = np.zeros((num, self.num_fields), dtype=np.int32)
+        for i in range(self.num_fields):
+            rank = np.searchsorted(self.cdfs[i], rng.random_sample(num))
+            X[:, i] = self.perms[i][np.minimum(rank, self.feat_sizes[i] - 1)]
+        return X
+
+    def _logits_(self, X):
+        """
+        :param X: field-wise indices, shape (num, num_fields)
+        :return: sum of the planted interaction terms, normalized to unit variance per term
+        """
+        logits = np.zeros(X.shape[0])
+        for comb in self.pairs + self.triples:
+            term = np.ones((X.shape[0], self.embed_size))
+            for i in comb:
+                term *= self.embeds[i][X[:, i]]
+            logits += term.sum(axis=1) / np.sqrt(self.embed_size)
+        return logits / np.sqrt(max(len(self.pairs) + len(self.triples), 1)) * self.signal
+
+    def _calibrate_(self, rng, num=100000):
+        """
+        find the bias giving pos_ratio positives by bisection over a calibration sample
+        :return: bias added to the logits
+        """
+        logits = self._logits_(self._sample_ids_(num, rng))
+        low, high = -20., 20.
+        for _ in range(50):
+            mid = (low + high) / 2
+            if np.mean(1. / (1. + np.exp(-(logits + mid)))) < self.pos_ratio:
+                low = mid
+            else:
+                high = mid
+        return (low + high) / 2
+
+    def generate(self, file_prefix, size, num_of_parts):
+        """
+        write num_of_parts blocks of block_size rows, block_format decides the layout
+        :param file_prefix: 'train' or 'test'
+        :param size: total number of rows
+        :param num_of_parts:
+        :return:
+        """
+        print('Generating', file_prefix, 'data...')
+        block_dir = self.column_data_dir if self.block_format == 'column' else self.hdf_data_dir
+        if not os.path.exists(block_dir):
+            os.makedirs(block_dir)
+        for idx in range(num_of_parts):
+            rng = np.random.RandomState([self.seed, 0 if file_prefix == 'train' else 1, idx])
+            num = min(self.block_size, size - idx * self.block_size)
+            X, y = self.sample(num, rng)
+            hdf_in = os.path.join(self.hdf_data_dir, '%s_input_part_%d.h5' % (file_prefix, idx))
+            hdf_out = os.path.join(self.hdf_data_dir, '%s_output_part_%d.h5' % (file_prefix, idx))
+            self._write_block_(X, y, self._block_path_(hdf_in), self._block_path_(hdf_out))
+            print('part:', idx, X.shape, y.shape, 'pos ratio:', y.mean())
+
+    def _bin_count_(self, gen_type):
+        if self.block_format != 'column':
+            num_of_parts = self.train_num_of_parts if gen_type == 'train' else self.test_num_of_parts
+            return self.bin_count(self.hdf_data_dir, gen_type, num_of_parts)
+        size = 0
+        num_of_pos = 0
+        for _, hdf_out in self._files_iter_(gen_type):
+            _y = np.load(self._block_path_(hdf_out) + '.npy', mmap_mode='r')
+            size += _y.shape[0]
+            num_of_pos += int(np.sum(_y == 1))
+        return size, num_of_pos, size - num_of_pos, 1.0 * num_of_pos / size
+
+    def planted_mask(self, order=2):
+        """
+        :param order: 2 or 3
+        :return: comb mask over generate_pairs(range(num_fields), order=order) marking the planted interactions,
+            to be compared with the structure found by the search
+        """
+        planted = set(self.pairs if order == 2 else self.triples)
+        return [1 if comb in planted else 0 for comb in combinations(range(self.num_fields), order)]
@@ -4,21 +4,31 @@ from .Avazu import Avazu
 # from .Huawei import Huawei
 from .Criteo_all import Criteo_all
 from .Criteo_Challenge import Criteo_Challenge
+from .Synthetic import Synthetic
 
 
-def as_dataset(data_name, initialized=True):
+def as_dataset(data_name, initialized=True, block_format='hdf', cache_dir=None):
     data_name = data_name.lower()
+    if cache_dir is not None and data_name not in ['criteo_9d', 'criteo_16d']:
+        # the other raw pipelines take no parameters to vary, their blocks are built once with initialized=False
+        raise Exception('cache_dir is only supported by criteo_9d and criteo_16d, not %s' % data_name)
     if data_name == 'criteo':
-        return Criteo(initialized=initialized)
+        dataset = Criteo(initialized=initialized)
     elif data_name == 'ipinyou':
-        return iPinYou(initialized=initialized)
+        dataset = iPinYou(initialized=initialized)
     elif data_name == 'avazu':
-        return Avazu(initialized=initialized)
+        dataset = Avazu(initialized=initialized)
     elif data_name == 'criteo_9d':
-        return Criteo_all(initialized=initialized, num_of_days=9)
+        dataset = Criteo_all(initialized=initialized, num_of_days=9, cache_dir=cache_dir)
     elif data_name == 'criteo_16d':
-        return Criteo_all(initialized=initialized, num_of_days=16)
+        dataset = Criteo_all(initialized=initialized, num_of_days=16, cache_dir=cache_dir)
     elif data_name == 'criteo_challenge':
-        return Criteo_Challenge(initialized=initialized)
+        dataset = Criteo_Challenge(initialized=initialized)
+    elif data_name == 'synthetic':
+        dataset = Synthetic(initialized=initialized, block_format=block_format)
     # elif data_name == 'huawei':
-    #     return Huawei(initialized=initialized)
+    #     dataset = Huawei(initialized=initialized)
+    else:
+        return None
+    dataset.block_format = block_format
+    return dataset
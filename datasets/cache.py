@@ -0,0 +1,95 @@
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+
+class ArtifactCache:
+    """
+    content-addressed store of preprocessing artifacts. every stage is keyed by a hash of its name, parameters and
+        inputs, and its outputs live in cache_dir/<name>-<key>. a stage whose key already exists is skipped, so
+        variants built with different parameters coexist and a parameter change only rebuilds the stages depending
+        on it
+    inputs:
+        a path inside cache_dir is an upstream stage, already identified by its key
+        any other path (file or directory) is identified by the names, sizes and modification times of its files
+    a stage directory is never written once built: anything derived from it is a stage of its own taking it as
+        input, e.g. Dataset.feature_count(), so that its key keeps identifying its contents
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def fingerprint(path):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            return [os.path.basename(path), stat.st_size, int(stat.st_mtime)]
+        res = []
+        for root, dirs, files in os.walk(path, followlinks=True):
+            dirs.sort()
+            for f in sorted(files):
+                stat = os.stat(os.path.join(root, f))
+                res.append([os.path.relpath(os.path.join(root, f), path), stat.st_size, int(stat.st_mtime)])
+        return res
+
+    def key(self, name, params=None, inputs=None):
+        """
+        :param name: stage name
+        :param params: json-serializable parameters of the stage
+        :param inputs: paths the stage reads
+        :return: hex digest identifying the stage outputs
+        """
+        desc = {'name': name, 'params': params, 'inputs': []}
+        for path in inputs or []:
+            path = os.path.abspath(path)
+            if os.path.dirname(path) == self.cache_dir:
+                desc['inputs'].append(os.path.basename(path))
+            else:
+                desc['inputs'].append(self.fingerprint(path))
+        return hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def stage(self, name, func, params=None, inputs=None):
+        """
+        build a stage unless it is up to date
+        :param name: stage name
+        :param func: func(out_dir) writes the artifacts of the stage into out_dir
+        :param params: see key()
+        :param inputs: see key()
+        :return: directory of the stage artifacts
+        """
+        out_dir = os.path.join(self.cache_dir, '%s-%s' % (name, self.key(name, params, inputs)))
+        manifest = os.path.join(out_dir, 'MANIFEST.json')
+        if os.path.exists(manifest):
+            print('stage', name, 'up to date:', out_dir)
+            return out_dir
+        print('building stage', name, 'into', out_dir)
+        # build into a temporary directory, so that an interrupted stage is never taken as finished
+        tmp_dir = out_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        tic = time.time()
+        func(tmp_dir)
+        with open(os.path.join(tmp_dir, 'MANIFEST.json'), 'w') as fout:
+            json.dump({'name': name, 'params': params, 'inputs': [os.path.abspath(p) for p in inputs or []],
+                       'build_time': time.time() - tic}, fout, sort_keys=True, indent=2)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.rename(tmp_dir, out_dir)
+        return out_dir
+
+
+def dump_meta(out_dir, meta):
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as fout:
+        json.dump(meta, fout)
+
+
+def load_meta(out_dir):
+    with open(os.path.join(out_dir, 'meta.json')) as fin:
+        return json.load(fin)
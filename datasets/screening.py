@@ -0,0 +1,93 @@
+from __future__ import division
+from __future__ import print_function
+
+from itertools import combinations
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def label_information(codes, y):
+    """
+    plug-in mutual information in nats between a categorical column and the binary label
+    :param codes: dense codes 0..K-1 of the column, see pd.factorize()
+    :param y: 0/1 labels
+    :return: I(codes; y), number of distinct codes
+    """
+    n = y.shape[0]
+    tot = np.bincount(codes)
+    pos = np.bincount(codes, weights=y)
+    neg = tot - pos
+    num_pos = pos.sum()
+
+    def xlogx(c):
+        c = c[c > 0]
+        return (c * np.log(c)).sum()
+
+    # I = H(X) + H(Y) - H(X, Y) in counts
+    mi = (xlogx(pos) + xlogx(neg) - xlogx(tot) - xlogx(np.array([num_pos, n - num_pos])) + n * np.log(n)) / n
+    return mi, tot.shape[0]
+
+
+def conditional_score(n, info, cells, sub_info, sub_cells):
+    """
+    G-test of the label being independent of the added column given a sub-combination: G = 2n I(y; added | sub)
+        is chi-square with (cells - sub_cells) degrees of freedom under independence. the score is G standardized
+        by the chi-square mean and deviation, so that crosses of many sparse ids are not favored as the raw
+        conditional mutual information would
+    :return: (G - df) / sqrt(2 df)
+    """
+    df = max(cells - sub_cells, 1)
+    return (2. * n * (info - sub_info) - df) / np.sqrt(2. * df)
+
+
+def interaction_scores(X, y, order=2, candidates=None):
+    """
+    score every combination of columns by how much it tells about the label beyond each of its
+        sub-combinations of one column less: the smallest conditional_score() over them, i.e. every column must
+        add information given the others
+    :param X: rows * fields ids
+    :param y: labels
+    :param order: 2 or 3
+    :param candidates: comb mask over combinations(range(fields), order) restricting the scored combinations, the
+        others score -inf
+    :return: scores over combinations(range(fields), order)
+    """
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    n, num_fields = X.shape
+    codes, cards = [], []
+    for i in range(num_fields):
+        c, uniques = pd.factorize(X[:, i])
+        codes.append(c.astype(np.int64))
+        cards.append(len(uniques))
+    info = {}
+    for i in range(num_fields):
+        info[(i,)] = label_information(codes[i], y)
+    scores = []
+    tic = time.time()
+    for lower in range(2, order + 1):
+        for m, comb in enumerate(combinations(range(num_fields), lower)):
+            if lower == order and candidates is not None and not candidates[m]:
+                scores.append(-np.inf)
+                continue
+            # factorize after every column, so the key stays below rows * cards[i] whatever the order
+            key = codes[comb[0]]
+            for i in comb[1:]:
+                key = pd.factorize(key * cards[i] + codes[i])[0]
+            info[comb] = label_information(key, y)
+            if lower == order:
+                scores.append(min(conditional_score(n, info[comb][0], info[comb][1], info[sub][0], info[sub][1])
+                                  for sub in combinations(comb, lower - 1)))
+    print('scored %d combinations of order %d on %d rows in %.1f s' % (len(scores), order, n, time.time() - tic))
+    return np.array(scores)
+
+
+def top_mask(scores, top_k):
+    """
+    :return: comb mask keeping the top_k scores, to restrict generate_pairs() and the search to them
+    """
+    mask = np.zeros(scores.shape[0], dtype=np.int32)
+    mask[np.argsort(-scores, kind='mergesort')[:top_k]] = 1
+    mask[~np.isfinite(scores)] = 0
+    return mask.tolist()
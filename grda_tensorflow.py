@@ -4,6 +4,7 @@ from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import state_ops
 from tensorflow.python.ops import random_ops
+from tensorflow.python.ops import resource_variable_ops
 from tensorflow.python.training import optimizer
 
 from absl import logging
@@ -12,6 +13,7 @@ import tensorflow as tf
 class GRDA(optimizer.Optimizer):
     """Optimizer that implements the GRDA algorithm.
     See (https://.......)
+    Sparse gradients, e.g. of gathered embedding tables, only update the touched rows, see _apply_sparse_shared().
     """
 
     def __init__(self, learning_rate=0.005, c = 0.005, mu=0.7, use_locking=False, name="GRDA"):
@@ -39,6 +41,10 @@ class GRDA(optimizer.Optimizer):
                 v_ini = random_ops.random_uniform(
                     shape=v.get_shape(), minval = -0.1, maxval = 0.1, dtype=v.dtype.base_dtype, seed = 123)*0
             self._get_or_make_slot(v, v_ini, "accumulator", self._name)
+            # 1 for rows already updated by the sparse path, see _apply_sparse_shared()
+            with ops.colocate_with(v):
+                touched_ini = array_ops.zeros(v.get_shape()[:1], dtype=v.dtype.base_dtype)
+            self._get_or_make_slot(v, touched_ini, "touched", self._name)
         first_var = min(var_list, key=lambda x: x.name)
         self._create_non_slot_variable(initial_value=0.,
                                        name="l1_accum",
@@ -83,9 +89,36 @@ class GRDA(optimizer.Optimizer):
     def _resource_apply_dense(self, grad, var):
         return self._apply_dense(grad,var)
 
+    def _apply_sparse_shared(self, grad, var, indices, scatter_update):
+        """Update only the rows in indices, duplicates are already summed.
+        The dual accumulator v of a skipped row does not move, and var = sign(v) * max(|v| - l1, 0) only depends
+        on v and the current l1, so the l1 accumulated while a row was skipped is applied when it is touched again.
+        A row touched for the first time adds its initial value to v, as the dense path does at the first iteration.
+        """
+        lr = math_ops.cast(self._learning_rate_tensor, var.dtype.base_dtype)
+        l1 = math_ops.cast(self._l1_accum, var.dtype.base_dtype)
+
+        v = self.get_slot(var, "accumulator")
+        touched = self.get_slot(var, "touched")
+        touched_rows = array_ops.gather(touched, indices)
+        first_touch = array_ops.reshape(1 - touched_rows, array_ops.concat(
+            [[-1], array_ops.ones([array_ops.rank(grad) - 1], dtype=tf.int32)], 0))
+        v_rows = array_ops.gather(v, indices) + first_touch * array_ops.gather(var, indices) - lr * grad
+        var_rows = math_ops.sign(v_rows) * math_ops.maximum(math_ops.abs(v_rows) - l1, 0)
+        with ops.control_dependencies([v_rows]):
+            v_t = scatter_update(v, indices, v_rows)
+            var_update = scatter_update(var, indices, var_rows)
+            touched_update = scatter_update(touched, indices, array_ops.ones_like(touched_rows))
+        return control_flow_ops.group(*[v_t, var_update, touched_update])
+
     def _apply_sparse(self, grad, var):
-        return
-        raise NotImplementedError("Sparse gradient updates are not supported yet.")
+        return self._apply_sparse_shared(
+            grad.values, var, grad.indices,
+            lambda x, i, u: state_ops.scatter_update(x, i, u, use_locking=self._use_locking))
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self._apply_sparse_shared(
+            grad, var, indices, lambda x, i, u: resource_variable_ops.resource_scatter_update(x.handle, i, u))
 
     def _finish(self, update_ops, name_scope):
         """
@@ -94,8 +127,10 @@ class GRDA(optimizer.Optimizer):
         iter_ = self._get_iter_variable()
         l1_accum = self._get_iter_variable('l1_accum')
 
-        update_iter = iter_.assign(iter_ + 1, use_locking=self._use_locking)
-        update_l1 = l1_accum.assign(self._l1_accum, use_locking = self._use_locking)
+        # the updates read iter and l1_accum, which must not move before they ran
+        with ops.control_dependencies(update_ops):
+            update_iter = iter_.assign(iter_ + 1, use_locking=self._use_locking)
+            update_l1 = l1_accum.assign(self._l1_accum, use_locking = self._use_locking)
         return tf.group(
             *update_ops + [update_iter,update_l1], name=name_scope)
 
@@ -0,0 +1,53 @@
+from tensorflow.python.framework import ops
+from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import resource_variable_ops
+from tensorflow.python.ops import state_ops
+from tensorflow.python.training import adam
+
+
+class LazyAdam(adam.AdamOptimizer):
+    """Adam that only updates the rows of a sparse gradient.
+    Dense Adam decays both moment tables of an embedding as a whole at every step, so a step costs
+    input_dim * k reads and writes whatever the batch touched. Here the moments and the variable are gathered at
+    the indices of the gradient, updated and scattered back, the other rows are left as they are. The moments of
+    a row are then only decayed at the steps that touch it, which is the same as dense Adam for rows touched at
+    every step. Dense gradients are applied as by Adam.
+    """
+
+    def __init__(self, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8, use_locking=False,
+                 name="LazyAdam"):
+        super(LazyAdam, self).__init__(learning_rate=learning_rate, beta1=beta1, beta2=beta2, epsilon=epsilon,
+                                       use_locking=use_locking, name=name)
+
+    def _apply_sparse_shared(self, grad, var, indices, scatter_update):
+        """Update only the rows in indices, duplicates are already summed."""
+        beta1_power, beta2_power = self._get_beta_accumulators()
+        beta1_power = math_ops.cast(beta1_power, var.dtype.base_dtype)
+        beta2_power = math_ops.cast(beta2_power, var.dtype.base_dtype)
+        lr_t = math_ops.cast(self._lr_t, var.dtype.base_dtype)
+        beta1_t = math_ops.cast(self._beta1_t, var.dtype.base_dtype)
+        beta2_t = math_ops.cast(self._beta2_t, var.dtype.base_dtype)
+        epsilon_t = math_ops.cast(self._epsilon_t, var.dtype.base_dtype)
+        lr = lr_t * math_ops.sqrt(1 - beta2_power) / (1 - beta1_power)
+        m = self.get_slot(var, "m")
+        v = self.get_slot(var, "v")
+        m_rows = beta1_t * array_ops.gather(m, indices) + (1 - beta1_t) * grad
+        v_rows = beta2_t * array_ops.gather(v, indices) + (1 - beta2_t) * math_ops.square(grad)
+        var_rows = array_ops.gather(var, indices) - lr * m_rows / (math_ops.sqrt(v_rows) + epsilon_t)
+        # the rows are read before any of them is written
+        with ops.control_dependencies([m_rows, v_rows, var_rows]):
+            m_t = scatter_update(m, indices, m_rows)
+            v_t = scatter_update(v, indices, v_rows)
+            var_update = scatter_update(var, indices, var_rows)
+        return control_flow_ops.group(*[var_update, m_t, v_t])
+
+    def _apply_sparse(self, grad, var):
+        return self._apply_sparse_shared(
+            grad.values, var, grad.indices,
+            lambda x, i, u: state_ops.scatter_update(x, i, u, use_locking=self._use_locking))
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self._apply_sparse_shared(
+            grad, var, indices, lambda x, i, u: resource_variable_ops.resource_scatter_update(x.handle, i, u))
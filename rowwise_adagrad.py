@@ -0,0 +1,93 @@
+from tensorflow.python.framework import ops
+from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import init_ops
+from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import resource_variable_ops
+from tensorflow.python.ops import state_ops
+from tensorflow.python.training import optimizer
+
+import tensorflow as tf
+
+class RowwiseAdagrad(optimizer.Optimizer):
+    """Adagrad with one accumulator per row instead of per element for the embedding tables.
+    The accumulator of a row adds the mean of the squared gradients of the row, so an embedding table of
+    input_dim * k keeps input_dim slot values instead of input_dim * k. The other variables, e.g. the kernels of
+    bin_mlp(), whose rows are input units rather than ids, get one accumulator per element, i.e. plain Adagrad,
+    and so do 1-D variables. Sparse gradients only update the touched rows.
+    """
+
+    def __init__(self, learning_rate=0.01, initial_accumulator_value=0.1, use_locking=False, name="RowwiseAdagrad",
+                 rowwise_collection="embeddings"):
+        """Construct a new row-wise Adagrad optimizer.
+        Args:
+            learning_rate: A Tensor or a floating point value. The learning rate.
+            initial_accumulator_value: A floating point value. Starting value for the accumulators, must be positive.
+            name: Optional name for the operations created when applying gradients.
+            Defaults to "RowwiseAdagrad".
+            rowwise_collection: graph collection of the variables with row-wise accumulators, the embedding tables.
+        """
+        if initial_accumulator_value <= 0.0:
+            raise ValueError("initial_accumulator_value must be positive: %s" % initial_accumulator_value)
+        super(RowwiseAdagrad, self).__init__(use_locking, name)
+        self._learning_rate = learning_rate
+        self._initial_accumulator_value = initial_accumulator_value
+        self._learning_rate_tensor = None
+        self._rowwise_collection = rowwise_collection
+
+    def _rowwise(self, var):
+        return var.op.name in set(v.op.name for v in tf.get_collection(self._rowwise_collection))
+
+    def _create_slots(self, var_list):
+        for v in var_list:
+            shape = v.get_shape()[:1] if self._rowwise(v) else v.get_shape()
+            with ops.colocate_with(v):
+                acc_ini = init_ops.constant_initializer(self._initial_accumulator_value, dtype=v.dtype.base_dtype)(
+                    shape)
+            self._get_or_make_slot(v, acc_ini, "accumulator", self._name)
+
+    def _prepare(self):
+        self._learning_rate_tensor = ops.convert_to_tensor(
+            self._learning_rate, name="learning_rate")
+
+    def _row_mean_square(self, grad, var):
+        if not self._rowwise(var):
+            return math_ops.square(grad)
+        return math_ops.reduce_mean(math_ops.square(grad), axis=math_ops.range(1, array_ops.rank(grad)))
+
+    def _expand_rows(self, acc, grad, var):
+        if not self._rowwise(var):
+            return acc
+        return array_ops.reshape(acc, array_ops.concat(
+            [[-1], array_ops.ones([array_ops.rank(grad) - 1], dtype=tf.int32)], 0))
+
+    def _apply_dense(self, grad, var):
+        lr = math_ops.cast(self._learning_rate_tensor, var.dtype.base_dtype)
+        acc = self.get_slot(var, "accumulator")
+        acc_t = state_ops.assign_add(acc, self._row_mean_square(grad, var), use_locking=self._use_locking)
+        var_update = state_ops.assign_sub(var, lr * grad / math_ops.sqrt(self._expand_rows(acc_t, grad, var)),
+                                          use_locking=self._use_locking)
+        return control_flow_ops.group(*[acc_t, var_update])
+
+    def _resource_apply_dense(self, grad, var):
+        return self._apply_dense(grad, var)
+
+    def _apply_sparse_shared(self, grad, var, indices, scatter_add):
+        """Update only the rows in indices, duplicates are already summed."""
+        lr = math_ops.cast(self._learning_rate_tensor, var.dtype.base_dtype)
+        acc = self.get_slot(var, "accumulator")
+        acc_rows = array_ops.gather(acc, indices) + self._row_mean_square(grad, var)
+        with ops.control_dependencies([acc_rows]):
+            acc_t = scatter_add(acc, indices, self._row_mean_square(grad, var))
+            var_update = scatter_add(var, indices,
+                                     -lr * grad / math_ops.sqrt(self._expand_rows(acc_rows, grad, var)))
+        return control_flow_ops.group(*[acc_t, var_update])
+
+    def _apply_sparse(self, grad, var):
+        return self._apply_sparse_shared(
+            grad.values, var, grad.indices,
+            lambda x, i, u: state_ops.scatter_add(x, i, u, use_locking=self._use_locking))
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self._apply_sparse_shared(
+            grad, var, indices, lambda x, i, u: resource_variable_ops.resource_scatter_add(x.handle, i, u))
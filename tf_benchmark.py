@@ -0,0 +1,251 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from tf_models import AutoDeepFM, AutoFM, generate_pairs
+from tf_trainer import Trainer
+from tf_utils import PAIR_KERNELS, embedding_lookup, enable_cpu_jit, get_optimizer, pair_product, time_fetches, \
+    triple_product
+
+
+def peak_memory(session, fetches, feed_dict=None):
+    """
+    :return: peak bytes allocated on any device during one session.run(fetches)
+    """
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    session.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.peak_bytes)
+    return peak
+
+
+def report(name, seconds, bytes_=None, base=None):
+    line = '%-24s time %8.2f ms' % (name, seconds * 1000)
+    if bytes_ is not None:
+        line += '  peak memory %8.1f MB' % (bytes_ / 2. ** 20)
+    if base is not None:
+        line += '  speedup %.2fx' % (base / seconds)
+    print(line)
+
+
+def bench_pairs(batch_size, num_inputs, factor, runs):
+    """
+    forward and backward of the second-order kernels, see tf_utils.pair_product()
+    """
+    print('pairs: batch %d, fields %d, k %d' % (batch_size, num_inputs, factor))
+    cols, rows = generate_pairs(range(num_inputs))
+    with tf.Graph().as_default():
+        xv = tf.Variable(np.random.normal(size=[batch_size, num_inputs, factor]).astype(np.float32))
+        outs = {}
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            base = None
+            for kernel in PAIR_KERNELS:
+                out = pair_product(xv, rows, cols, kernel=kernel)
+                grad = tf.gradients(tf.reduce_sum(out), xv)[0]
+                seconds = time_fetches(session, [out, grad], runs=runs)
+                base = base or seconds
+                report(kernel, seconds, peak_memory(session, [out, grad]), base)
+                outs[kernel] = session.run(out)
+            for kernel in PAIR_KERNELS[1:]:
+                print('max abs diff %s vs transpose: %e' % (kernel, np.abs(outs[kernel] - outs['transpose']).max()))
+
+
+def bench_triples(batch_size, num_inputs, factor, runs, budgets):
+    """
+    forward and backward of the third-order products, unchunked and under memory budgets in MB,
+        see tf_utils.triple_product()
+    """
+    print('triples: batch %d, fields %d, k %d' % (batch_size, num_inputs, factor))
+    first, second, third = generate_pairs(range(num_inputs), order=3)
+    with tf.Graph().as_default():
+        xps = tf.Variable(np.random.normal(size=[batch_size, num_inputs, factor]).astype(np.float32))
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            base = None
+            for budget in [None] + budgets:
+                out = triple_product(xps, first, second, third,
+                                     memory_budget=None if budget is None else int(budget * 2 ** 20))
+                grad = tf.gradients(tf.reduce_sum(out), xps)[0]
+                seconds = time_fetches(session, [out, grad], runs=runs)
+                base = base or seconds
+                report('full' if budget is None else '%d MB' % budget, seconds,
+                       peak_memory(session, [out, grad]), base)
+
+
+
+# fields and features of the data sets the embedding benchmarks mimic
+SIZES = {
+    'criteo': (39, 1178909),
+    'avazu': (24, 645195),
+}
+
+
+def sample_ids(batch_size, num_inputs, input_dim, zipf_a=1.2, seed=0):
+    """
+    :return: batch * fields ids, zipf distributed within equally sized fields like skewed CTR data
+    """
+    rng = np.random.RandomState(seed)
+    field_size = input_dim // num_inputs
+    return (rng.zipf(zipf_a, size=[batch_size, num_inputs]) - 1) % field_size + \
+        np.arange(num_inputs) * field_size
+
+
+def real_batch(data_name, batch_size):
+    """
+    :return: the first training batch of a data set prepared on disk, see datasets.as_dataset()
+    """
+    from datasets import as_dataset
+    dataset = as_dataset(data_name)
+    gen = dataset.batch_generator({'gen_type': 'train', 'random_sample': True, 'batch_size': batch_size,
+                                   'split_fields': False, 'on_disk': True, 'squeeze_output': True})
+    for batch_data in gen:
+        return batch_data[0], dataset.max_length, dataset.num_features
+
+
+def bench_embedding(data_name, batch_size, factor, runs, opt='adam', real=False):
+    """
+    lookup (forward only) and lookup, backward and optimizer update (step) of w, v and thiird_v. separate tables vs
+        one fused table, each with and without in-batch id deduplication, see tf_utils.embedding_lookup()
+    :param real: use a batch of the data set instead of zipf distributed ids
+    """
+    if real:
+        X, num_inputs, input_dim = real_batch(data_name, batch_size)
+    else:
+        num_inputs, input_dim = SIZES[data_name]
+        X = sample_ids(batch_size, num_inputs, input_dim)
+    print('%s embedding: batch %d, fields %d, features %d, k %d, %s, %d of %d ids distinct' %
+          (data_name, batch_size, num_inputs, input_dim, factor, opt, np.unique(X).shape[0], X.size))
+    for fused in [False, True]:
+        for unique in [False, True]:
+            name = ('fused' if fused else 'separate') + (' unique' if unique else '')
+            with tf.Graph().as_default():
+                inputs = tf.constant(X, dtype=tf.int32)
+                xw, xv, _, xps = embedding_lookup('xavier', input_dim, factor, inputs, third_order=True, fused=fused,
+                                                  unique=unique)
+                loss = tf.reduce_sum(tf.square(xw)) + tf.reduce_sum(tf.square(xv)) + tf.reduce_sum(tf.square(xps))
+                step = get_optimizer(opt)(learning_rate=1e-3).minimize(loss)
+                with tf.Session() as session:
+                    session.run(tf.global_variables_initializer())
+                    report(name + ' lookup', time_fetches(session, [xw, xv, xps], runs=runs))
+                    report(name + ' step', time_fetches(session, step, runs=runs))
+
+
+def bench_step(model_name, batch_size, num_inputs, input_dim, factor, runs, retrain_stage=0, trainer_args=None,
+               memory=False, **model_args):
+    """
+    search or retrain stage training steps of AutoFM / AutoDeepFM on random ids, run through Trainer._train()
+    :param trainer_args: further arguments of Trainer, the model gets a static batch size with static_batch
+    :param memory: also report the peak memory of a step
+    """
+    trainer_args = trainer_args or {}
+    if trainer_args.get('static_batch'):
+        model_args['batch_size'] = batch_size
+    model_args.setdefault('kernel_batch_size', batch_size)
+    print('%s step: batch %d, fields %d, features %d, k %d, retrain stage %d' %
+          (model_name, batch_size, num_inputs, input_dim, factor, retrain_stage))
+    with tf.Graph().as_default():
+        if model_name == 'autofm':
+            model = AutoFM(init='xavier', num_inputs=num_inputs, input_dim=input_dim, embed_size=factor,
+                           retrain_stage=retrain_stage, **model_args)
+        else:
+            model = AutoDeepFM(init='xavier', num_inputs=num_inputs, input_dim=input_dim, embed_size=factor,
+                               layer_sizes=[700] * 5 + [1], layer_acts=['relu'] * 5 + [None], layer_keeps=[1.] * 6,
+                               layer_l2=[0, 0], batch_norm=True, retrain_stage=retrain_stage, **model_args)
+        trainer = Trainer(model=model, batch_size=batch_size, retrain_stage=retrain_stage, **trainer_args)
+        X = np.random.randint(0, input_dim, size=[batch_size, num_inputs])
+        y = np.random.randint(0, 2, size=[batch_size])
+        for _ in range(2):
+            trainer._train(X, y)
+        tic = time.time()
+        for _ in range(runs):
+            trainer._train(X, y)
+        seconds = (time.time() - tic) / runs
+        print('graph ops: %d' % len(tf.get_default_graph().get_operations()))
+        bytes_ = None
+        if memory:
+            feed_dict = {model.inputs: X, model.labels: y, model.training: True, trainer.learning_rate: 1e-3,
+                         trainer.learning_rate2: 1e-3, trainer.grda_c: 0.005}
+            bytes_ = peak_memory(trainer.session, [model.optimizer1] if retrain_stage else
+                                 [model.optimizer1, model.optimizer2], feed_dict)
+        report(model_name, seconds, bytes_)
+        trainer.session.close()
+    return seconds
+
+def bench_compile(model_name, batch_size, num_inputs, input_dim, factor, runs, retrain_stage=0, **model_args):
+    """
+    steps per second of bench_step() with a dynamic or static batch size, tuned grappler rewrites and XLA
+        auto-clustering, see Trainer(jit, grappler, static_batch)
+    """
+    enable_cpu_jit()
+    base = None
+    for name, trainer_args in [('dynamic', {}),
+                               ('static', {'static_batch': 'pad'}),
+                               ('static grappler', {'static_batch': 'pad', 'grappler': True}),
+                               ('static jit', {'static_batch': 'pad', 'jit': True}),
+                               ('static grappler jit', {'static_batch': 'pad', 'grappler': True, 'jit': True})]:
+        print(name)
+        seconds = bench_step(model_name, batch_size, num_inputs, input_dim, factor, runs,
+                             retrain_stage=retrain_stage, trainer_args=trainer_args, **model_args)
+        base = base or seconds
+        print('%-24s %8.2f steps/s  speedup %.2fx' % (name, 1. / seconds, base / seconds))
+
+def bench_precision(model_name, batch_size, num_inputs, input_dim, factor, runs, retrain_stage=0, **model_args):
+    """
+    steps per second and peak memory of bench_step() with the interaction products and the MLP in float32,
+        bfloat16 and float16 (with loss scaling), see Model.compile()
+    """
+    base = None
+    for compute_dtype in [None, 'bfloat16', 'float16']:
+        print(compute_dtype or 'float32')
+        seconds = bench_step(model_name, batch_size, num_inputs, input_dim, factor, runs,
+                             retrain_stage=retrain_stage, memory=True, compute_dtype=compute_dtype, **model_args)
+        base = base or seconds
+        print('%-24s %8.2f steps/s  speedup %.2fx' % (compute_dtype or 'float32', 1. / seconds, base / seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro benchmarks of the interaction kernels')
+    parser.add_argument('bench', choices=['pairs', 'triples', 'embedding', 'autofm', 'autodeepfm'])
+    parser.add_argument('--precision', action='store_true',
+                        help='compare the autofm / autodeepfm steps in float32, bfloat16 and float16, '
+                             'see bench_precision()')
+    parser.add_argument('--compile', action='store_true',
+                        help='compare the autofm / autodeepfm steps with static batches, grappler and XLA, '
+                             'see bench_compile()')
+    parser.add_argument('--batch_size', type=int, default=2000)
+    parser.add_argument('--num_inputs', type=int, default=39, help='39 for criteo, 24 for avazu')
+    parser.add_argument('--factor', type=int, default=40)
+    parser.add_argument('--input_dim', type=int, default=1000000, help='number of features of the step benchmarks')
+    parser.add_argument('--retrain_stage', type=int, default=0)
+    parser.add_argument('--pair_kernel', default='transpose')
+    parser.add_argument('--data_name', default='criteo', choices=sorted(SIZES))
+    parser.add_argument('--opt', default='adam', help='optimizer of the embedding benchmark, see get_optimizer()')
+    parser.add_argument('--real', action='store_true', help='embedding benchmark on a batch of the data set')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budgets', type=float, nargs='+', default=[64, 256, 1024],
+                        help='memory budgets of the chunked third-order products in MB')
+    args = parser.parse_args()
+    if args.bench == 'pairs':
+        bench_pairs(args.batch_size, args.num_inputs, args.factor, args.runs)
+    elif args.bench == 'triples':
+        bench_triples(args.batch_size, args.num_inputs, args.factor, args.runs, args.budgets)
+    elif args.bench == 'embedding':
+        bench_embedding(args.data_name, args.batch_size, args.factor, args.runs, opt=args.opt, real=args.real)
+    elif args.precision:
+        bench_precision(args.bench, args.batch_size, args.num_inputs, args.input_dim, args.factor, args.runs,
+                        retrain_stage=args.retrain_stage, pair_kernel=args.pair_kernel)
+    elif args.compile:
+        bench_compile(args.bench, args.batch_size, args.num_inputs, args.input_dim, args.factor, args.runs,
+                      retrain_stage=args.retrain_stage, pair_kernel=args.pair_kernel)
+    else:
+        bench_step(args.bench, args.batch_size, args.num_inputs, args.input_dim, args.factor, args.runs,
+                   retrain_stage=args.retrain_stage, pair_kernel=args.pair_kernel)
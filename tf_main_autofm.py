@@ -6,7 +6,8 @@ import __init__
 sys.path.append(__init__.config['data_path']) # add your data path here
 from datasets import as_dataset
 from tf_trainer import Trainer
-from tf_models import AutoFM
+from tf_utils import enable_cpu_jit, mixed_dims
+from tf_models import AutoFM, export_structure, load_structure, export_groups, load_groups, load_tuples
 import tensorflow as tf
 import traceback
 import random
@@ -14,8 +15,20 @@ seeds = [0x0123, 0x4567, 0x3210, 0x7654, 0x89AB, 0xCDEF, 0xBA98, 0xFEDC,
              0x0123, 0x4567, 0x3210, 0x7654, 0x89AB, 0xCDEF, 0xBA98, 0xFEDC]
 data_name = 'avazu'
 dataset = as_dataset(data_name) # https://github.com/Atomu2014/Ads-RecSys-Datasets使用的这个
+fields = None  # a subset of dataset.feat_names to train on, e.g. without 'device_ip'; None for all fields
+min_count = None  # raise the min-count cutoff of the stored blocks, e.g. 100, without reprocessing raw logs
+if min_count:
+    dataset.rethreshold(threshold=min_count)
+hot_k = None  # keep rows for the hot_k most frequent ids of every field, hash the others into shared rows
+if hot_k:
+    dataset.hot_cold_split(hot_k=hot_k)
 backend = 'tf'
 batch_size = 2000
+static_batch = None  # 'drop' or 'pad' the short last batch of an epoch, the graphs are then built for batch_size rows
+jit = False  # XLA auto-clustering, see tf_benchmark.py --compile, on CPU it was slower than the default kernels
+grappler = False  # two rounds of tuned grappler rewrites
+if jit:
+    enable_cpu_jit()
 
 train_data_param = {
     'gen_type': 'train',
@@ -24,6 +37,9 @@ train_data_param = {
     'split_fields': False,
     'on_disk': True,
     'squeeze_output': True,
+    'fields': fields,
+    'neg_sample_rate': None,  # keep negatives with this probability at every epoch, losses are reweighted
+    'neg_sample_seed': None,
 }
 test_data_param = {
     'gen_type': 'test',
@@ -32,14 +48,17 @@ test_data_param = {
     'split_fields': False,
     'on_disk': True,
     'squeeze_output': True,
+    'fields': fields,
 }
 
 
 def run_one_model(model=None,learning_rate=1e-3,decay_rate=1.0,epsilon=1e-8,ep=5, grda_c=0.005,
-                  grda_mu=0.51, learning_rate2=1e-3, decay_rate2=1.0, retrain_stage=0):
+                  grda_mu=0.51, learning_rate2=1e-3, decay_rate2=1.0, retrain_stage=0, logdir=None,
+                  prune_every=None, group_c=None, target_pairs=None, target_triples=None, target_flops=None,
+                  stable_every=None, search_fractions=None, stable_start=0):
     n_ep = ep * 1
     train_param = {
-        'opt1': 'adam',
+        'opt1': 'adam',  # 'lazyadam' or 'rowwise_adagrad' only update the embedding rows of the batch
         'opt2': 'grda',
         'loss': 'weight',
         'pos_weight': 1.0,
@@ -59,11 +78,26 @@ def run_one_model(model=None,learning_rate=1e-3,decay_rate=1.0,epsilon=1e-8,ep=5
         'grda_mu': grda_mu,
         'test_every_epoch': int(ep / 5),
         'retrain_stage': retrain_stage,
+        'logdir': logdir,
+        'prune_every': prune_every,
+        'group_c': group_c,
+        'target_pairs': target_pairs,
+        'target_triples': target_triples,
+        'target_flops': target_flops,
+        'stable_every': stable_every,
+        'stable_start': stable_start,
+        'stable_window': 5,
+        'static_batch': static_batch,
+        'jit': jit,
+        'grappler': grappler,
     }
     train_gen = dataset.batch_generator(train_data_param)
     test_gen = dataset.batch_generator(test_data_param)
     trainer = Trainer(model=model, train_gen=train_gen, test_gen=test_gen, **train_param)
-    trainer.fit()
+    if search_fractions and not retrain_stage:
+        trainer.fit_progressive(search_fractions)
+    else:
+        trainer.fit()
     trainer.session.close()
 
 
@@ -75,6 +109,13 @@ if __name__=="__main__":
     learning_rate = 1e-3
     dc = 1.0
     split_epoch = 5
+    pair_kernel = 'transpose'  # 'transpose', 'gather', 'matmul', 'einsum' or 'auto' to benchmark them once
+    fused_embedding = False  # one table for w, v and thiird_v, a single gather and optimizer update per batch
+    unique_lookup = False  # gather each distinct id of a batch once
+    compute_dtype = None  # 'bfloat16' (or 'float16', loss scaled) interaction products, weights stay float32
+    mixed_dim_alpha = None  # e.g. 0.25, per-field dimensions of v shrinking with the field size, see mixed_dims()
+    field_dims = mixed_dims(dataset.feat_sizes, embedding_size, alpha=mixed_dim_alpha) if mixed_dim_alpha else None
+    field_columns = None  # embedding columns kept by every field, exported by a dim_prune search
 
     # second-order parameter
     weight_base = 0.6  # the initial value of alpha
@@ -84,23 +125,80 @@ if __name__=="__main__":
     third_prune = False  # whether condisder third-order feature interaction
     weight_base_third = 0.6
     comb_mask_third = None
+    third_memory_budget = None  # bytes for the third-order products, e.g. 2 ** 30 to search on all criteo fields
+    third_embedding = 'separate'  # 'shared' reuses v, 'projected' learns a k * third_embed_size map of v
+    third_embed_size = None
+
+    # higher-order parameter: search tuples of higher_order fields (e.g. 4) on a pool of higher_pool candidates,
+    # refreshed from the kept lower-order interactions as GRDA prunes them
+    higher_order = None
+    higher_pool = 1000
+    weight_base_higher = 0.6
+    higher_tuples = None
 
     # search_stage or retrain_stage; 0 represents search stage and 1 represents retrain stage
     retrain_stage = 0  # in retrain stage, optimize all parameters by adam Optimizer, you need to mask interactions by comb_mask and comb_mask_third
-
+    logdir = None  # checkpoints are saved here, the search stage exports the kept interactions into logdir/structure
+    structure_path = None  # exported structure to retrain on, overrides comb_mask and comb_mask_third
+    if retrain_stage and structure_path:
+        comb_mask, comb_mask_third = load_structure(structure_path)
+        higher_tuples = load_tuples(structure_path)
+        field_columns, searched_sizes = load_groups(structure_path)
+        if field_columns is not None:
+            field_dims = None
+
+    # search stage pre-screening: keep the screen_pairs / screen_triples best candidates by a conditional mutual
+    # information test on a sample of the training blocks, see Dataset.screen_interactions()
+    screen_pairs = None
+    screen_triples = None  # e.g. 300 of the 9139 triples of criteo
+    if not retrain_stage and screen_pairs:
+        comb_mask = dataset.screen_interactions(order=2, top_k=screen_pairs, candidates=comb_mask)[1]
+    if not retrain_stage and third_prune and screen_triples:
+        comb_mask_third = dataset.screen_interactions(order=3, top_k=screen_triples, candidates=comb_mask_third)[1]
     # grda parameter
     grda_c = 0.005
     grda_mu = 0.6
     learning_rate2 = 1.0 # learning rate for alpha in research stage
     dc2 = 0.6
+    prune_every = None  # check alpha every prune_every batches and stop computing the ones zero for 3 checks
+    # budgeted search: grda_c is adapted during the search so that the structure meets the budget, and the export
+    # keeps the target_pairs / target_triples largest alpha
+    target_pairs = None
+    target_triples = None
+    target_flops = None  # multiply-adds per example of the interactions and dense layers
+    stable_every = None  # stop the search once no alpha changed zero pattern over 5 checks every stable_every batches
+    stable_start = 0  # checks before this batch, or before anything is pruned, do not count as stable
+    search_fractions = None  # search on growing subsamples, e.g. [0.02, 0.05, 0.1, 0.2, 1.], until the kept set is stable
+    dim_prune = False  # search the embedding columns of every field by GRDA, exported as field_columns
+    group_c = 0.04  # l1 strength of the group gates, see Trainer
     model = AutoFM(init="xavier", num_inputs=dataset.max_length, input_dim=dataset.num_features, 
                     l2_v=l2_v, embed_size=embedding_size, comb_mask=comb_mask, weight_base=weight_base, 
                     third_prune=third_prune, weight_base_third=weight_base_third, 
-                    comb_mask_third=comb_mask_third, retrain_stage=retrain_stage)
+                    comb_mask_third=comb_mask_third, retrain_stage=retrain_stage, fields=dataset.field_index(fields),
+                    pair_kernel=pair_kernel, third_memory_budget=third_memory_budget,
+                    progressive_prune=prune_every is not None, fused_embedding=fused_embedding,
+                    unique_lookup=unique_lookup,
+                    third_embedding=third_embedding, third_embed_size=third_embed_size,
+                    field_dims=field_dims, feat_sizes=dataset.feat_sizes, dim_prune=dim_prune,
+                    higher_order=higher_order, higher_pool=higher_pool, weight_base_higher=weight_base_higher,
+                    higher_tuples=higher_tuples,
+                    batch_size=batch_size if static_batch else None,
+                    compute_dtype=compute_dtype, kernel_batch_size=batch_size,
+                    field_columns=field_columns)
 
     run_one_model(model=model, learning_rate=learning_rate, epsilon=1e-8,
                   decay_rate=dc, ep=split_epoch, grda_c=grda_c, grda_mu=grda_mu, 
-                  learning_rate2=learning_rate2,decay_rate2=dc2, retrain_stage=retrain_stage)
+                  learning_rate2=learning_rate2,decay_rate2=dc2, retrain_stage=retrain_stage, logdir=logdir,
+                  prune_every=prune_every, group_c=group_c if dim_prune else None,
+                  target_pairs=target_pairs, target_triples=target_triples, target_flops=target_flops,
+                  stable_every=stable_every, search_fractions=search_fractions, stable_start=stable_start)
+
+    if not retrain_stage and logdir is not None:
+        export_structure(logdir, os.path.join(logdir, 'structure'), dataset.max_length, comb_mask=comb_mask,
+                         comb_mask_third=comb_mask_third, fields=dataset.field_index(fields), top_k=target_pairs,
+                         top_k_third=target_triples, embed_size=embedding_size, dense_flops=model.dense_flops)
+        export_groups(logdir, os.path.join(logdir, 'structure'), dataset.max_length, embedding_size,
+                      fields=dataset.field_index(fields))
 
 
 
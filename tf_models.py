@@ -1,14 +1,15 @@
 from __future__ import print_function
 
-from abc import abstractmethod
 from itertools import combinations
+import os
 import numpy as np
 import tensorflow as tf
 
 import __init__
 from tf_utils import row_col_fetch, row_col_expand, batch_kernel_product, \
     batch_mlp, create_placeholder, drop_out, embedding_lookup, linear, output, bin_mlp, get_variable, \
-    layer_normalization, batch_normalization, get_l2_loss, split_data_mask
+    layer_normalization, batch_normalization, get_l2_loss, split_data_mask, create_weight_placeholder, weighted_mean, \
+    pair_product, select_pair_kernel, triple_product, scatter_columns, column_pair_product, kept_columns
 
 dtype = __init__.config['dtype']
 
@@ -22,53 +23,190 @@ class Model:
     outputs = None
     logits = None
     labels = None
+    sample_weights = None
     learning_rate = None
     loss = None
     l2_loss = None
     optimizer = None
     grad = None
+    training = None
+    l2_w = None
+    l2_v = None
+    l2_ps = None
+    layer_l2 = None
+    layer_kernels = None
+    third_prune = False
+    retrain_stage = 0
+    pair_kernel = 'transpose'
+    kernel_batch_size = 2000
+    third_memory_budget = None
+    progressive_prune = False
+    third_embedding = 'separate'
+    dim_prune = False
+    unit_prune = False
+    dense_flops = 0
+    field_columns = None
+    higher_order = None
+    compute_dtype = None
 
-    @abstractmethod
-    def compile(self, **kwargs):
-        pass
+    def compile(self, loss=None, optimizer1=None, optimizer2=None, global_step=None, pos_weight=1.0,
+                optimizer3=None, loss_scale=None):
+        """
+        in search stage the gradients are computed once for all variables: the architecture weights alpha and the
+            group gates go to optimizer2 (GRDA), the others to optimizer1. in retrain stage optimizer1 updates all variables
+        :param optimizer3: if set, updates the group gates instead of optimizer2, e.g. GRDA with a stronger l1
+        :param loss_scale: the gradients are computed on the loss times loss_scale and divided by it, so that small
+            float16 gradients do not underflow. None scales by 1024 with float16 compute_dtype, bfloat16 has the
+            range of float32 and needs none
+        """
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        with tf.control_dependencies(update_ops):
+            with tf.name_scope('loss'):
+                self.loss = weighted_mean(loss(logits=self.logits, targets=self.labels, pos_weight=pos_weight),
+                                          self.sample_weights)
+                _loss_ = self.loss
+                params, variables = [self.l2_w, self.l2_v], [self.xw, self.xv]
+                if self.third_prune and self.third_embedding != 'shared':
+                    params.append(self.l2_ps)
+                    variables.append(self.xps)
+                if self.layer_kernels is not None:
+                    params.append(self.layer_l2)
+                    variables.append(self.layer_kernels)
+                self.l2_loss = get_l2_loss(params, variables)
+                if self.l2_loss is not None:
+                    _loss_ += self.l2_loss
+                all_variable = [v for v in tf.trainable_variables()]
+                if loss_scale is None and self.compute_dtype == tf.float16:
+                    loss_scale = 1024.
+                if self.retrain_stage:
+                    self.optimizer1 = optimizer1.apply_gradients(
+                        scaled_gradients(optimizer1, _loss_, all_variable, loss_scale), global_step=global_step)
+                else:
+                    weight_var = list(set(tf.get_collection("edge_weights")))
+                    if self.third_prune:
+                        weight_var = list(set(weight_var + tf.get_collection("third_edge_weights")))
+                    if self.higher_order:
+                        weight_var = list(set(weight_var + tf.get_collection("higher_edge_weights")))
+                    group_var = list(set(tf.get_collection("group_weights")))
+                    if optimizer3 is None:
+                        weight_var = list(set(weight_var + group_var))
+                    grads_and_vars = scaled_gradients(optimizer1, _loss_, all_variable, loss_scale)
+                    self.optimizer1 = optimizer1.apply_gradients(
+                        [(g, v) for g, v in grads_and_vars
+                         if v not in weight_var and v not in group_var and g is not None],
+                        global_step=global_step)
+                    self.optimizer2 = optimizer2.apply_gradients(
+                        [(g, v) for g, v in grads_and_vars if v in weight_var])
+                    # its accumulators are reset when tuples of the higher-order pool are replaced
+                    self.structure_optimizer = optimizer2
+                    if optimizer3 is not None and group_var:
+                        self.optimizer2 = tf.group(self.optimizer2, optimizer3.apply_gradients(
+                            [(g, v) for g, v in grads_and_vars if v in group_var]))
 
-    def __str__(self):
-        return self.__class__.__name__
+    def _dim_gates_(self, xv, xps):
+        """
+        group gates of the embedding columns, one per field and dimension, searched by GRDA as the interaction
+            alphas. the gate of a field and dimension scales that column of v and thiird_v for the ids of the field,
+            so at 0 the column can be removed from the field, see export_groups()
+        :param xv, xps: field embeddings, batch * fields * k, xps may be None
+        :return: gated xv, xps
+        """
+        if not self.dim_prune or self.retrain_stage:
+            return xv, xps
+        with tf.variable_scope('group_weight', reuse=tf.AUTO_REUSE):
+            self.dim_weights = tf.get_variable('dim_weights', shape=xv.shape[1:], initializer=tf.ones_initializer())
+            tf.add_to_collection("group_weights", self.dim_weights)
+        xv = xv * self.dim_weights
+        if xps is not None:
+            xps = xps * self.dim_weights
+        return xv, xps
 
-def generate_pairs(ranges=range(1, 100), mask=None, order=2):
-    res = []
-    for i in range(order):
-        res.append([])
-    for i, pair in enumerate(list(combinations(ranges, order))):
-        if mask is None or mask[i]==1:
-            for j in range(order):
-                res[j].append(pair[j])
-    print("generated pairs", len(res[0]))
-    return res
+    def _unit_gates_(self, layer_sizes):
+        """
+        group gates of the hidden units of bin_mlp(), searched by GRDA, see export_groups()
+        :return: one gate vector per hidden layer, None for the output layer
+        """
+        if not self.unit_prune or self.retrain_stage:
+            return None
+        self.unit_weights = []
+        with tf.variable_scope('group_weight', reuse=tf.AUTO_REUSE):
+            for i, size in enumerate(layer_sizes[:-1]):
+                self.unit_weights.append(tf.get_variable('unit_weights_%d' % i, shape=[size],
+                                                         initializer=tf.ones_initializer()))
+                tf.add_to_collection("group_weights", self.unit_weights[-1])
+        return self.unit_weights + [None]
 
-class AutoFM(Model):
-    def __init__(self, init='xavier', num_inputs=None, input_dim=None, embed_size=None, l2_w=None, l2_v=None,
-                 norm=False, real_inputs=None, comb_mask=None, weight_base=0.6, third_prune=False, 
-                 comb_mask_third=None, weight_base_third=0.6, retrain_stage=0):
-        self.l2_w = l2_w
-        self.l2_v = l2_v
-        self.l2_ps = l2_v
-        self.third_prune = third_prune
-        self.retrain_stage = retrain_stage
+    def analyse_groups(self, sess):
+        """
+        :return: per field, the number of embedding columns whose gate is not 0, and per hidden layer the number
+            of units whose gate is not 0, None if not searched
+        """
+        field_dims, layer_sizes = None, None
+        if self.dim_prune and not self.retrain_stage:
+            field_dims = (sess.run(self.dim_weights) != 0).sum(axis=1).tolist()
+            print('kept embedding columns per field', field_dims)
+        if self.unit_prune and not self.retrain_stage:
+            layer_sizes = [int((w != 0).sum()) for w in sess.run(self.unit_weights)]
+            print('kept hidden units per layer', layer_sizes)
+        return field_dims, layer_sizes
 
-        self.inputs, self.labels, self.training = create_placeholder(num_inputs, tf, True)
+    def _compute_(self, x):
+        """
+        :return: x in compute_dtype, the dtype of the interaction products and the MLP. the variables, BN and the
+            loss stay in float32, the products are cast back before their BN
+        """
+        return x if self.compute_dtype is None else tf.cast(x, self.compute_dtype)
 
-        inputs, mask, flag, num_inputs = split_data_mask(self.inputs, num_inputs, norm=norm, real_inputs=real_inputs)
+    def _third_embedding_(self, init, xv, mode, third_embed_size=None):
+        """
+        third-order embeddings derived from the second-order ones instead of a separate thiird_v table, which
+            saves input_dim * k parameters and their optimizer slots
+        :param init:
+        :param xv: field embeddings, batch * fields * k
+        :param mode: 'shared' uses xv itself, 'projected' maps xv to third_embed_size dimensions (default k) with
+            a learned k * third_embed_size matrix
+        :param third_embed_size:
+        :return: batch * fields * third_embed_size
+        """
+        if mode == 'shared':
+            return xv
+        elif mode == 'projected':
+            factor = int(xv.shape[2])
+            projection = get_variable(init, name='third_projection', shape=[factor, third_embed_size or factor])
+            return tf.tensordot(xv, projection, axes=1)
+        raise ValueError('unknown third_embedding: %s' % mode)
 
-        self.xw, self.xv, b, self.xps = embedding_lookup(init=init, input_dim=input_dim, factor=embed_size, inputs=inputs,
-                                               apply_mask=flag, mask=mask, third_order=third_prune)
-
-        l = linear(self.xw)
-        self.cols, self.rows = generate_pairs(range(self.xv.shape[1]),mask=comb_mask)
-        t_embedding_matrix = tf.transpose(self.xv, perm=[1, 0, 2])
-        left = tf.transpose(tf.gather(t_embedding_matrix, self.rows), perm=[1, 0, 2])
-        right = tf.transpose(tf.gather(t_embedding_matrix, self.cols), perm=[1, 0, 2])
-        level_2_matrix = tf.reduce_sum(tf.multiply(left, right), axis=-1)
+    def _second_order_(self, xv, comb_mask, weight_base):
+        """
+        batch normalized inner products of the pairs kept by comb_mask, gated by the architecture weights alpha
+            (edge_weight/weights) in search stage. in retrain stage alpha is constant, so it is folded into the
+            BN scale and the mask multiply is dropped, see load_structure(). the products are computed by
+            pair_product() with self.pair_kernel, 'auto' picks the fastest kernel for batches of
+            self.kernel_batch_size rows. on the columns kept by a group search, see export_groups(), every pair
+            only multiplies the columns both fields kept, see column_pair_product()
+        :param xv: field embeddings, batch * fields * k, in compute_dtype, see _compute_()
+        :param comb_mask: mask over generate_pairs(range(fields)), None for all pairs
+        :param weight_base: initial value of alpha
+        :return: batch * pairs
+        """
+        self.cols, self.rows = generate_pairs(range(xv.shape[1]), mask=comb_mask)
+        pair_kernel = self.pair_kernel
+        if pair_kernel == 'auto':
+            pair_kernel = select_pair_kernel(self.kernel_batch_size, int(xv.shape[1]), int(xv.shape[2]),
+                                             self.rows, self.cols, compute_dtype=xv.dtype)
+        if self.progressive_prune and not self.retrain_stage:
+            live = self._live_index_('edge_weight', len(self.cols))
+            level_2_matrix = scatter_columns(pair_product(xv, tf.gather(self.rows, live), tf.gather(self.cols, live),
+                                                          kernel=pair_kernel), live, len(self.cols))
+        elif self.field_columns is not None:
+            level_2_matrix = column_pair_product(xv, self.rows, self.cols, self.field_columns)
+        else:
+            level_2_matrix = pair_product(xv, self.rows, self.cols, kernel=pair_kernel)
+        level_2_matrix = tf.cast(level_2_matrix, dtype)
+        if self.retrain_stage:
+            return tf.layers.batch_normalization(level_2_matrix, axis=-1, training=self.training,
+                                                 reuse=tf.AUTO_REUSE, scale=True, center=False, name='prune_BN',
+                                                 gamma_initializer=tf.constant_initializer(weight_base))
         with tf.variable_scope("edge_weight", reuse=tf.AUTO_REUSE):
             self.edge_weights = tf.get_variable('weights', shape=[len(self.cols)],
                                                 initializer=tf.random_uniform_initializer(
@@ -81,39 +219,233 @@ class AutoFM(Model):
             mask = tf.expand_dims(mask, axis=0)
         level_2_matrix = tf.layers.batch_normalization(level_2_matrix, axis=-1, training=self.training,
                                                     reuse=tf.AUTO_REUSE, scale=False, center=False, name='prune_BN')
-        level_2_matrix *= mask                                          
-        if third_prune:
-            self.first, self.second, self.third = generate_pairs(range(self.xps.shape[1]), mask=comb_mask_third, order=3)
-            t_embedding_matrix = tf.transpose(self.xps, perm=[1, 0, 2])
-            first_embed = tf.transpose(tf.gather(t_embedding_matrix, self.first), perm=[1, 0, 2])
-            second_embed = tf.transpose(tf.gather(t_embedding_matrix, self.second), perm=[1, 0, 2])
-            third_embed = tf.transpose(tf.gather(t_embedding_matrix, self.third), perm=[1, 0, 2])
-            level_3_matrix = tf.reduce_sum(tf.multiply(tf.multiply(first_embed, second_embed), third_embed), axis=-1)
-            with tf.variable_scope("third_edge_weight", reuse=tf.AUTO_REUSE):
-                self.third_edge_weights = tf.get_variable('third_weights', shape=[len(self.first)],
-                                                          initializer=tf.random_uniform_initializer(
-                                                              minval=weight_base_third - 0.001,
-                                                              maxval=weight_base_third + 0.001))
-                third_normed_wts = tf.identity(self.third_edge_weights, name="third_normed_wts")
-                tf.add_to_collection("third_structure", self.third_edge_weights)
-                tf.add_to_collection("third_edge_weights", self.third_edge_weights)
-                third_mask = tf.identity(third_normed_wts, name="third_unpruned_mask")
-                third_mask = tf.expand_dims(third_mask, axis=0)
-            level_3_matrix = tf.layers.batch_normalization(level_3_matrix, axis=-1, training=self.training,
-                                                           reuse=tf.AUTO_REUSE, scale=False, center=False,
-                                                           name="level_3_matrix_BN")
-            level_3_matrix *= third_mask
+        return level_2_matrix * mask
 
-        fm_out = tf.reduce_sum(level_2_matrix, axis=-1)
-        if third_prune:
-            fm_out2 = tf.reduce_sum(level_3_matrix, axis=-1)
-        if third_prune:
-            self.logits, self.outputs = output([l, fm_out,fm_out2, b, ])
+    def _third_order_(self, xps, comb_mask_third, weight_base_third):
+        """
+        same as _second_order_() for the triples kept by comb_mask_third, gated by third_edge_weight/third_weights.
+            self.third_memory_budget bounds the memory of the products, see triple_product()
+        :return: batch * triples
+        """
+        self.first, self.second, self.third = generate_pairs(range(xps.shape[1]), mask=comb_mask_third, order=3)
+        if self.progressive_prune and not self.retrain_stage:
+            live = self._live_index_('third_edge_weight', len(self.first))
+            level_3_matrix = triple_product(xps, tf.gather(self.first, live), tf.gather(self.second, live),
+                                            tf.gather(self.third, live), memory_budget=self.third_memory_budget)
+            level_3_matrix = scatter_columns(level_3_matrix, live, len(self.first))
+        else:
+            level_3_matrix = triple_product(xps, self.first, self.second, self.third,
+                                            memory_budget=self.third_memory_budget)
+        level_3_matrix = tf.cast(level_3_matrix, dtype)
+        if self.retrain_stage:
+            return tf.layers.batch_normalization(level_3_matrix, axis=-1, training=self.training,
+                                                 reuse=tf.AUTO_REUSE, scale=True, center=False,
+                                                 name="level_3_matrix_BN",
+                                                 gamma_initializer=tf.constant_initializer(weight_base_third))
+        with tf.variable_scope("third_edge_weight", reuse=tf.AUTO_REUSE):
+            self.third_edge_weights = tf.get_variable('third_weights', shape=[len(self.first)],
+                                                      initializer=tf.random_uniform_initializer(
+                                                          minval=weight_base_third - 0.001,
+                                                          maxval=weight_base_third + 0.001))
+            third_normed_wts = tf.identity(self.third_edge_weights, name="third_normed_wts")
+            tf.add_to_collection("third_structure", self.third_edge_weights)
+            tf.add_to_collection("third_edge_weights", self.third_edge_weights)
+            third_mask = tf.identity(third_normed_wts, name="third_unpruned_mask")
+            third_mask = tf.expand_dims(third_mask, axis=0)
+        level_3_matrix = tf.layers.batch_normalization(level_3_matrix, axis=-1, training=self.training,
+                                                       reuse=tf.AUTO_REUSE, scale=False, center=False,
+                                                       name="level_3_matrix_BN")
+        return level_3_matrix * third_mask
+
+    def _higher_order_(self, xv, order, pool_size, weight_base, tuples=None):
+        """
+        interactions of order >= 3 searched on a bounded pool of pool_size field tuples instead of all
+            C(fields, order) of them. the pool is a variable, refresh_pool() replaces the tuples GRDA drove to 0 by
+            new candidates, so memory and step cost do not depend on order. the products are batch normalized and
+            gated by higher_edge_weight/higher_weights in search stage, as _second_order_()
+        :param xv: field embeddings, batch * fields * k
+        :param order:
+        :param pool_size: number of tuples searched at a time
+        :param weight_base: initial value of alpha
+        :param tuples: tuples * order field indices kept by the search, required in retrain stage, see load_tuples()
+        :return: batch * tuples
+        """
+        num_inputs = int(xv.shape[1])
+        if self.retrain_stage:
+            if tuples is None:
+                raise ValueError('retrain stage of order %d needs the searched tuples, see load_tuples()' % order)
+            pool = tf.constant(np.array(tuples, dtype=np.int32).reshape([-1, order]))
+        else:
+            self.higher_rng = np.random.RandomState(0)
+            init = sample_tuples(num_inputs, order, min(pool_size, num_combinations(num_inputs, order)),
+                                 self.higher_rng)
+            self.higher_zero_checks = np.zeros(init.shape[0], dtype=np.int32)
+            self.higher_weight_base = weight_base
+            pool = self.higher_pool = tf.get_variable('higher_pool', initializer=init, trainable=False)
+            # checks every tuple has been in the pool for, tuples added by the last checks are not tested yet
+            self.higher_age = tf.get_variable('higher_age', initializer=np.zeros(init.shape[0], dtype=np.int32),
+                                              trainable=False)
+        # batch * tuples * k, one gather and multiply per member of the tuples
+        product = tf.gather(xv, pool[:, 0], axis=1)
+        for j in range(1, order):
+            product *= tf.gather(xv, pool[:, j], axis=1)
+        higher_matrix = tf.cast(tf.reduce_sum(product, axis=-1), dtype)
+        if self.retrain_stage:
+            return tf.layers.batch_normalization(higher_matrix, axis=-1, training=self.training,
+                                                 reuse=tf.AUTO_REUSE, scale=True, center=False,
+                                                 name='higher_order_BN',
+                                                 gamma_initializer=tf.constant_initializer(weight_base))
+        with tf.variable_scope('higher_edge_weight', reuse=tf.AUTO_REUSE):
+            self.higher_edge_weights = tf.get_variable('higher_weights', shape=[init.shape[0]],
+                                                       initializer=tf.random_uniform_initializer(
+                                                           minval=weight_base - 0.001,
+                                                           maxval=weight_base + 0.001))
+            tf.add_to_collection("higher_edge_weights", self.higher_edge_weights)
+        higher_matrix = tf.layers.batch_normalization(higher_matrix, axis=-1, training=self.training,
+                                                      reuse=tf.AUTO_REUSE, scale=False, center=False,
+                                                      name='higher_order_BN')
+        self.higher_bn_stats = [v for v in tf.global_variables() if v.name.startswith('higher_order_BN/')]
+        return higher_matrix * tf.expand_dims(self.higher_edge_weights, axis=0)
+
+    def refresh_pool(self, sess, patience=3):
+        """
+        replace the tuples of the higher-order pool whose alpha has been 0 at patience consecutive checks. half of
+            the new tuples extend an interaction that is still kept (a triple if third_prune and order > 3, else a
+            pair) by random fields, the others are sampled uniformly, none is in the pool or among the replaced
+            tuples, so a tuple GRDA pruned is not drawn back in its place. a new tuple starts as the initial pool: alpha
+            at weight_base, its GRDA accumulator at the l1 penalty accumulated so far plus weight_base, and
+            BN statistics of mean 0 and variance 1
+        :param sess:
+        :param patience:
+        :return: number of replaced tuples
+        """
+        alpha, pool, age = sess.run([self.higher_edge_weights, self.higher_pool, self.higher_age])
+        self.higher_zero_checks = np.where(alpha == 0, self.higher_zero_checks + 1, 0)
+        dead = np.where(self.higher_zero_checks >= patience)[0]
+        age += 1
+        if dead.shape[0] == 0:
+            self.higher_age.load(age, sess)
+            return 0
+        order = pool.shape[1]
+        if self.third_prune and order > 3:
+            seeds = np.stack([self.first, self.second, self.third], axis=1)[sess.run(self.third_edge_weights) != 0]
         else:
-            self.logits, self.outputs = output([l, fm_out, b, ])
+            seeds = np.stack([self.cols, self.rows], axis=1)[sess.run(self.edge_weights) != 0]
+        fresh = sample_tuples(int(self.xv.shape[1]), order, dead.shape[0], self.higher_rng, seeds=seeds,
+                              exclude=set(tuple(t) for t in pool.tolist()))
+        dead = dead[:fresh.shape[0]]
+        pool[dead] = fresh
+        self.higher_pool.load(pool, sess)
+        self.higher_zero_checks[dead] = 0
+        age[dead] = 0
+        self.higher_age.load(age, sess)
+        opt = self.structure_optimizer
+        accumulator = opt.get_slot(self.higher_edge_weights, 'accumulator')
+        acc, l1 = sess.run([accumulator, opt._get_iter_variable('l1_accum')])
+        alpha[dead] = self.higher_weight_base
+        acc[dead] = self.higher_weight_base + l1
+        self.higher_edge_weights.load(alpha, sess)
+        accumulator.load(acc, sess)
+        for var in self.higher_bn_stats:
+            stats = sess.run(var)
+            stats[dead] = 1. if 'variance' in var.name else 0.
+            var.load(stats, sess)
+        print('higher order pool: replaced %d of %d tuples' % (dead.shape[0], pool.shape[0]))
+        return dead.shape[0]
+
+    def _live_index_(self, scope, size):
+        """
+        index of the interactions still computed in search stage, shrunk by prune_interactions(). the products of
+            the frozen interactions are 0, so their alpha gets no gradient and the BN and optimizer states keep
+            their shapes
+        :param scope: variable scope of the alpha
+        :param size: number of searched interactions
+        :return: int32 variable of unknown length
+        """
+        live = tf.get_variable(scope + '_live', initializer=np.arange(size, dtype=np.int32), trainable=False,
+                               validate_shape=False)
+        live_ph = tf.placeholder(tf.int32, [None], name=scope + '_live_ph')
+        self.live_index[scope] = {
+            'index': live,
+            'assign': tf.assign(live, live_ph, validate_shape=False),
+            'placeholder': live_ph,
+            'zero_checks': np.zeros(size, dtype=np.int32),
+        }
+        return live
+
+    def prune_interactions(self, sess, patience=3):
+        """
+        freeze the interactions whose alpha has been 0 at patience consecutive checks, the following steps only
+            gather and multiply the live ones
+        :param sess:
+        :param patience:
+        :return: number of live interactions per scope
+        """
+        res = {}
+        for scope, live in self.live_index.items():
+            alpha = self.edge_weights if scope == 'edge_weight' else self.third_edge_weights
+            alpha, index = sess.run([alpha, live['index']])
+            live['zero_checks'] = np.where(alpha == 0, live['zero_checks'] + 1, 0)
+            kept = index[live['zero_checks'][index] < patience]
+            if kept.shape[0] < index.shape[0]:
+                sess.run(live['assign'], feed_dict={live['placeholder']: kept})
+                print('%s: %d of %d interactions live' % (scope, kept.shape[0], alpha.shape[0]))
+            res[scope] = kept.shape[0]
+        return res
+
+    def structure_weights(self, sess):
+        """
+        :return: |alpha| of the pairs followed by the triples (if third_prune)
+        """
+        alphas = [self.edge_weights] + ([self.third_edge_weights] if self.third_prune else [])
+        return np.abs(np.concatenate(sess.run(alphas)))
+
+    def structure_pattern(self, sess):
+        """
+        :return: everything the search decides, != 0: alpha of the pairs, the triples (if third_prune) and the
+            higher-order pool (if higher_order), followed by the gates of the embedding columns (if dim_prune) and of
+            the hidden units (if unit_prune). a pooled tuple replaced by refresh_pool() turns from 0 to not 0
+        """
+        searched = [self.structure_weights(sess)]
+        if self.higher_order:
+            searched.append(sess.run(self.higher_edge_weights))
+        if self.dim_prune:
+            searched.append(sess.run(self.dim_weights).reshape(-1))
+        if self.unit_prune:
+            searched.extend(sess.run(self.unit_weights))
+        return np.concatenate(searched) != 0
+
+    def count_interactions(self, sess, min_age=3):
+        """
+        :param min_age: pooled tuples younger than min_age refresh_pool() checks are not counted, as in
+            export_structure()
+        :return: number of pairs, triples and pooled higher-order tuples whose alpha is not 0 (triples is 0 without
+            third_prune, tuples without higher_order)
+        """
+        pattern = self.structure_weights(sess) != 0
+        higher = 0
+        if self.higher_order and not self.retrain_stage:
+            alpha, age = sess.run([self.higher_edge_weights, self.higher_age])
+            higher = int(((alpha != 0) & (age >= min_age)).sum())
+        return int(pattern[:len(self.cols)].sum()), int(pattern[len(self.cols):].sum()), higher
+
+    def serving_flops(self, pairs, triples, higher=0):
+        """
+        :param higher: number of kept higher-order tuples, each costs (order - 1) * k as in export_structure()
+        :return: predicted multiply-adds per example of a structure keeping pairs, triples and higher tuples, the
+            interactions plus the dense layers, see interaction_flops()
+        """
+        k = int(self.xv.shape[2])
+        higher_flops = higher * (self.higher_order - 1) * k if self.higher_order else 0
+        return interaction_flops(pairs, triples, k,
+                                 int(self.xps.shape[2]) if self.third_prune else 0) + higher_flops + self.dense_flops
 
     def analyse_structure(self, sess, print_full_weight=False, epoch=None):
-        import numpy as np
+        if self.retrain_stage:
+            print("retrain stage, kept pairs", len(self.cols))
+            if self.third_prune:
+                print("retrain stage, kept triples", len(self.first))
+            return
         wts, mask = sess.run(["edge_weight/normed_wts:0", "edge_weight/unpruned_mask:0"])
         if print_full_weight:
             outline = ""
@@ -139,165 +471,454 @@ class AutoFM(Model):
             zeros_ = np.zeros_like(mask, dtype=np.float32)
             zeros_[mask == 0] = 1
             print("third masked edge_num", sum(zeros_))
+        if self.higher_order:
+            print("higher order kept tuples", int((sess.run(self.higher_edge_weights) != 0).sum()))
+        self.analyse_groups(sess)
 
-    def compile(self, loss=None, optimizer1=None, optimizer2=None, global_step=None, pos_weight=1.0):
-        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        with tf.control_dependencies(update_ops):
-            with tf.name_scope('loss'):
-                self.loss = tf.reduce_mean(loss(logits=self.logits, targets=self.labels, pos_weight=pos_weight))
-                _loss_ = self.loss
-                if self.third_prune:
-                    self.l2_loss = get_l2_loss([self.l2_w, self.l2_v, self.l2_ps],
-                                               [self.xw, self.xv, self.xps])
-                else:
-                    self.l2_loss = get_l2_loss([self.l2_w, self.l2_v],
-                                               [self.xw, self.xv])
-                if self.l2_loss is not None:
-                    _loss_ += self.l2_loss
-                if self.retrain_stage:
-                    all_variable = [v for v in tf.trainable_variables()]
-                    self.optimizer1 = optimizer1.minimize(loss=_loss_, var_list=all_variable)
-                else:
-                    if self.third_prune:
-                        weight_second_var = list(set(tf.get_collection("edge_weights")))
-                        weight_third_var = list(set(tf.get_collection("third_edge_weights")))
-                        weight_var = weight_second_var + weight_third_var
-                        weight_var = list(set(weight_var))
-                    else:
-                        weight_var = list(set(tf.get_collection("edge_weights")))
-                    all_variable = [v for v in tf.trainable_variables()]
-                    other_var = [i for i in all_variable if i not in weight_var]
-                    self.optimizer1 = optimizer1.minimize(loss=_loss_, var_list=other_var)
-                    self.optimizer2 = optimizer2.minimize(loss=_loss_, var_list=weight_var)
+
+    def __str__(self):
+        return self.__class__.__name__
+
+def scaled_gradients(optimizer, loss, var_list, loss_scale=None):
+    """
+    :return: optimizer.compute_gradients(loss * loss_scale) divided by loss_scale, plain gradients if it is None
+    """
+    if loss_scale is None:
+        return optimizer.compute_gradients(loss, var_list=var_list)
+    res = []
+    for g, v in optimizer.compute_gradients(loss * loss_scale, var_list=var_list):
+        if isinstance(g, tf.IndexedSlices):
+            g = tf.IndexedSlices(g.values / loss_scale, g.indices, g.dense_shape)
+        elif g is not None:
+            g = g / loss_scale
+        res.append((g, v))
+    return res
+
+def generate_pairs(ranges=range(1, 100), mask=None, order=2):
+    res = []
+    for i in range(order):
+        res.append([])
+    for i, pair in enumerate(list(combinations(ranges, order))):
+        if mask is None or mask[i]==1:
+            for j in range(order):
+                res[j].append(pair[j])
+    print("generated pairs", len(res[0]))
+    return res
+
+def project_mask(mask, fields, num_inputs, order=2):
+    """
+    restrict a comb mask over combinations(range(num_inputs), order) to the combinations of the selected fields,
+        so that it indexes generate_pairs(range(len(fields)), order=order) on inputs holding only those fields
+    :param mask: comb mask over all fields, None keeps every combination
+    :param fields: sorted column indices of the selected fields
+    :param num_inputs: number of fields the mask was built on
+    :param order:
+    :return: projected mask, or None if mask is None
+    """
+    if mask is None:
+        return None
+    fields = set(fields)
+    return [mask[i] for i, comb in enumerate(combinations(range(num_inputs), order)) if fields.issuperset(comb)]
+
+def field_ranges(feat_sizes, fields=None):
+    """
+    :param feat_sizes: cardinality of every field of the data set
+    :param fields: sorted column indices of the selected fields, None for all
+    :return: sizes and offsets of the id ranges of the (selected) fields
+    """
+    offsets = np.cumsum([0] + list(feat_sizes[:-1])).tolist()
+    if fields is None:
+        return list(feat_sizes), offsets
+    return [feat_sizes[i] for i in fields], [offsets[i] for i in fields]
+
+def lift_mask(mask, fields, num_inputs, order=2):
+    """
+    inverse of project_mask(), combinations touching a field outside fields are dropped
+    :param mask: comb mask over combinations(range(len(fields)), order)
+    :param fields: sorted column indices of the selected fields
+    :param num_inputs: number of fields of the returned mask
+    :param order:
+    :return: comb mask over combinations(range(num_inputs), order)
+    """
+    projected = iter(mask)
+    fields = set(fields)
+    return [next(projected) if fields.issuperset(comb) else 0 for comb in combinations(range(num_inputs), order)]
+
+def expand_mask(kept, comb_mask, num_inputs, order=2):
+    """
+    :param kept: 0/1 per searched combination, i.e. per entry of generate_pairs(mask=comb_mask)
+    :param comb_mask: candidate mask the search ran on, None for all combinations
+    :param num_inputs:
+    :param order:
+    :return: comb mask over combinations(range(num_inputs), order)
+    """
+    size = len(list(combinations(range(num_inputs), order)))
+    if comb_mask is None:
+        comb_mask = [1] * size
+    full = np.zeros(size, dtype=np.int32)
+    full[np.array(comb_mask) == 1] = kept
+    return full.tolist()
+
+def num_combinations(n, order):
+    res = 1
+    for i in range(order):
+        res = res * (n - i) // (i + 1)
+    return res
+
+def sample_tuples(num_inputs, order, size, rng, seeds=None, exclude=()):
+    """
+    candidate tuples of the higher-order search, distinct, sorted and not in exclude
+    :param num_inputs: number of fields
+    :param order:
+    :param size: number of tuples, fewer are returned if not as many candidates are left
+    :param rng: np.random.RandomState
+    :param seeds: kept interactions of a lower order, half of the tuples extend one of them by random fields
+    :param exclude: set of tuples not to return, e.g. the rest of the pool
+    :return: size * order int32 field indices
+    """
+    res, seen = [], set(exclude)
+    left = num_combinations(num_inputs, order) - len(seen)
+    for _ in range(100 * size):
+        if len(res) == min(size, left):
+            break
+        if seeds is not None and len(seeds) and rng.rand() < 0.5:
+            tuple_ = set(seeds[rng.randint(len(seeds))])
+            while len(tuple_) < order:
+                tuple_.add(rng.randint(num_inputs))
+        else:
+            tuple_ = rng.choice(num_inputs, order, replace=False)
+        tuple_ = tuple(sorted(int(i) for i in tuple_))
+        if tuple_ not in seen:
+            seen.add(tuple_)
+            res.append(tuple_)
+    return np.array(res, dtype=np.int32).reshape([-1, order])
+
+def project_tuples(tuples, fields):
+    """
+    keep the tuples of field indices within fields and index them in fields, see project_mask()
+    """
+    if tuples is None:
+        return None
+    local = {f: i for i, f in enumerate(fields)}
+    return [[local[f] for f in t] for t in tuples if all(f in local for f in t)]
+
+def interaction_flops(pairs, triples, embed_size, third_embed_size=None):
+    """
+    :return: multiply-adds per example of the inner products of pairs and the element-wise products of triples
+    """
+    return pairs * embed_size + triples * 2 * (third_embed_size or embed_size)
+
+def export_structure(ckpt, out_dir, num_inputs, comb_mask=None, comb_mask_third=None, fields=None, threshold=0.,
+                     top_k=None, top_k_third=None, embed_size=None, dense_flops=0, top_k_higher=None,
+                     min_age=3):
+    """
+    read the architecture weights of a search stage checkpoint and write the kept interactions as
+        comb_mask.npy (and comb_mask_third.npy if the search was third-order) into out_dir, see load_structure(),
+        and the kept tuples of a higher-order search as higher_tuples.npy, see load_tuples()
+    :param ckpt: checkpoint path or directory holding checkpoints, the latest one is used
+    :param out_dir:
+    :param num_inputs: number of fields of the data set
+    :param comb_mask, comb_mask_third: candidate masks of the search stage
+    :param fields: field indices the search was run on, None for all fields
+    :param threshold: alpha with |alpha| <= threshold is pruned, GRDA sets pruned alpha to exactly 0
+    :param top_k, top_k_third: keep at most the top_k pairs (top_k_third triples) of largest |alpha|
+    :param top_k_higher: keep at most top_k_higher higher-order tuples of largest |alpha|
+    :param min_age: drop the tuples that were in the pool for fewer refresh_pool() checks, usually prune_patience
+    :param embed_size: if set, print the predicted serving cost of the structure, see interaction_flops()
+    :param dense_flops: multiply-adds per example of the other layers, added to the printed cost
+    :return: comb_mask, comb_mask_third (None if not searched)
+    """
+    if os.path.isdir(ckpt):
+        ckpt = tf.train.latest_checkpoint(ckpt)
+    reader = tf.train.NewCheckpointReader(ckpt)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    res, counts = [], []
+    for order, name, candidates, k in [(2, 'edge_weight/weights', comb_mask, top_k),
+                                       (3, 'third_edge_weight/third_weights', comb_mask_third, top_k_third)]:
+        if not reader.has_tensor(name):
+            res.append(None)
+            counts.append(0)
+            continue
+        alpha = np.abs(reader.get_tensor(name))
+        kept = (alpha > threshold).astype(np.int32)
+        if k is not None and kept.sum() > k:
+            kept[np.argsort(-alpha, kind='mergesort')[k:]] = 0
+        if fields is not None:
+            candidates = project_mask(candidates, fields, num_inputs, order=order)
+            mask = lift_mask(expand_mask(kept, candidates, len(fields), order=order), fields, num_inputs,
+                             order=order)
+        else:
+            mask = expand_mask(kept, candidates, num_inputs, order=order)
+        np.save(os.path.join(out_dir, 'comb_mask.npy' if order == 2 else 'comb_mask_third.npy'),
+                np.array(mask, dtype=np.int32))
+        print('order %d: kept %d of %d searched combinations' % (order, int(kept.sum()), kept.shape[0]))
+        res.append(mask)
+        counts.append(int(kept.sum()))
+    higher_flops = 0
+    if reader.has_tensor('higher_edge_weight/higher_weights'):
+        alpha = np.abs(reader.get_tensor('higher_edge_weight/higher_weights'))
+        pool = reader.get_tensor('higher_pool')
+        kept = (alpha > threshold) & (reader.get_tensor('higher_age') >= min_age)
+        if top_k_higher is not None and kept.sum() > top_k_higher:
+            kept[np.argsort(-alpha, kind='mergesort')[top_k_higher:]] = False
+        tuples = pool[kept]
+        if fields is not None:
+            tuples = np.array(fields, dtype=np.int32)[tuples]
+        np.save(os.path.join(out_dir, 'higher_tuples.npy'), tuples)
+        print('order %d: kept %d of %d pooled tuples' % (pool.shape[1], tuples.shape[0], pool.shape[0]))
+        higher_flops = tuples.shape[0] * (pool.shape[1] - 1) * (embed_size or 0)
+    if embed_size is not None:
+        print('predicted serving multiply-adds per example: %d' %
+              (interaction_flops(counts[0], counts[1], embed_size) + higher_flops + dense_flops))
+    return res[0], res[1]
+
+def load_structure(structure_dir):
+    """
+    :param structure_dir: out_dir of export_structure()
+    :return: comb_mask, comb_mask_third (None if absent), to build the retrain stage graph on
+    """
+    res = []
+    for f in ['comb_mask.npy', 'comb_mask_third.npy']:
+        path = os.path.join(structure_dir, f)
+        res.append(np.load(path).tolist() if os.path.exists(path) else None)
+    return res[0], res[1]
+
+def load_tuples(structure_dir):
+    """
+    :param structure_dir: out_dir of export_structure()
+    :return: higher-order tuples of field indices, None if absent
+    """
+    path = os.path.join(structure_dir, 'higher_tuples.npy')
+    return np.load(path).tolist() if os.path.exists(path) else None
+
+def export_groups(ckpt, out_dir, num_inputs, embed_size, fields=None, threshold=0.):
+    """
+    read the group gates of a search stage checkpoint and write the compact structure: field_columns.npy, the
+        fields * k mask of the embedding columns every field kept, and layer_sizes.npy, the units kept per hidden
+        layer followed by the output layer. the retrain stage builds the smaller model on them: every field keeps
+        its columns only, pairs multiply the columns both fields kept and the MLP reads the kept columns, see
+        column_lookup() and column_pair_product(), and the hidden layers are narrower, see load_groups()
+    :param ckpt: checkpoint path or directory holding checkpoints, the latest one is used
+    :param out_dir:
+    :param num_inputs: number of fields of the data set
+    :param embed_size: k of the search stage
+    :param fields: field indices the search was run on, None for all fields. the other fields keep k columns
+    :param threshold: gates with |gate| <= threshold are pruned
+    :return: field_columns, layer_sizes (None if not searched)
+    """
+    if os.path.isdir(ckpt):
+        ckpt = tf.train.latest_checkpoint(ckpt)
+    reader = tf.train.NewCheckpointReader(ckpt)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    field_columns, layer_sizes, full_sizes = None, None, []
+    node_in = (len(fields) if fields is not None else num_inputs) * embed_size
+    full_in = node_in
+    if reader.has_tensor('group_weight/dim_weights'):
+        gates = np.abs(reader.get_tensor('group_weight/dim_weights'))
+        kept = gates > threshold
+        # a field keeps at least its largest column, so that every table of column_lookup() has a dimension
+        kept[np.arange(kept.shape[0]), np.argmax(gates, axis=1)] = True
+        field_columns = np.ones([num_inputs, embed_size], dtype=np.int32)
+        field_columns[fields if fields is not None else np.arange(num_inputs)] = kept
+        np.save(os.path.join(out_dir, 'field_columns.npy'), field_columns)
+        node_in = int(kept.sum())
+        print('embedding columns: kept %d of %d, %d of %d columns kept by some field' %
+              (node_in, kept.size, int(kept.any(axis=0).sum()), embed_size))
+        field_columns = field_columns.tolist()
+    i = 0
+    while reader.has_tensor('group_weight/unit_weights_%d' % i):
+        gates = reader.get_tensor('group_weight/unit_weights_%d' % i)
+        layer_sizes = (layer_sizes or []) + [max(int((np.abs(gates) > threshold).sum()), 1)]
+        full_sizes.append(gates.shape[0])
+        print('hidden layer %d: kept %d of %d units' % (i, layer_sizes[-1], gates.shape[0]))
+        i += 1
+    if layer_sizes is not None:
+        layer_sizes.append(1)
+        np.save(os.path.join(out_dir, 'layer_sizes.npy'), np.array(layer_sizes, dtype=np.int32))
+        # the MLP input is the kept columns
+        print('mlp multiply-adds per example: %d -> %d' % (mlp_flops(full_in, full_sizes + [1]),
+                                                           mlp_flops(node_in, layer_sizes)))
+    return field_columns, layer_sizes
+
+def load_groups(structure_dir):
+    """
+    :param structure_dir: out_dir of export_groups()
+    :return: field_columns, layer_sizes (None if absent), to build the retrain stage graph on
+    """
+    res = []
+    for f in ['field_columns.npy', 'layer_sizes.npy']:
+        path = os.path.join(structure_dir, f)
+        res.append(np.load(path).tolist() if os.path.exists(path) else None)
+    return res[0], res[1]
+
+def compact_columns(field_columns):
+    """
+    :param field_columns: fields * k 0/1 mask of the embedding columns kept by every field, see export_groups()
+    :return: bool mask without the columns no field kept, which no product or MLP input reads
+    """
+    field_columns = np.array(field_columns, dtype=bool)
+    return field_columns[:, field_columns.any(axis=0)]
+
+def mlp_flops(node_in, layer_sizes):
+    """
+    :return: multiply-adds of the kernels of bin_mlp() for one example
+    """
+    flops = 0
+    for size in layer_sizes:
+        flops += node_in * size
+        node_in = size
+    return flops
+
+class AutoFM(Model):
+    def __init__(self, init='xavier', num_inputs=None, input_dim=None, embed_size=None, l2_w=None, l2_v=None,
+                 norm=False, real_inputs=None, comb_mask=None, weight_base=0.6, third_prune=False, 
+                 comb_mask_third=None, weight_base_third=0.6, retrain_stage=0, fields=None, pair_kernel='transpose',
+                 third_memory_budget=None, progressive_prune=False, fused_embedding=False, unique_lookup=False,
+                 third_embedding='separate', third_embed_size=None, field_dims=None, feat_sizes=None,
+                 dim_prune=False, higher_order=None,
+                 higher_pool=1000, weight_base_higher=0.6, higher_tuples=None, batch_size=None,
+                 compute_dtype=None, kernel_batch_size=None, field_columns=None):
+        self.l2_w = l2_w
+        self.l2_v = l2_v
+        self.l2_ps = l2_v
+        self.third_prune = third_prune
+        self.dim_prune = dim_prune
+        self.higher_order = higher_order
+        self.compute_dtype = tf.as_dtype(compute_dtype) if compute_dtype else None
+        self.retrain_stage = retrain_stage
+        self.pair_kernel = pair_kernel
+        # the 'auto' pair kernel is timed on batches of the training batch size
+        self.kernel_batch_size = batch_size or kernel_batch_size or self.kernel_batch_size
+        self.third_memory_budget = third_memory_budget
+        self.progressive_prune = progressive_prune
+        self.live_index = {}
+        self.third_embedding = third_embedding
+
+        if fields is not None:
+            comb_mask = project_mask(comb_mask, fields, num_inputs)
+            comb_mask_third = project_mask(comb_mask_third, fields, num_inputs, order=3)
+            higher_tuples = project_tuples(higher_tuples, fields)
+            num_inputs = len(fields)
+            if field_dims is not None:
+                field_dims = [field_dims[i] for i in fields]
+            if field_columns is not None:
+                field_columns = [field_columns[i] for i in fields]
+        if field_columns is not None:
+            if field_dims is not None:
+                raise ValueError('field_columns and field_dims can not be used together')
+            self.field_columns = compact_columns(field_columns)
+        field_sizes, field_offsets = field_ranges(feat_sizes, fields) \
+            if field_dims is not None or field_columns is not None else (None, None)
+        self.inputs, self.labels, self.training = create_placeholder(num_inputs, tf, True, batch_size=batch_size)
+        self.sample_weights = create_weight_placeholder(self.labels)
+
+        inputs, mask, flag, num_inputs = split_data_mask(self.inputs, num_inputs, norm=norm, real_inputs=real_inputs)
+
+        self.xw, self.xv, b, self.xps = embedding_lookup(init=init, input_dim=input_dim, factor=embed_size, inputs=inputs,
+                                               apply_mask=flag, mask=mask,
+                                               third_order=third_prune and third_embedding == 'separate',
+                                               fused=fused_embedding, unique=unique_lookup, field_dims=field_dims,
+                                               field_sizes=field_sizes, field_offsets=field_offsets,
+                                               field_columns=self.field_columns)
+        self.xv, self.xps = self._dim_gates_(self.xv, self.xps)
+        if third_prune and third_embedding != 'separate':
+            self.xps = self._third_embedding_(init, self.xv, third_embedding, third_embed_size)
+
+        l = linear(self.xw)
+        level_2_matrix = self._second_order_(self._compute_(self.xv), comb_mask, weight_base)
+        if third_prune:
+            level_3_matrix = self._third_order_(self._compute_(self.xps), comb_mask_third, weight_base_third)
+
+        fm_out = tf.reduce_sum(level_2_matrix, axis=-1)
+        if third_prune:
+            fm_out2 = tf.reduce_sum(level_3_matrix, axis=-1)
+        logits = [l, fm_out, fm_out2, b, ] if third_prune else [l, fm_out, b, ]
+        if higher_order:
+            logits.append(tf.reduce_sum(self._higher_order_(self._compute_(self.xv), higher_order, higher_pool,
+                                                            weight_base_higher, higher_tuples), axis=-1))
+        self.logits, self.outputs = output(logits)
 
 class AutoDeepFM(Model):
     def __init__(self, init='xavier', num_inputs=None, input_dim=None, embed_size=None, l2_w=None, l2_v=None,
                  layer_sizes=None, layer_acts=None, layer_keeps=None, layer_l2=None, norm=False, real_inputs=None,
                  batch_norm=False, layer_norm=False, comb_mask=None, weight_base=0.6, third_prune=False, 
-                 comb_mask_third=None, weight_base_third=0.6, retrain_stage=0):
+                 comb_mask_third=None, weight_base_third=0.6, retrain_stage=0, fields=None, pair_kernel='transpose',
+                 third_memory_budget=None, progressive_prune=False, fused_embedding=False, unique_lookup=False,
+                 third_embedding='separate', third_embed_size=None, field_dims=None, feat_sizes=None,
+                 dim_prune=False, unit_prune=False, higher_order=None,
+                 higher_pool=1000, weight_base_higher=0.6, higher_tuples=None, batch_size=None,
+                 compute_dtype=None, kernel_batch_size=None, field_columns=None):
         self.l2_w = l2_w
         self.l2_v = l2_v
         self.l2_ps = l2_v
         self.layer_l2 = layer_l2
+        self.dim_prune = dim_prune
+        self.unit_prune = unit_prune
+        self.higher_order = higher_order
+        self.compute_dtype = tf.as_dtype(compute_dtype) if compute_dtype else None
         self.retrain_stage = retrain_stage
-        self.inputs, self.labels, self.training = create_placeholder(num_inputs, tf, True)
+        self.pair_kernel = pair_kernel
+        # the 'auto' pair kernel is timed on batches of the training batch size
+        self.kernel_batch_size = batch_size or kernel_batch_size or self.kernel_batch_size
+        self.third_memory_budget = third_memory_budget
+        self.progressive_prune = progressive_prune
+        self.live_index = {}
+        self.third_embedding = third_embedding
+        if fields is not None:
+            comb_mask = project_mask(comb_mask, fields, num_inputs)
+            comb_mask_third = project_mask(comb_mask_third, fields, num_inputs, order=3)
+            higher_tuples = project_tuples(higher_tuples, fields)
+            num_inputs = len(fields)
+            if field_dims is not None:
+                field_dims = [field_dims[i] for i in fields]
+            if field_columns is not None:
+                field_columns = [field_columns[i] for i in fields]
+        if field_columns is not None:
+            if field_dims is not None:
+                raise ValueError('field_columns and field_dims can not be used together')
+            self.field_columns = compact_columns(field_columns)
+        field_sizes, field_offsets = field_ranges(feat_sizes, fields) \
+            if field_dims is not None or field_columns is not None else (None, None)
+        self.inputs, self.labels, self.training = create_placeholder(num_inputs, tf, True, batch_size=batch_size)
+        self.sample_weights = create_weight_placeholder(self.labels)
         layer_keeps = drop_out(self.training, layer_keeps)
         inputs, mask, flag, num_inputs = split_data_mask(self.inputs, num_inputs, norm=norm, real_inputs=real_inputs)
 
         self.xw, xv, _, self.xps = embedding_lookup(init=init, input_dim=input_dim, factor=embed_size, inputs=inputs,
-                                            apply_mask=flag, mask=mask, use_b=False, third_order=third_prune)
+                                            apply_mask=flag, mask=mask, use_b=False,
+                                            third_order=third_prune and third_embedding == 'separate',
+                                            fused=fused_embedding, unique=unique_lookup, field_dims=field_dims,
+                                            field_sizes=field_sizes, field_offsets=field_offsets,
+                                            field_columns=self.field_columns)
+        xv, self.xps = self._dim_gates_(xv, self.xps)
+        if third_prune and third_embedding != 'separate':
+            self.xps = self._third_embedding_(init, xv, third_embedding, third_embed_size)
         self.third_prune = third_prune
         self.xv = xv
-        h = tf.reshape(xv, [-1, num_inputs * embed_size])
-        h, self.layer_kernels, _ = bin_mlp(init, layer_sizes, layer_acts, layer_keeps, h, num_inputs * embed_size,
-                                           batch_norm=batch_norm, layer_norm=layer_norm, training=self.training)
-        h = tf.squeeze(h)
+        if self.field_columns is not None:
+            # the MLP reads the kept columns only
+            h = kept_columns(self._compute_(xv), self.field_columns)
+        else:
+            h = tf.reshape(self._compute_(xv), [-1, num_inputs * embed_size])
+        node_in = int(h.shape[1])
+        self.dense_flops = mlp_flops(node_in, layer_sizes)
+        h, self.layer_kernels, _ = bin_mlp(init, layer_sizes, layer_acts, layer_keeps, h, node_in,
+                                           batch_norm=batch_norm, layer_norm=layer_norm, training=self.training,
+                                           unit_gates=self._unit_gates_(layer_sizes))
+        h = tf.cast(tf.squeeze(h), dtype)
 
         l = linear(self.xw)
-        self.cols, self.rows = generate_pairs(range(self.xv.shape[1]),mask=comb_mask)
-        t_embedding_matrix = tf.transpose(self.xv, perm=[1, 0, 2])
-        left = tf.transpose(tf.gather(t_embedding_matrix, self.rows), perm=[1, 0, 2])
-        right = tf.transpose(tf.gather(t_embedding_matrix, self.cols), perm=[1, 0, 2])
-        level_2_matrix = tf.reduce_sum(tf.multiply(left, right), axis=-1)
-        with tf.variable_scope("edge_weight", reuse=tf.AUTO_REUSE):
-            self.edge_weights = tf.get_variable('weights', shape=[len(self.cols)],
-                                                initializer=tf.random_uniform_initializer(
-                                                minval=weight_base - 0.001,
-                                                maxval=weight_base + 0.001))
-            normed_wts = tf.identity(self.edge_weights, name="normed_wts")
-            tf.add_to_collection("structure", self.edge_weights)
-            tf.add_to_collection("edge_weights", self.edge_weights)
-            mask = tf.identity(normed_wts, name="unpruned_mask")
-            mask = tf.expand_dims(mask, axis=0)
-        level_2_matrix = tf.layers.batch_normalization(level_2_matrix, axis=-1, training=self.training,
-                                                    reuse=tf.AUTO_REUSE, scale=False, center=False, name='prune_BN')
-        level_2_matrix *= mask                                          
+        level_2_matrix = self._second_order_(self._compute_(self.xv), comb_mask, weight_base)
         if third_prune:
-            self.first, self.second, self.third = generate_pairs(range(self.xps.shape[1]), mask=comb_mask_third, order=3)
-            t_embedding_matrix = tf.transpose(self.xps, perm=[1, 0, 2])
-            first_embed = tf.transpose(tf.gather(t_embedding_matrix, self.first), perm=[1, 0, 2])
-            second_embed = tf.transpose(tf.gather(t_embedding_matrix, self.second), perm=[1, 0, 2])
-            third_embed = tf.transpose(tf.gather(t_embedding_matrix, self.third), perm=[1, 0, 2])
-            level_3_matrix = tf.reduce_sum(tf.multiply(tf.multiply(first_embed, second_embed), third_embed), axis=-1)
-            with tf.variable_scope("third_edge_weight", reuse=tf.AUTO_REUSE):
-                self.third_edge_weights = tf.get_variable('third_weights', shape=[len(self.first)],
-                                                          initializer=tf.random_uniform_initializer(
-                                                              minval=weight_base_third - 0.001,
-                                                              maxval=weight_base_third + 0.001))
-                third_normed_wts = tf.identity(self.third_edge_weights, name="third_normed_wts")
-                tf.add_to_collection("third_structure", self.third_edge_weights)
-                tf.add_to_collection("third_edge_weights", self.third_edge_weights)
-                third_mask = tf.identity(third_normed_wts, name="third_unpruned_mask")
-                third_mask = tf.expand_dims(third_mask, axis=0)
-            level_3_matrix = tf.layers.batch_normalization(level_3_matrix, axis=-1, training=self.training,
-                                                           reuse=tf.AUTO_REUSE, scale=False, center=False,
-                                                           name="level_3_matrix_BN")
-            level_3_matrix *= third_mask
+            level_3_matrix = self._third_order_(self._compute_(self.xps), comb_mask_third, weight_base_third)
 
         fm_out = tf.reduce_sum(level_2_matrix, axis=-1)
         if third_prune:
             fm_out2 = tf.reduce_sum(level_3_matrix, axis=-1)
-        if third_prune:
-            self.logits, self.outputs = output([l, fm_out,fm_out2, h, ])
-        else:
-            self.logits, self.outputs = output([l, fm_out, h, ])
-
-    def analyse_structure(self, sess, print_full_weight=False, epoch=None):
-        import numpy as np
-        wts, mask = sess.run(["edge_weight/normed_wts:0", "edge_weight/unpruned_mask:0"])
-        if print_full_weight:
-            outline = ""
-            for j in range(wts.shape[0]):
-                outline += str(wts[j]) + ","
-            outline += "\n"
-            print("log avg auc all weights for(epoch:%s)" % (epoch), outline)
-        print("wts", wts[:10])
-        print("mask", mask[:10])
-        zeros_ = np.zeros_like(mask, dtype=np.float32)
-        zeros_[mask == 0] = 1
-        print("masked edge_num", sum(zeros_))
-        if self.third_prune:
-            wts, mask = sess.run(["third_edge_weight/third_normed_wts:0", "third_edge_weight/third_unpruned_mask:0"])
-            if print_full_weight:
-                outline = ""
-                for j in range(wts.shape[0]):
-                    outline += str(wts[j]) + ","
-                outline += "\n"
-                print("third log avg auc all third weights for(epoch:%s)" % (epoch), outline)
-            print("third wts", wts[:10])
-            print("third mask", mask[:10])
-            zeros_ = np.zeros_like(mask, dtype=np.float32)
-            zeros_[mask == 0] = 1
-            print("third masked edge_num", sum(zeros_))
-
-    def compile(self, loss=None, optimizer1=None, optimizer2=None, global_step=None, pos_weight=1.0):
-        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        with tf.control_dependencies(update_ops):
-            with tf.name_scope('loss'):
-                self.loss = tf.reduce_mean(loss(logits=self.logits, targets=self.labels, pos_weight=pos_weight))
-                _loss_ = self.loss
-                if self.third_prune:
-                    self.l2_loss = get_l2_loss([self.l2_w, self.l2_v, self.l2_ps, self.layer_l2],
-                                               [self.xw, self.xv, self.xps, self.layer_kernels])
-                else:
-                    self.l2_loss = get_l2_loss([self.l2_w, self.l2_v, self.layer_l2],
-                                               [self.xw, self.xv, self.layer_kernels])
-                if self.l2_loss is not None:
-                    _loss_ += self.l2_loss
-                if self.retrain_stage:
-                    all_variable = [v for v in tf.trainable_variables()]
-                    self.optimizer1 = optimizer1.minimize(loss=_loss_, var_list=all_variable)
-                else:
-                    all_variable = [v for v in tf.trainable_variables()]
-                    if self.third_prune:
-                        print("optimizer")
-                        weight_second_var = list(set(tf.get_collection("edge_weights")))
-                        weight_third_var = list(set(tf.get_collection("third_edge_weights")))
-                        weight_var = weight_second_var + weight_third_var
-                        weight_var = list(set(weight_var))
-                        # weight_var = list(set(tf.get_collection("third_edge_weights")))
-                    else:
-                        weight_var = list(set(tf.get_collection("edge_weights")))
-                    other_var = [i for i in all_variable if i not in weight_var]
-                    self.optimizer1 = optimizer1.minimize(loss=_loss_, var_list=other_var)
-                    self.optimizer2 = optimizer2.minimize(loss=_loss_, var_list=weight_var)
+        logits = [l, fm_out, fm_out2, h, ] if third_prune else [l, fm_out, h, ]
+        if higher_order:
+            logits.append(tf.reduce_sum(self._higher_order_(self._compute_(self.xv), higher_order, higher_pool,
+                                                            weight_base_higher, higher_tuples), axis=-1))
+        self.logits, self.outputs = output(logits)
@@ -7,9 +7,10 @@ import time
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 from sklearn.metrics import roc_auc_score, log_loss
 from grda_tensorflow import GRDA
-from tf_utils import get_optimizer, get_loss
+from tf_utils import enable_cpu_jit, get_optimizer, get_loss
 
 
 class Trainer:
@@ -29,7 +30,10 @@ class Trainer:
                  n_epoch=1, train_per_epoch=10000, test_per_epoch=10000, early_stop_epoch=5,
                  batch_size=2000, learning_rate=1e-2, decay_rate=0.95, learning_rate2=1e-2,decay_rate2=1,
                  logdir=None, load_ckpt=False, ckpt_time=10,grda_c=0.005, grda_mu=0.51,
-                 test_every_epoch=1, retrain_stage=0):
+                 test_every_epoch=1, retrain_stage=0, prune_every=None, prune_patience=3, group_c=None,
+                 target_pairs=None, target_triples=None, target_flops=None, budget_every=100, budget_gain=0.5,
+                 stable_every=None, stable_window=5, stable_churn=0, pool_every=100, jit=False, grappler=False,
+                 static_batch=None, loss_scale=None, stable_start=0):
         self.model = model
         self.train_gen = train_gen
         self.test_gen = test_gen
@@ -51,6 +55,36 @@ class Trainer:
         self.epsilon = epsilon
         self.test_every_epoch = test_every_epoch
         self.retrain_stage = retrain_stage
+        # search stage: every prune_every batches, freeze the interactions zero at prune_patience checks in a row
+        self.prune_every = prune_every
+        self.prune_patience = prune_patience
+        # higher-order search: every pool_every batches, replace the pooled tuples zero at prune_patience checks
+        self.pool_every = pool_every
+        # budgeted search: every budget_every batches, scale grda_c by (serving cost / target) ^ budget_gain
+        self._grda_c = grda_c
+        self.target_pairs = target_pairs
+        self.target_triples = target_triples
+        self.target_flops = target_flops
+        self.budget_every = budget_every
+        self.budget_gain = budget_gain
+        # early stop of the search: every stable_every batches, compare the zero pattern of alpha with the previous
+        # check, and stop once at most stable_churn alphas flipped at stable_window checks in a row. a check only
+        # counts from batch stable_start on and once something is pruned: the l1 threshold of GRDA starts near 0,
+        # so nothing flips during the first checks either
+        self.stable_every = stable_every
+        self.stable_window = stable_window
+        self.stable_churn = stable_churn
+        self.stable_start = stable_start
+        self.structure = None
+        self.stable_checks = 0
+        self.churn_history = []
+        # static shapes: 'drop' skips, 'pad' fills with weight 0 rows the batches shorter than batch_size, so every
+        # step runs the same shapes. evaluation always pads, see _pad_()
+        if static_batch not in (None, 'drop', 'pad'):
+            raise ValueError('unknown static_batch: %s' % static_batch)
+        if static_batch is None and self.model.inputs.shape.as_list()[0] is not None:
+            raise ValueError('the model has a static batch size, set static_batch to drop or pad short batches')
+        self.static_batch = static_batch
 
         self.call_auc = roc_auc_score
         self.call_loss = log_loss
@@ -59,17 +93,32 @@ class Trainer:
                                 # device_count={'GPU': 0},
                                 )
         config.gpu_options.allow_growth = True
+        if jit:
+            # XLA auto-clustering fuses the chains of small ops, e.g. of the interaction layers
+            enable_cpu_jit()
+            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        if grappler:
+            # two rounds of the rewrites, which fold the shape computations of static batches and fuse
+            # element-wise ops
+            rewrite_options = config.graph_options.rewrite_options
+            rewrite_options.meta_optimizer_iterations = rewriter_config_pb2.RewriterConfig.TWO
+            rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.ON
+            rewrite_options.shape_optimization = rewriter_config_pb2.RewriterConfig.ON
+            rewrite_options.arithmetic_optimization = rewriter_config_pb2.RewriterConfig.AGGRESSIVE
+            rewrite_options.dependency_optimization = rewriter_config_pb2.RewriterConfig.ON
+            rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
         # config.log_device_placement=True
         self.session = tf.Session(config=config)
 
         self.learning_rate = tf.placeholder("float")
         self.learning_rate2 = tf.placeholder("float")
+        self.grda_c = tf.placeholder("float")
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
 
         tf.summary.scalar('global_step', self.global_step)
-        if opt1 == 'adam':
+        if opt1 == 'adam' or opt1 == 'lazyadam':
             opt1 = optimizer(learning_rate=self.learning_rate, epsilon=self.epsilon)  # TODO fbh
-        elif opt1 == 'adagrad':
+        elif opt1 == 'adagrad' or opt1 == 'rowwise_adagrad':
             opt1 = optimizer(learning_rate=self.learning_rate, initial_accumulator_value=initial_accumulator_value)
         elif opt1 == 'moment':
             opt1 = optimizer(learning_rate=self.learning_rate, momentum=momentum)
@@ -79,21 +128,61 @@ class Trainer:
             opt1 = optimizer(learning_rate=self.learning_rate, )  # TODO fbh
 
         if opt2 == 'grda':
-            opt2 = GRDA(learning_rate=self.learning_rate2, c=grda_c, mu=grda_mu)
-        self.model.compile(loss=loss, optimizer1=opt1, optimizer2=opt2,global_step=self.global_step, pos_weight=pos_weight)
+            opt2 = GRDA(learning_rate=self.learning_rate2, c=self.grda_c, mu=grda_mu)
+        # the gates of embedding columns and hidden units are scale invariant under BN, so they take their own l1
+        opt3 = None
+        if group_c is not None:
+            opt3 = GRDA(learning_rate=self.learning_rate2, c=group_c, mu=grda_mu, name='GroupGRDA')
+        self.model.compile(loss=loss, optimizer1=opt1, optimizer2=opt2,global_step=self.global_step, pos_weight=pos_weight,
+                           optimizer3=opt3, loss_scale=loss_scale)
+        self.budgeted = not retrain_stage and (target_pairs, target_triples, target_flops) != (None, None, None)
+        if self.budgeted and self.target_flops is None:
+            # pairs and triples share grda_c, so count targets are met in cost and cut exactly at export
+            self.target_flops = self.model.serving_flops(
+                len(self.model.cols) if target_pairs is None else target_pairs,
+                (len(self.model.first) if self.model.third_prune else 0) if target_triples is None else target_triples,
+                int(self.model.higher_pool.shape[0]) if self.model.higher_order else 0)
 
         self.session.run(tf.global_variables_initializer())
         self.session.run(tf.local_variables_initializer())
+        if self.logdir is not None:
+            # checkpoints hold the searched architecture weights, see tf_models.export_structure()
+            self.saver = tf.train.Saver(max_to_keep=3)
+            if load_ckpt and tf.train.latest_checkpoint(self.logdir) is not None:
+                self.saver.restore(self.session, tf.train.latest_checkpoint(self.logdir))
+                print('restored from', tf.train.latest_checkpoint(self.logdir))
 
     def _run(self, fetches, feed_dict):
         return self.session.run(fetches=fetches, feed_dict=feed_dict)
 
-    def _train(self, X, y):
+    def _pad_(self, X, y, weights=None):
+        """
+        repeat the rows of a batch shorter than batch_size up to batch_size rows, the repeated rows have weight 0
+            so they do not count in the loss, they only enter the batch statistics of BN
+        :return: X, y, weights, number of real rows
+        """
+        num = len(y)
+        if num == self.batch_size:
+            return X, y, weights, num
+        index = np.arange(self.batch_size) % num
+        if weights is None:
+            weights = np.ones(num, dtype=np.float32)
+        weights = np.concatenate([weights, np.zeros(self.batch_size - num, dtype=np.float32)])
+        if type(X) is list:
+            X = [x[index] for x in X]
+        else:
+            X = X[index]
+        return X, y[index], weights, num
+
+    def _train(self, X, y, weights=None):
         feed_dict = {
             self.model.labels: y,
             self.learning_rate: self._learning_rate,
-            self.learning_rate2: self._learning_rate2
+            self.learning_rate2: self._learning_rate2,
+            self.grda_c: self._grda_c,
         }
+        if weights is not None:
+            feed_dict[self.model.sample_weights] = weights
         if type(self.model.inputs) is list:
             for i in range(len(self.model.inputs)):
                 feed_dict[self.model.inputs[i]] = X[i]
@@ -120,6 +209,7 @@ class Trainer:
             self.model.labels: y,
             self.learning_rate: self._learning_rate,
             self.learning_rate2: self._learning_rate2,
+            self.grda_c: self._grda_c,
         }
         if type(self.model.inputs) is list:
             for i in range(len(self.model.inputs)):
@@ -156,8 +246,13 @@ class Trainer:
         tic = time.time()
         num = 0
         for batch_data in gen:
-            X, y = batch_data
-            batch_loss, batch_pred = self._predict(X, y)
+            X, y = batch_data[0], batch_data[1]
+            if self.static_batch:
+                X_pad, y_pad, _, rows = self._pad_(X, y)
+                batch_loss, batch_pred = self._predict(X_pad, y_pad)
+                batch_pred = batch_pred[:rows]
+            else:
+                batch_loss, batch_pred = self._predict(X, y)
             preds.append(batch_pred)
             labels.append(y)
             cnt += 1
@@ -179,6 +274,44 @@ class Trainer:
     def _batch_callback(self):
         pass
 
+    def _adjust_budget(self):
+        """
+        move grda_c multiplicatively towards the l1 strength whose structure meets target_flops: a structure over
+            budget raises grda_c, so alpha is shrunk faster, one under budget lowers it
+        :return: serving cost of the current structure
+        """
+        pairs, triples, higher = self.model.count_interactions(self.session, self.prune_patience)
+        flops = self.model.serving_flops(pairs, triples, higher)
+        self._grda_c *= np.clip(1. * flops / self.target_flops, 0.5, 2.) ** self.budget_gain
+        print('budget: %d pairs, %d triples, %d higher-order tuples, %d of %d multiply-adds, grda_c = %e' %
+              (pairs, triples, higher, flops, self.target_flops, self._grda_c))
+        return flops
+
+    def _check_structure(self):
+        """
+        record the zero pattern of the searched weights and the churn since the previous check, see
+            Model.structure_pattern()
+        :return: True once the structure has been stable for stable_window checks
+        """
+        pattern = self.model.structure_pattern(self.session)
+        if self.structure is not None:
+            churn = int((pattern != self.structure).sum())
+            self.churn_history.append(churn)
+            counts = not pattern.all() and int(self.global_step.eval(self.session)) >= self.stable_start
+            self.stable_checks = self.stable_checks + 1 if counts and churn <= self.stable_churn else 0
+            print('structure: %d of %d kept, churn %d, stable for %d checks' %
+                  (int(pattern.sum()), pattern.shape[0], churn, self.stable_checks))
+        self.structure = pattern
+        return self.stable_checks >= self.stable_window
+
+    def _save(self):
+        if self.saver is None:
+            return
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
+        path = self.saver.save(self.session, os.path.join(self.logdir, 'model'), global_step=self.global_step)
+        print('saved checkpoint', path)
+
     def _epoch_callback(self,):
         tic = time.time()
         print('running test...')
@@ -219,11 +352,32 @@ class Trainer:
             epoch_batches = 0
 
             for batch_data in self.train_gen:
-                X, y = batch_data
+                # (X, y) or (X, y, weights) when the generator samples negatives
+                X, y = batch_data[0], batch_data[1]
+                weights = batch_data[2] if len(batch_data) > 2 else None
+                if self.static_batch == 'drop' and len(y) < self.batch_size:
+                    continue
                 label_list.append(y)
                 if last_epoch != epoch:
                     last_epoch = epoch
-                batch_loss, batch_l2, batch_pred = self._train(X, y)
+                if self.static_batch == 'pad':
+                    X_pad, y_pad, weights_pad, rows = self._pad_(X, y, weights)
+                    batch_loss, batch_l2, batch_pred = self._train(X_pad, y_pad, weights_pad)
+                    batch_pred = batch_pred[:rows]
+                else:
+                    batch_loss, batch_l2, batch_pred = self._train(X, y, weights)
+                if self.prune_every and not self.retrain_stage and (finished_batches + 1) % self.prune_every == 0:
+                    self.model.prune_interactions(self.session, self.prune_patience)
+                if self.model.higher_order and not self.retrain_stage and (finished_batches + 1) % self.pool_every == 0:
+                    self.model.refresh_pool(self.session, self.prune_patience)
+                if self.budgeted and (finished_batches + 1) % self.budget_every == 0:
+                    self._adjust_budget()
+                if self.stable_every and not self.retrain_stage and (finished_batches + 1) % self.stable_every == 0:
+                    if self._check_structure():
+                        print('structure stable, search stopped at epoch %d, batch %d' % (epoch, epoch_batches + 1))
+                        self._epoch_callback()
+                        self._save()
+                        return
 
 
                 pred_list.append(batch_pred)
@@ -254,6 +408,7 @@ class Trainer:
 
                 toc = time.time()
                 if toc - tic > self.ckpt_time * 60:
+                    self._save()
                     tic = toc
 
                 if epoch_batches % num_of_batches == 0:
@@ -261,6 +416,7 @@ class Trainer:
                         l, a = self._epoch_callback()
                         loss_list.append(l)
                         auc_list.append(a)
+                    self._save()
                     self._learning_rate *= self.decay_rate
                     self._learning_rate2 *= self.decay_rate2
                     epoch += 1
@@ -273,6 +429,7 @@ class Trainer:
                     l, a = self._epoch_callback()
                     loss_list.append(l)
                     auc_list.append(a)
+                self._save()
                 self._learning_rate *= self.decay_rate
                 self._learning_rate2 *= self.decay_rate2
                 epoch += 1
@@ -280,3 +437,50 @@ class Trainer:
                 if epoch > self.n_epoch:
                     return
 
+
+    def fit_progressive(self, fractions, min_jaccard=0.9):
+        """
+        search stage in rounds on growing stratified subsamples of the training set, each round runs fit() on its
+            subsample and continues from the weights of the previous one, with the initial learning rates and grda_c.
+            the rounds stop once the interactions kept after a round and the as many largest |alpha| of the previous
+            round have a jaccard similarity of at least min_jaccard. the ranking is compared rather than the zero
+            pattern, since GRDA prunes more the more steps it took. rounds that pruned nothing are not compared, so
+            the search goes on until the kept set is a proper subset
+        :param fractions: increasing block_fraction of every round, see Dataset.__iter__(), e.g. [0.05, 0.1, 0.2, 1.]
+        :param min_jaccard:
+        :return: per round: fraction, training examples so far, seconds so far, test auc, kept, jaccard
+        """
+        train_gen, train_per_epoch = self.train_gen, self.train_per_epoch
+        history = []
+        seconds = 0.
+        weights = None
+        # every round restarts the decay schedules (and the budgeted grda_c) rather than continuing the last round's
+        learning_rate, learning_rate2, grda_c = self._learning_rate, self._learning_rate2, self._grda_c
+        for fraction in fractions:
+            self._learning_rate, self._learning_rate2, self._grda_c = learning_rate, learning_rate2, grda_c
+            self.train_gen = train_gen.dataset.batch_generator(dict(train_gen.kwargs, block_fraction=fraction))
+            self.train_per_epoch = int(train_per_epoch * fraction) + 1
+            tic = time.time()
+            self.fit()
+            seconds += time.time() - tic
+            examples = int(self.global_step.eval(self.session)) * self.batch_size
+            _, _, _, auc = self.predict(self.test_gen, self.test_per_epoch)
+            current = self.model.structure_weights(self.session)
+            pattern = current != 0
+            jaccard = None
+            # while nothing is pruned every kept set is the whole set, so rounds are only compared once both pruned
+            if not pattern.all():
+                if weights is not None:
+                    top = np.zeros_like(pattern)
+                    top[np.argsort(-weights, kind='mergesort')[:pattern.sum()]] = True
+                    jaccard = (pattern & top).sum() / max((pattern | top).sum(), 1)
+                weights = current
+            history.append((fraction, examples, seconds, auc, int(pattern.sum()), jaccard))
+            print('round %d: fraction %g, %d examples, %d s, test auc %f, %d kept, jaccard %s' %
+                  (len(history), fraction, examples, seconds, auc, int(pattern.sum()), jaccard))
+            if jaccard is not None and jaccard >= min_jaccard:
+                print('kept interactions stable, search stopped after %d rounds' % len(history))
+                break
+        self.train_gen, self.train_per_epoch = train_gen, train_per_epoch
+        self._save()
+        return history
@@ -1,11 +1,14 @@
 from __future__ import division
 
 import os
+import time
 
 import numpy as np
 import tensorflow as tf
 
 import __init__
+from lazy_adam import LazyAdam
+from rowwise_adagrad import RowwiseAdagrad
 
 dtype = tf.float32 if __init__.config['dtype'] == 'float32' else tf.float64
 minval = __init__.config['minval']
@@ -14,39 +17,50 @@ mean = __init__.config['mean']
 stddev = __init__.config['stddev']
 
 
-def get_variable(init_type='xavier', shape=None, name=None, minval=minval, maxval=maxval, mean=mean,
-                 stddev=stddev, dtype=dtype, ):
+def get_initial_value(init_type='xavier', shape=None, name=None, minval=minval, maxval=maxval, mean=mean,
+                      stddev=stddev, dtype=dtype, ):
+    """
+    :return: initial value tensor of a variable, see get_variable()
+    """
     if type(init_type) is str:
         init_type = init_type.lower()
     if init_type == 'tnormal':
-        return tf.Variable(tf.truncated_normal(shape=shape, mean=mean, stddev=stddev, dtype=dtype), name=name)
+        return tf.truncated_normal(shape=shape, mean=mean, stddev=stddev, dtype=dtype)
     elif init_type == 'uniform':
-        return tf.Variable(tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype), name=name)
+        return tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype)
     elif init_type == 'normal':
-        return tf.Variable(tf.random_normal(shape=shape, mean=mean, stddev=stddev, dtype=dtype), name=name)
+        return tf.random_normal(shape=shape, mean=mean, stddev=stddev, dtype=dtype)
     elif init_type == 'xavier':
         maxval = np.sqrt(6. / np.sum(shape))
         minval = -maxval
         print(name, 'initialized from:', minval, maxval)
-        return tf.Variable(tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype), name=name)
+        return tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype)
     elif init_type == 'xavier_out':
         maxval = np.sqrt(3. / shape[1])
         minval = -maxval
         print(name, 'initialized from:', minval, maxval)
-        return tf.Variable(tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype), name=name)
+        return tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype)
     elif init_type == 'xavier_in':
         maxval = np.sqrt(3. / shape[0])
         minval = -maxval
         print(name, 'initialized from:', minval, maxval)
-        return tf.Variable(tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype), name=name)
+        return tf.random_uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype)
     elif init_type == 'zero':
-        return tf.Variable(tf.zeros(shape=shape, dtype=dtype), name=name)
+        return tf.zeros(shape=shape, dtype=dtype)
     elif init_type == 'one':
-        return tf.Variable(tf.ones(shape=shape, dtype=dtype), name=name)
+        return tf.ones(shape=shape, dtype=dtype)
     elif init_type == 'identity' and len(shape) == 2 and shape[0] == shape[1]:
-        return tf.Variable(tf.diag(tf.ones(shape=shape[0], dtype=dtype)), name=name)
+        return tf.diag(tf.ones(shape=shape[0], dtype=dtype))
     elif 'int' in init_type.__class__.__name__ or 'float' in init_type.__class__.__name__:
-        return tf.Variable(tf.ones(shape=shape, dtype=dtype) * init_type, name=name)
+        return tf.ones(shape=shape, dtype=dtype) * init_type
+
+
+def get_variable(init_type='xavier', shape=None, name=None, minval=minval, maxval=maxval, mean=mean,
+                 stddev=stddev, dtype=dtype, ):
+    initial_value = get_initial_value(init_type, shape=shape, name=name, minval=minval, maxval=maxval, mean=mean,
+                                      stddev=stddev, dtype=dtype)
+    if initial_value is not None:
+        return tf.Variable(initial_value, name=name)
 
 
 def selu(x):
@@ -85,6 +99,11 @@ def get_optimizer(opt_algo):
         return tf.train.AdagradOptimizer
     elif opt_algo == 'adam':
         return tf.train.AdamOptimizer
+    elif opt_algo == 'lazyadam':
+        # only the rows gathered in the batch and their moments are updated
+        return LazyAdam
+    elif opt_algo == 'rowwise_adagrad':
+        return RowwiseAdagrad
     elif opt_algo == 'moment':
         return tf.train.MomentumOptimizer
     elif opt_algo == 'ftrl':
@@ -180,15 +199,32 @@ def add_noise(noisy, x, training):
         return x
 
 
-def create_placeholder(num_inputs, dtype=dtype, training=False):
+def create_placeholder(num_inputs, dtype=dtype, training=False, batch_size=None):
+    """
+    :param batch_size: static leading dimension of inputs and labels, None for batches of any size
+    """
     with tf.name_scope('input'):
-        inputs = tf.placeholder(tf.int32, [None, num_inputs], name='input')
-        labels = tf.placeholder(tf.float32, [None], name='label')
+        inputs = tf.placeholder(tf.int32, [batch_size, num_inputs], name='input')
+        labels = tf.placeholder(tf.float32, [batch_size], name='label')
         if check(training):
             training = tf.placeholder(dtype=tf.bool, name='training')
     return inputs, labels, training
 
 
+def create_weight_placeholder(labels):
+    """
+    per-sample loss weights, e.g. importance weights of negative sampling. defaults to ones when not fed
+    """
+    with tf.name_scope('weight'):
+        weights = tf.placeholder_with_default(tf.ones_like(labels), labels.shape, name='weight')
+    return weights
+
+
+def weighted_mean(x, weights):
+    with tf.name_scope('weighted_mean'):
+        return tf.reduce_sum(x * weights) / tf.reduce_sum(weights)
+
+
 def split_data_mask(inputs, num_inputs, norm=False, real_inputs=None, num_cat=None):
     if not check(real_inputs):
         if check(norm):
@@ -295,10 +331,188 @@ def drop_out(training, keep_probs, ):
 #             return xw, xv, b, xps, x_fourth
 
 
+def gather_rows(params, ids, unique=False):
+    """
+    :param params: embedding table
+    :param ids: int tensor of any shape
+    :param unique: gather the distinct ids only and expand them with the inverse index. skewed CTR batches repeat
+        a few ids per field, so fewer rows are read and the gradient holds each touched row once
+    :return: ids.shape + params.shape[1:]
+    """
+    if not unique:
+        return tf.gather(params, ids)
+    with tf.name_scope('gather_unique'):
+        unique_ids, index = tf.unique(tf.reshape(ids, [-1]))
+        rows = tf.gather(tf.gather(params, unique_ids), index)
+        rows = tf.reshape(rows, tf.concat([tf.shape(ids), tf.shape(rows)[1:]], 0))
+        rows.set_shape(ids.get_shape().concatenate(params.get_shape()[1:]))
+        return rows
+
+
+def mixed_dims(feat_sizes, factor, alpha=0.25, min_dim=2):
+    """
+    per-field embedding dimensions shrinking with field cardinality: d_i = factor * (min_size / size_i) ^ alpha,
+        clipped to [min_dim, factor] and to the field size
+    :param feat_sizes: cardinality of every field
+    :param factor: dimension of the smallest field, and of the interactions
+    :param alpha: 0 gives every field factor dimensions, larger values shrink the big fields faster
+    :param min_dim:
+    :return: list of dimensions
+    """
+    min_size = min(feat_sizes)
+    dims = []
+    for size in feat_sizes:
+        dim = int(round(factor * (1. * min_size / size) ** alpha))
+        dims.append(max(min(dim, factor, size), min(min_dim, factor)))
+    return dims
+
+
+def mixed_dim_lookup(init, name, inputs, factor, field_dims, field_sizes, field_offsets, unique=False):
+    """
+    field embeddings of per-field dimensions, projected to the common dimension factor. fields of the same
+        dimension share one table, so there is one gather per distinct dimension
+    :param init:
+    :param name: prefix of the variables
+    :param inputs: batch * fields ids, column i holds ids of field i in [field_offsets[i], + field_sizes[i])
+    :param factor: output dimension
+    :param field_dims, field_sizes, field_offsets: per field
+    :param unique: see gather_rows()
+    :return: batch * fields * factor
+    """
+    outputs, order = [], []
+    for dim in sorted(set(field_dims)):
+        fields = [i for i, d in enumerate(field_dims) if d == dim]
+        sizes = [field_sizes[i] for i in fields]
+        # rows of the fields are stacked in the table of their dimension
+        shift = np.cumsum([0] + sizes[:-1]) - np.array([field_offsets[i] for i in fields])
+        table = get_variable(init, name='%s_%d' % (name, dim), shape=[sum(sizes), dim])
+        tf.add_to_collection("embeddings", table)
+        x = gather_rows(table, tf.gather(inputs, fields, axis=1) + shift.astype(np.int32), unique=unique)
+        if dim != factor:
+            projection = get_variable(init, name='%s_%d_projection' % (name, dim), shape=[len(fields), dim, factor])
+            x = tf.einsum('bfd,fdk->bfk', x, projection)
+        outputs.append(x)
+        order.extend(fields)
+    return tf.gather(tf.concat(outputs, axis=1), np.argsort(order), axis=1)
+
+
+def column_lookup(init, name, inputs, field_columns, field_sizes, field_offsets, unique=False):
+    """
+    field embeddings keeping only the columns every field kept in the group search, see tf_models.export_groups().
+        a field with d kept columns has rows of d dimensions and no projection, fields of the same d share one
+        table. the kept columns are placed at their position, the others are 0
+    :param init:
+    :param name: prefix of the variables
+    :param inputs: batch * fields ids, see mixed_dim_lookup()
+    :param field_columns: fields * columns 0/1 mask of the kept columns, every field keeps at least one
+    :param field_sizes, field_offsets: per field
+    :param unique: see gather_rows()
+    :return: batch * fields * columns
+    """
+    field_columns = np.array(field_columns, dtype=bool)
+    num_fields, num_columns = field_columns.shape
+    field_dims = field_columns.sum(axis=1)
+    outputs, position = [], []
+    for dim in sorted(set(field_dims.tolist())):
+        fields = [i for i in range(num_fields) if field_dims[i] == dim]
+        sizes = [field_sizes[i] for i in fields]
+        shift = np.cumsum([0] + sizes[:-1]) - np.array([field_offsets[i] for i in fields])
+        table = get_variable(init, name='%s_%d' % (name, dim), shape=[sum(sizes), dim])
+        tf.add_to_collection("embeddings", table)
+        x = gather_rows(table, tf.gather(inputs, fields, axis=1) + shift.astype(np.int32), unique=unique)
+        outputs.append(tf.reshape(x, [-1, len(fields) * dim]))
+        for i in fields:
+            position.extend(i * num_columns + np.where(field_columns[i])[0])
+    # the pruned columns read the trailing 0
+    flat = tf.concat(outputs + [tf.zeros_like(outputs[0][:, :1])], axis=1)
+    index = np.full(num_fields * num_columns, len(position), dtype=np.int32)
+    index[position] = np.arange(len(position), dtype=np.int32)
+    return tf.reshape(tf.gather(flat, index, axis=1), [-1, num_fields, num_columns])
+
+
+def kept_columns(xv, field_columns):
+    """
+    :param xv: batch * fields * columns, see column_lookup()
+    :param field_columns: fields * columns 0/1 mask
+    :return: batch * kept columns, the embeddings without the pruned columns, field by field
+    """
+    field_columns = np.array(field_columns, dtype=bool)
+    flat = tf.reshape(xv, [-1, field_columns.size])
+    return tf.gather(flat, np.where(field_columns.reshape(-1))[0].astype(np.int32), axis=1)
+
+
 def embedding_lookup(init, input_dim, factor, inputs, apply_mask=False, mask=None,
                      use_w=True, use_v=True, use_b=True, fm_path=None, fm_step=None,  third_order=False,order=None,
-                     embedsize=None):
+                     embedsize=None, fused=False, unique=False, field_dims=None, field_sizes=None,
+                     field_offsets=None, field_columns=None):
+    """
+    :param fused: keep w, v and thiird_v as columns of one [input_dim, 1 + k (+ k)] table 'wv', so that a batch
+        takes a single gather and the optimizer a single sparse update over the table
+    :param unique: gather each distinct id of the batch once, see gather_rows()
+    :param field_dims: per-field dimensions of v and thiird_v, see mixed_dim_lookup(). field_sizes and
+        field_offsets give the id range of every field. w stays one table
+    :param field_columns: fields * columns mask of the embedding columns kept by every field, replaces field_dims,
+        see column_lookup()
+    :return: xw (batch * fields), xv, xps (batch * fields * k), b
+    """
     xw, xv, b, xps = None, None, None, None
+    if field_dims is not None or field_columns is not None:
+        if fused:
+            raise ValueError('fused tables do not support per-field dimensions')
+
+        def lookup(name):
+            if field_columns is not None:
+                return column_lookup(init, name, inputs, field_columns, field_sizes, field_offsets, unique)
+            return mixed_dim_lookup(init, name, inputs, factor, field_dims, field_sizes, field_offsets, unique)
+
+        with tf.name_scope('embedding'):
+            if use_w:
+                w = get_variable(init, name='w', shape=[input_dim,])
+                tf.add_to_collection("embeddings", w)
+                xw = gather_rows(w, inputs, unique=unique)
+                if apply_mask:
+                    xw = xw * mask
+            if use_v:
+                xv = lookup('v')
+                if apply_mask:
+                    xv = xv * tf.expand_dims(mask, 2)
+            if third_order:
+                xps = lookup('thiird_v')
+                if apply_mask:
+                    xps = xps * tf.expand_dims(mask, 2)
+            if use_b:
+                b = get_variable('zero', name='b', shape=[1])
+                tf.add_to_collection("embeddings", b)
+        return xw, xv, b, xps
+    if fused and (fm_path is None or fm_step is None):
+        with tf.name_scope('embedding'):
+            parts, sizes = [], []
+            if use_w:
+                parts.append(tf.expand_dims(get_initial_value(init, name='w', shape=[input_dim,]), 1))
+                sizes.append(1)
+            if use_v:
+                parts.append(get_initial_value(init, name='v', shape=[input_dim, factor]))
+                sizes.append(factor)
+            if third_order:
+                parts.append(get_initial_value(init, name='thiird_v', shape=[input_dim, factor]))
+                sizes.append(factor)
+            wv = tf.Variable(tf.concat(parts, 1), name='wv')
+            tf.add_to_collection("embeddings", wv)
+            xwv = gather_rows(wv, inputs, unique=unique)
+            if apply_mask:
+                xwv = xwv * tf.expand_dims(mask, 2)
+            # the gradient of split is a single concat, slices would each build a full width gradient
+            parts = tf.split(xwv, sizes, axis=2)
+            if use_w:
+                xw = tf.squeeze(parts.pop(0), axis=2)
+            if use_v:
+                xv = parts.pop(0)
+            if third_order:
+                xps = parts.pop(0)
+            if use_b:
+                b = get_variable('zero', name='b', shape=[1])
+                tf.add_to_collection("embeddings", b)
+        return xw, xv, b, xps
     if fm_path is not None and fm_step is not None:
         fm_dict = load_fm(fm_path, fm_step)
         with tf.name_scope('embedding'):
@@ -320,21 +534,21 @@ def embedding_lookup(init, input_dim, factor, inputs, apply_mask=False, mask=Non
             if use_w:
                 w = get_variable(init, name='w', shape=[input_dim,])
                 tf.add_to_collection("embeddings", w)
-                xw = tf.gather(w, inputs)
+                xw = gather_rows(w, inputs, unique=unique)
                 if apply_mask:
                     xw = xw * mask
                 # tf.add_to_collection("embeddings", xw)
             if use_v:
                 v = get_variable(init_type=init, name='v', shape=[input_dim, factor])
                 tf.add_to_collection("embeddings", v)
-                xv = tf.gather(v, inputs)
+                xv = gather_rows(v, inputs, unique=unique)
                 if apply_mask:
                     xv = xv * tf.expand_dims(mask, 2)
                 # tf.add_to_collection("embeddings", xv)
             if third_order:
                 third_v = get_variable(init_type=init, name='thiird_v', shape=[input_dim, factor])
                 tf.add_to_collection("embeddings", third_v)
-                xps = tf.gather(third_v, inputs)
+                xps = gather_rows(third_v, inputs, unique=unique)
                 if apply_mask:
                     xps = xps * tf.expand_dims(mask, 2)
                 # tf.add_to_collection("embeddings", xps)
@@ -430,6 +644,202 @@ def row_col_expand(xv_embed, num_inputs):
     return xv_p, xv_q
 
 
+PAIR_KERNELS = ['transpose', 'gather', 'matmul', 'einsum']
+_pair_kernel_cache = {}
+
+
+def pair_product(xv, rows, cols, kernel='transpose'):
+    """
+    inner products of the embedding pairs (rows[i], cols[i]), all kernels give the same result
+    :param xv: batch * num * k
+    :param rows, cols: field indices of the pairs, see tf_models.generate_pairs(), lists or int32 tensors
+    :param kernel: 'transpose' gathers on field-major embeddings, 'gather' gathers on axis 1 without transposes,
+        'matmul' computes the batch * num * num gram matrix and picks the pairs from it, which never materializes
+        batch * pair * k tensors, 'einsum' fuses the multiply and the reduction over gathered embeddings
+    :return: batch * pair
+    """
+    with tf.name_scope('pair_product'):
+        if kernel == 'transpose':
+            t_embedding_matrix = tf.transpose(xv, perm=[1, 0, 2])
+            left = tf.transpose(tf.gather(t_embedding_matrix, rows), perm=[1, 0, 2])
+            right = tf.transpose(tf.gather(t_embedding_matrix, cols), perm=[1, 0, 2])
+            return tf.reduce_sum(tf.multiply(left, right), axis=-1)
+        elif kernel == 'gather':
+            return tf.reduce_sum(tf.multiply(tf.gather(xv, rows, axis=1), tf.gather(xv, cols, axis=1)), axis=-1)
+        elif kernel == 'matmul':
+            num_inputs = int(xv.shape[1])
+            gram = tf.reshape(tf.matmul(xv, xv, transpose_b=True), [-1, num_inputs * num_inputs])
+            return tf.gather(gram, tf.convert_to_tensor(rows) * num_inputs + tf.convert_to_tensor(cols), axis=1)
+        elif kernel == 'einsum':
+            return tf.einsum('bpk,bpk->bp', tf.gather(xv, rows, axis=1), tf.gather(xv, cols, axis=1))
+        raise ValueError('unknown pair kernel: %s' % kernel)
+
+
+def column_pair_product(xv, rows, cols, field_columns):
+    """
+    inner products of the embedding pairs over the columns both fields kept, so a pair costs as many
+        multiply-adds as the columns it shares instead of k, equal to pair_product() on the 0-padded xv
+    :param xv: batch * num * columns, see column_lookup()
+    :param rows, cols: field indices of the pairs, lists
+    :param field_columns: num * columns 0/1 mask
+    :return: batch * pair
+    """
+    field_columns = np.array(field_columns, dtype=bool)
+    num_columns = field_columns.shape[1]
+    left, right, segment = [], [], []
+    for p, (i, j) in enumerate(zip(rows, cols)):
+        shared = np.where(field_columns[i] & field_columns[j])[0]
+        left.extend(i * num_columns + shared)
+        right.extend(j * num_columns + shared)
+        segment.extend([p] * shared.shape[0])
+    with tf.name_scope('column_pair_product'):
+        flat = tf.reshape(xv, [-1, field_columns.size])
+        products = tf.gather(flat, np.array(left, dtype=np.int32), axis=1) * \
+            tf.gather(flat, np.array(right, dtype=np.int32), axis=1)
+        out = tf.transpose(tf.unsorted_segment_sum(tf.transpose(products), np.array(segment, dtype=np.int32),
+                                                   len(rows)))
+        out.set_shape([None, len(rows)])
+    return out
+
+
+def triple_product(xps, first, second, third, memory_budget=None):
+    """
+    products summed over k of the embedding triples (first[i], second[i], third[i])
+    :param xps: batch * num * k
+    :param first, second, third: field indices of the triples, see tf_models.generate_pairs(), lists or int32
+        tensors
+    :param memory_budget: None gathers all triples at once, which needs about 5 * batch * triple * k floats.
+        otherwise bytes the intermediates may take: the triples are processed in chunks sized from the budget and
+        the batch size, and the backward pass recomputes the chunks instead of storing them
+    :return: batch * triple
+    """
+    with tf.name_scope('triple_product'):
+        if memory_budget is None:
+            t_embedding_matrix = tf.transpose(xps, perm=[1, 0, 2])
+            first_embed = tf.transpose(tf.gather(t_embedding_matrix, first), perm=[1, 0, 2])
+            second_embed = tf.transpose(tf.gather(t_embedding_matrix, second), perm=[1, 0, 2])
+            third_embed = tf.transpose(tf.gather(t_embedding_matrix, third), perm=[1, 0, 2])
+            return tf.reduce_sum(tf.multiply(tf.multiply(first_embed, second_embed), third_embed), axis=-1)
+        return _chunked_triple_product(xps, first, second, third, memory_budget)
+
+
+def _chunked_triple_product(xps, first, second, third, memory_budget):
+    num_inputs, factor = int(xps.shape[1]), int(xps.shape[2])
+    indices = tf.stack([tf.convert_to_tensor(i, dtype=tf.int32) for i in [first, second, third]])
+    num_triples = tf.shape(indices)[1]
+    batch_size = tf.cast(tf.shape(xps)[0], tf.int64)
+    # the backward pass holds 3 gathered embeddings, 3 partial gradients and their concatenation per chunk
+    chunk_size = tf.cast(tf.maximum(memory_budget // (9 * batch_size * factor * xps.dtype.size), 1), tf.int32)
+    num_chunks = (num_triples + chunk_size - 1) // chunk_size
+
+    def chunk(c):
+        # indices of the triples in chunk c, 3 * chunk_size
+        return tf.gather(indices, tf.range(c * chunk_size, tf.minimum((c + 1) * chunk_size, num_triples)), axis=1)
+
+    @tf.custom_gradient
+    def product(x):
+        def body(c, ta):
+            idx = chunk(c)
+            out = tf.reduce_sum(tf.gather(x, idx[0], axis=1) * tf.gather(x, idx[1], axis=1) *
+                                tf.gather(x, idx[2], axis=1), axis=-1)
+            return c + 1, ta.write(c, tf.transpose(out))
+
+        # parallel_iterations=1 keeps a single chunk alive at a time
+        _, ta = tf.while_loop(lambda c, _: c < num_chunks, body,
+                              [0, tf.TensorArray(x.dtype, size=num_chunks, infer_shape=False)],
+                              parallel_iterations=1)
+        # an empty TensorArray cannot be concatenated, e.g. when all triples are pruned
+        out = tf.cond(num_chunks > 0, lambda: tf.transpose(ta.concat()),
+                      lambda: tf.zeros([tf.shape(x)[0], 0], dtype=x.dtype))
+        out.set_shape([None, indices.shape[1]])
+
+        def grad(dy):
+            def grad_body(c, dx):
+                idx = chunk(c)
+                x_0, x_1, x_2 = [tf.gather(x, idx[i], axis=1) for i in range(3)]
+                g = tf.expand_dims(tf.gather(dy, tf.range(c * chunk_size, tf.minimum((c + 1) * chunk_size,
+                                                                                      num_triples)), axis=1), -1)
+                # chunk * batch * k partial gradients, summed into the fields they came from
+                partial = tf.transpose(tf.concat([g * x_1 * x_2, g * x_0 * x_2, g * x_0 * x_1], axis=1), [1, 0, 2])
+                partial = tf.unsorted_segment_sum(partial, tf.reshape(idx, [-1]), num_inputs)
+                return c + 1, dx + tf.transpose(partial, [1, 0, 2])
+
+            _, dx = tf.while_loop(lambda c, _: c < num_chunks, grad_body, [0, tf.zeros_like(x)],
+                                  parallel_iterations=1)
+            return dx
+
+        return out, grad
+
+    return product(xps)
+
+
+def scatter_columns(x, index, size):
+    """
+    :param x: batch * len(index)
+    :param index: column of every column of x in the output
+    :param size: number of output columns
+    :return: batch * size, 0 in the columns missing from index
+    """
+    with tf.name_scope('scatter_columns'):
+        out = tf.transpose(tf.scatter_nd(tf.expand_dims(index, 1), tf.transpose(x), [size, tf.shape(x)[0]]))
+        out.set_shape([None, size])
+    return out
+
+
+def enable_cpu_jit():
+    """
+    allow XLA auto-clustering on CPU, sessions still need global_jit_level ON_1 in their config. TF reads the flag
+        when the first session is created, so call this before, e.g. before select_pair_kernel() runs
+    """
+    flags = os.environ.get('TF_XLA_FLAGS', '')
+    if '--tf_xla_cpu_global_jit' not in flags:
+        os.environ['TF_XLA_FLAGS'] = (flags + ' --tf_xla_cpu_global_jit').strip()
+
+
+def time_fetches(session, fetches, feed_dict=None, runs=10, warmup=2):
+    """
+    :return: median wall time in seconds of session.run(fetches)
+    """
+    for _ in range(warmup):
+        session.run(fetches, feed_dict=feed_dict)
+    times = []
+    for _ in range(runs):
+        tic = time.time()
+        session.run(fetches, feed_dict=feed_dict)
+        times.append(time.time() - tic)
+    return float(np.median(times))
+
+
+def select_pair_kernel(batch_size, num_inputs, factor, rows, cols, kernels=PAIR_KERNELS, runs=10,
+                       compute_dtype=tf.float32):
+    """
+    time forward and backward of every pair kernel on random embeddings of the given shape in a separate graph,
+        the choice is cached per shape, number of pairs, compute dtype and device
+    :param compute_dtype: dtype the products are computed in, the embeddings stay float32 and are cast to it as in
+        the models, see Model._compute_()
+    :return: name of the fastest kernel
+    """
+    compute_dtype = tf.as_dtype(compute_dtype)
+    key = (batch_size, num_inputs, factor, len(rows), compute_dtype.name,
+           bool(tf.config.list_physical_devices('GPU')))
+    if key in _pair_kernel_cache:
+        return _pair_kernel_cache[key]
+    times = {}
+    with tf.Graph().as_default():
+        xv = tf.Variable(np.random.normal(size=[batch_size, num_inputs, factor]).astype(np.float32))
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            for kernel in kernels:
+                out = pair_product(tf.cast(xv, compute_dtype), rows, cols, kernel=kernel)
+                grad = tf.gradients(tf.reduce_sum(out), xv)[0]
+                times[kernel] = time_fetches(session, [out, grad], runs=runs)
+    best = min(times, key=times.get)
+    print('pair kernel times (ms, %s):' % compute_dtype.name,
+          ', '.join('%s %.2f' % (k, times[k] * 1000) for k in kernels), '-> use', best)
+    _pair_kernel_cache[key] = best
+    return best
+
+
 def batch_kernel_product(xv_p, xv_q, kernel=None, add_bias=True, factor=None, num_pairs=None, reduce_sum=True, mask=None):
     """
     :param xv_p: batch * pair * k
@@ -595,7 +1005,13 @@ def layer_normalization(x, reduce_dim=1, out_dim=None, scale=None, bias=None):
 
 
 def bin_mlp(init, layer_sizes, layer_acts, layer_keeps, h, node_in, batch_norm=False, layer_norm=False, training=True,
-            res_conn=False):
+            res_conn=False, unit_gates=None):
+    """
+    :param h: input, the layers compute in its dtype, e.g. bfloat16 with float32 kernels, biases and BN
+    :param unit_gates: per layer, None or a vector multiplying the outputs of the layer, a unit whose gate is 0
+        outputs 0 and can be removed
+    """
+    compute_dtype = h.dtype
     layer_kernels = []
     layer_biases = []
     x_prev = None
@@ -606,16 +1022,18 @@ def bin_mlp(init, layer_sizes, layer_acts, layer_keeps, h, node_in, batch_norm=F
             print(wi.shape, bi.shape)
             print(layer_acts[i], layer_keeps[i])
 
-            h = tf.matmul(h, wi)
+            h = tf.matmul(h, tf.cast(wi, compute_dtype))
             if i < len(layer_sizes) - 1:
                 if batch_norm:
-                    h = tf.layers.batch_normalization(h, training=training, reuse=tf.AUTO_REUSE, scale=False,
-                                                      center=False, name='mlp_bn_%d' % i)
+                    h = tf.layers.batch_normalization(tf.cast(h, wi.dtype), training=training, reuse=tf.AUTO_REUSE,
+                                                      scale=False, center=False, name='mlp_bn_%d' % i)
+                    h = tf.cast(h, compute_dtype)
                     # h = batch_normalization(h, out_dim=layer_sizes[i], bias=False)
                 elif layer_norm:
-                    h = layer_normalization(h, out_dim=layer_sizes[i], bias=False)
+                    h = tf.cast(layer_normalization(tf.cast(h, wi.dtype), out_dim=layer_sizes[i], bias=False),
+                                compute_dtype)
             # h = tf.matmul(h, wi)
-            h = h + bi
+            h = h + tf.cast(bi, compute_dtype)
             if res_conn:
                 if x_prev is None:
                     x_prev = h
@@ -626,7 +1044,9 @@ def bin_mlp(init, layer_sizes, layer_acts, layer_keeps, h, node_in, batch_norm=F
             h = tf.nn.dropout(
                 activate(
                     h, layer_acts[i]),
-                layer_keeps[i])
+                tf.cast(layer_keeps[i], compute_dtype))
+            if unit_gates is not None and unit_gates[i] is not None:
+                h = h * tf.cast(unit_gates[i], compute_dtype)
             node_in = layer_sizes[i]
             layer_kernels.append(wi)
             layer_biases.append(bi)